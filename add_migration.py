@@ -111,7 +111,9 @@ async def migrate_user_profile(database):
             afirmacion_anxious TEXT,
             afirmacion_avoidant TEXT,
             afirmacion_secure TEXT,
-            afirmacion_disorganized TEXT
+            afirmacion_disorganized TEXT,
+            test_digest TEXT,
+            test_digest_key TEXT
         )
     ''')
     # Intentar agregar las columnas si la tabla ya existe
@@ -151,6 +153,14 @@ async def migrate_user_profile(database):
         await database.execute('ALTER TABLE user_profile ADD COLUMN relationship_status TEXT')
     except Exception:
         pass  # Ya existe
+    try:
+        await database.execute('ALTER TABLE user_profile ADD COLUMN test_digest TEXT')
+    except Exception:
+        pass  # Ya existe
+    try:
+        await database.execute('ALTER TABLE user_profile ADD COLUMN test_digest_key TEXT')
+    except Exception:
+        pass  # Ya existe
     
     # Create affirmations table
     await database.execute('''
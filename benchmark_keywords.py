@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: precompiled keyword matcher vs. the previous extract_keywords loop.
+
+    python benchmark_keywords.py --repeat 2000 --sizes 10,100,1000
+
+For every message size (in words) the previous implementation and the matcher run on
+the same Spanish, English and Russian messages, asking for the first 5 categories as
+extract_keywords does; prints microseconds per call and the speedup over the previous
+implementation. Besides the default matcher (which picks its engine by message length),
+each engine is measured on its own: the Aho-Corasick automaton (when pyahocorasick is
+installed), the regex fallback and the per-stem scan used for long messages. Messages
+mix keywords with ordinary words at --density. The previous implementation is
+reproduced here (keyword dict rebuilt on every call, nested substring loop) so the
+comparison keeps working after it was replaced.
+"""
+import random
+import argparse
+import timeit
+
+from keyword_matcher import ATTACHMENT_KEYWORDS, KeywordMatcher, _ahocorasick_available
+
+KEYWORD_WORDS = {
+    "es": "ansiedad miedo relación pelea confianza tranquilidad distancia pareja".split(),
+    "en": "anxiety fear relationship fight trust calm distance partner".split(),
+    "ru": "тревогу страх отношениях ссорой доверия спокойствия дистанция партнёр".split(),
+}
+
+FILLER_WORDS = {
+    "es": "mi novio no me contesta los mensajes y el fin de semana fuimos a cenar con unos amigos luego "
+          "paseamos por el centro de la ciudad pero cuando volvimos a casa apenas hablamos".split(),
+    "en": "my boyfriend does not answer my messages and at the weekend we went to dinner with some friends then "
+          "we walked around the city centre but when we got home we barely spoke".split(),
+    "ru": "мой парень не отвечает на сообщения а в выходные мы ходили ужинать с друзьями потом гуляли "
+          "по центру города но когда вернулись домой почти не разговаривали".split(),
+}
+
+def legacy_extract_keywords(message, language="es"):
+    """The replaced implementation: fresh dict per call, nested `in` checks"""
+    attachment_keywords = {lang: {category: list(words) for category, words in categories.items()}
+                           for lang, categories in ATTACHMENT_KEYWORDS.items()}
+    message_lower = message.lower()
+    lang_keywords = attachment_keywords.get(language, attachment_keywords["es"])
+    found_categories = []
+    for category, keywords in lang_keywords.items():
+        for keyword in keywords:
+            if keyword in message_lower:
+                found_categories.append(category)
+                break
+    unique_categories = []
+    for category in found_categories:
+        if category not in unique_categories:
+            unique_categories.append(category)
+    return unique_categories[:5]
+
+def make_message(language, words, rng, density=0.05):
+    return " ".join(
+        rng.choice(KEYWORD_WORDS[language] if rng.random() < density else FILLER_WORDS[language])
+        for _ in range(words)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="calls per implementation and message")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated message sizes in words")
+    parser.add_argument("--density", type=float, default=0.05, help="share of keyword words in the messages")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    never = float("inf")
+    engines = [
+        ("default", KeywordMatcher()),
+        ("regex", KeywordMatcher(use_automaton=False, scan_min_chars=never)),
+        ("scan", KeywordMatcher(scan_min_chars=0)),
+    ]
+    if _ahocorasick_available:
+        engines.insert(1, ("automaton", KeywordMatcher(use_automaton=True, scan_min_chars=never)))
+    else:
+        print("pyahocorasick not installed: the default matcher uses the regex engine")
+
+    def per_call_us(function):
+        return timeit.timeit(function, number=args.repeat) / args.repeat * 1e6
+
+    rng = random.Random(args.seed)
+    print(f"{'lang':<5}{'words':>7}{'legacy us':>11}" + "".join(f"{name + ' us':>14}{'speedup':>9}" for name, _ in engines))
+    mismatches = 0
+    for size in [int(size) for size in args.sizes.split(",") if size.strip()]:
+        for language in KEYWORD_WORDS:
+            message = make_message(language, size, rng, args.density)
+            legacy_us = per_call_us(lambda: legacy_extract_keywords(message, language))
+            line = f"{language:<5}{size:>7}{legacy_us:>11.1f}"
+            for _, matcher in engines:
+                engine_us = per_call_us(lambda: matcher.categories_in(message, language, limit=5))
+                line += f"{engine_us:>14.1f}{legacy_us / engine_us:>8.1f}x"
+            print(line)
+            results = {tuple(matcher.categories_in(message, language, limit=5)) for _, matcher in engines}
+            mismatches += len(results) > 1
+    if mismatches:
+        print(f"WARNING: the engines disagreed on {mismatches} messages")
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,261 @@
 # chatgpt_wrapper.py
-from openai import OpenAI
+import os
+import time
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from llm_resilience import llm_caller
+from llm_scheduler import llm_scheduler, PRIORITY_INTERACTIVE
+from llm_usage import usage_recorder
+
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+# Alternative OpenAI-compatible endpoint, e.g. fake_openai_server.py for load tests
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Connection pool shared by every async client in the process
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+
+# HTTP/2 needs the optional h2 package
+try:
+    import h2  # type: ignore  # noqa: F401
+    _http2_available = True
+except ImportError:
+    _http2_available = False
+
+_async_http_client = None
+
+def get_async_http_client():
+    """Return the process-wide pooled keep-alive HTTP client used for async completions"""
+    global _async_http_client
+    if _async_http_client is None or _async_http_client.is_closed:
+        _async_http_client = httpx.AsyncClient(
+            http2=_http2_available,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        print(f"[DEBUG] Created pooled OpenAI HTTP client (http2={_http2_available}, max_connections={OPENAI_MAX_CONNECTIONS})")
+    return _async_http_client
+
+async def close_async_http_client():
+    global _async_http_client
+    if _async_http_client is not None and not _async_http_client.is_closed:
+        await _async_http_client.aclose()
+    _async_http_client = None
+
+def _message_chars(message):
+    return len(message.get("content") or "")
+
+class MessageWindow(list):
+    """
+    Message list keeping a running character count, so ChatGPT.size() is O(1). on_resize
+    (set by SessionManager) is called with the change in characters after every update.
+    """
+    def __init__(self, messages=(), on_resize=None):
+        super().__init__(messages)
+        self.chars = sum(_message_chars(m) for m in self)
+        self.on_resize = on_resize
+
+    def _resized(self, delta):
+        if delta:
+            self.chars += delta
+            if self.on_resize is not None:
+                self.on_resize(delta)
+
+    def append(self, message):
+        super().append(message)
+        self._resized(_message_chars(message))
+
+    def extend(self, messages):
+        messages = list(messages)
+        super().extend(messages)
+        self._resized(sum(_message_chars(m) for m in messages))
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, message):
+        super().insert(index, message)
+        self._resized(_message_chars(message))
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self._resized(-_message_chars(message))
+        return message
+
+    def remove(self, message):
+        super().remove(message)
+        self._resized(-_message_chars(message))
+
+    def clear(self):
+        removed = self.chars
+        super().clear()
+        self._resized(-removed)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            removed = sum(_message_chars(m) for m in self[index])
+            added = sum(_message_chars(m) for m in value)
+        else:
+            removed, added = _message_chars(self[index]), _message_chars(value)
+        super().__setitem__(index, value)
+        self._resized(added - removed)
+
+    def __delitem__(self, index):
+        removed = self[index]
+        super().__delitem__(index)
+        self._resized(-(sum(_message_chars(m) for m in removed) if isinstance(index, slice) else _message_chars(removed)))
 
 class ChatGPT:
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key, client=None, async_client=None, max_messages=None, model=DEFAULT_MODEL):
+        self.api_key = api_key
+        self.model = model
+        # Shared clients can be passed in so many per-user instances reuse one connection pool
+        self.client = client or OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL)
+        self.async_client = async_client
         self.messages = []
+        # Maximum number of non-system messages kept in the window (None = unbounded)
+        self.max_messages = max_messages
 
-    def chat(self, message):
-        self.messages.append({"role": "user", "content": message})
-        response = self.client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=self.messages
+    def get_async_client(self):
+        if self.async_client is None:
+            # Retries and deadlines are handled by llm_caller, not by the SDK
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=OPENAI_BASE_URL,
+                                            http_client=get_async_http_client(), max_retries=0)
+        return self.async_client
+
+    @property
+    def messages(self):
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages):
+        # Assigning a new list keeps the size listener and reports the difference
+        previous = getattr(self, "_messages", None)
+        on_resize = previous.on_resize if previous is not None else None
+        self._messages = MessageWindow(messages, on_resize)
+        if previous is not None:
+            previous.on_resize = None
+            if on_resize is not None and self._messages.chars != previous.chars:
+                on_resize(self._messages.chars - previous.chars)
+
+    def _completion_args(self, model=None, max_tokens=None, timeout=None):
+        """Per-request overrides chosen by the model router"""
+        args = {"model": model or self.model, "messages": list(self.messages)}
+        if max_tokens:
+            args["max_tokens"] = max_tokens
+        if timeout:
+            args["timeout"] = timeout
+        return args
+
+    def _record_usage(self, args, usage, started, user_id=None, state=None):
+        """Report token counts and latency of one completion to the usage recorder"""
+        usage_recorder.record(
+            args["model"],
+            getattr(usage, "prompt_tokens", 0) if usage else 0,
+            getattr(usage, "completion_tokens", 0) if usage else 0,
+            (time.monotonic() - started) * 1000,
+            user_id=user_id, state=state
         )
+
+    def chat(self, message, model=None, max_tokens=None, timeout=None, user_id=None, state=None):
+        self.messages.append({"role": "user", "content": message})
+        self.trim()
+        args = self._completion_args(model, max_tokens, timeout)
+        started = time.monotonic()
+        response = self.client.chat.completions.create(**args)
+        self._record_usage(args, response.usage, started, user_id, state)
+        reply = response.choices[0].message.content
+        self.messages.append({"role": "assistant", "content": reply})
+        self.trim()
+        return reply
+
+    def _rollback(self, message):
+        # Drop the user message of a failed call so the window does not keep an unanswered turn
+        if self.messages and self.messages[-1] == {"role": "user", "content": message}:
+            self.messages.pop()
+
+    async def achat(self, message, model=None, max_tokens=None, timeout=None, priority=PRIORITY_INTERACTIVE,
+                    user_id=None, state=None):
+        """
+        Async version of chat() - waits on the pooled connection instead of a worker thread.
+        The call waits for a slot in llm_scheduler (SchedulerOverloaded when the queue is full),
+        then goes through llm_caller (deadline, retries, hedging, circuit breaker) and raises
+        LLMUnavailableError when the model cannot answer in time.
+        """
+        self.messages.append({"role": "user", "content": message})
+        self.trim()
+        args = self._completion_args(model, max_tokens)
+        client = self.get_async_client()
+        try:
+            async with llm_scheduler.slot(priority):
+                started = time.monotonic()
+                response = await llm_caller.call(lambda: client.chat.completions.create(**args), timeout=timeout)
+                self._record_usage(args, response.usage, started, user_id, state)
+        except Exception:
+            self._rollback(message)
+            raise
         reply = response.choices[0].message.content
         self.messages.append({"role": "assistant", "content": reply})
+        self.trim()
         return reply
 
+    async def astream(self, message, model=None, max_tokens=None, timeout=None, priority=PRIORITY_INTERACTIVE,
+                      user_id=None, state=None):
+        """
+        Stream the reply token by token; the full reply is added to the window when the stream ends.
+        The scheduler slot is held until the stream is exhausted.
+        """
+        self.messages.append({"role": "user", "content": message})
+        self.trim()
+        args = self._completion_args(model, max_tokens)
+        client = self.get_async_client()
+        parts = []
+        usage = None
+        try:
+            async with llm_scheduler.slot(priority):
+                started = time.monotonic()
+                # Only opening the stream is retried; a stream that breaks halfway is not replayed
+                stream = await llm_caller.call(
+                    lambda: client.chat.completions.create(**args, stream=True, stream_options={"include_usage": True}),
+                    timeout=timeout, hedge=False
+                )
+                async for chunk in stream:
+                    # The last chunk carries the usage block and no choices
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+                self._record_usage(args, usage, started, user_id, state)
+        except Exception:
+            self._rollback(message)
+            raise
+        self.messages.append({"role": "assistant", "content": "".join(parts)})
+        self.trim()
+
+    def trim(self):
+        """Drop the oldest non-system messages so the window stays within max_messages"""
+        if not self.max_messages:
+            return
+        system = [m for m in self.messages if m["role"] == "system"][:1]
+        rest = [m for m in self.messages if m["role"] != "system"]
+        if len(rest) > self.max_messages:
+            self.messages[:] = system + rest[-self.max_messages:]
+
+    def size(self):
+        """Approximate memory footprint of the window in characters"""
+        return self.messages.chars
+
     def reset(self):
         self.messages.clear()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Token-aware prompt packing.
+
+Builds the messages sent to the model within a fixed token budget. The budget is split
+between the system prompt, the injected knowledge, the test/profile context and the
+conversation history; any share a section does not use is handed on to the history.
+Markup is stripped before counting, so HTML-heavy assistant replies are not overcounted.
+"""
+import os
+import re
+import html
+
+# tiktoken gives exact counts for the OpenAI models; without it we fall back to an estimate
+_tiktoken_available = False
+try:
+    import tiktoken  # type: ignore
+    _encoding = tiktoken.get_encoding("cl100k_base")  # gpt-4-turbo / gpt-4o-mini family
+    _tiktoken_available = True
+except Exception as e:
+    print(f"[DEBUG] tiktoken not available ({e}), using estimated token counts")
+    _encoding = None
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+
+# Share of the budget reserved for each section, in packing order
+CONTEXT_BUDGET_SHARES = {
+    "system": 0.30,
+    "knowledge": 0.15,
+    "test_context": 0.20,
+    "history": 0.35,
+}
+
+# Chat format overhead per message (role + separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_SPACE_RE = re.compile(r"[ \t]+")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+
+def strip_markup(text: str) -> str:
+    """Remove HTML tags and entities and collapse whitespace"""
+    if not text:
+        return ""
+    text = re.sub(r"<br\s*/?>|</p>|</li>", "\n", text, flags=re.IGNORECASE)
+    text = _TAG_RE.sub("", text)
+    text = html.unescape(text)
+    text = _SPACE_RE.sub(" ", text)
+    text = _BLANK_LINES_RE.sub("\n\n", text)
+    return text.strip()
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in text (exact with tiktoken, estimated otherwise)"""
+    if not text:
+        return 0
+    if _tiktoken_available:
+        return len(_encoding.encode(text))
+    # Latin text averages ~4 characters per token, Cyrillic and accented text far fewer
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return int(ascii_chars / 4 + other_chars / 1.5) + 1
+
+def count_message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text so that it fits in max_tokens"""
+    if max_tokens <= 0 or not text:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _tiktoken_available:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens])
+    # Binary search on the character length for the estimated count
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+class ContextPacker:
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, shares=None):
+        self.budget = budget
+        self.shares = shares or CONTEXT_BUDGET_SHARES
+
+    def section_budget(self, section):
+        return int(self.budget * self.shares.get(section, 0))
+
+    def pack(self, system_prompt, knowledge="", test_context="", history=None, reserve=0):
+        """
+        Fit every section into its share of the budget.
+        `reserve` tokens are kept free for the incoming user message.
+        Returns the fitted texts, the history messages to send (chronological,
+        markup stripped) and a per-section token report.
+        """
+        history = history or []
+        available = self.budget - reserve
+        packed = {}
+        report = {}
+        carry = 0  # tokens left unused by earlier sections
+
+        for section, text in (("system", system_prompt), ("knowledge", knowledge), ("test_context", test_context)):
+            limit = min(self.section_budget(section) + carry, available)
+            fitted = truncate_to_tokens(text or "", limit)
+            used = count_tokens(fitted)
+            packed[section] = fitted
+            report[section] = used
+            carry = limit - used
+            available -= used
+
+        # Newest history first, until the remaining budget is spent
+        history_messages = []
+        used = 0
+        for item in reversed(history):
+            content = strip_markup(item.get("content") or "")
+            if not content:
+                continue
+            cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > available:
+                break
+            history_messages.append({"role": item["role"], "content": content})
+            used += cost
+        history_messages.reverse()
+        packed["history"] = history_messages
+        report["history"] = used
+        report["history_messages"] = len(history_messages)
+        report["reserve"] = reserve
+        report["total"] = report["system"] + report["knowledge"] + report["test_context"] + used + reserve
+        report["budget"] = self.budget
+        packed["report"] = report
+        return packed
+
+context_packer = ContextPacker()
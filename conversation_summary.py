@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling per-user conversation summaries.
+
+Older turns are folded into a compact summary stored in conversation_summaries, so a
+conversation turn only has to send the summary plus the messages not folded yet. The
+summary is updated in the background every SUMMARY_EVERY_N_MESSAGES new messages.
+"""
+import os
+import asyncio
+import datetime
+
+from context_packer import count_tokens, strip_markup, truncate_to_tokens
+from model_router import route_model
+from llm_scheduler import PRIORITY_BACKGROUND
+
+# Fold older turns into the summary every N new messages
+SUMMARY_EVERY_N_MESSAGES = int(os.getenv("SUMMARY_EVERY_N_MESSAGES", "10"))
+# Raw messages still sent to the model next to the summary
+SUMMARY_RECENT_MESSAGES = int(os.getenv("SUMMARY_RECENT_MESSAGES", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "600"))
+# Bounds of one fold (messages and transcript tokens) and folds per background update, so a
+# long backlog is summarized in several model calls that each fit the context
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "60"))
+SUMMARY_BATCH_TOKENS = int(os.getenv("SUMMARY_BATCH_TOKENS", "6000"))
+SUMMARY_MAX_BATCHES = int(os.getenv("SUMMARY_MAX_BATCHES", "5"))
+
+SUMMARY_INSTRUCTIONS = (
+    "Eres el asistente de memoria de Eldric, un coach emocional. "
+    "Actualiza el resumen de la relación con el usuario combinando el resumen anterior con los mensajes nuevos. "
+    "Conserva los datos personales (nombres, pareja, edad), los temas importantes, las emociones, los problemas "
+    "de pareja que ha contado y los consejos que ya se le dieron. "
+    "Escribe en español, en tercera persona, como una lista breve de puntos. No inventes nada. "
+    f"Máximo {SUMMARY_MAX_TOKENS} tokens."
+)
+
+# Users whose summary is being updated right now (avoids overlapping updates)
+_updating = set()
+# Keep references to running tasks so they are not garbage collected
+_background_tasks = set()
+
+async def get_summary(database, user_id):
+    """
+    Return the stored summary row for user_id as a dict, or None. unsummarized_messages
+    counts the stored messages newer than summarized_until, which the prompt still needs raw.
+    """
+    if not database or not database.is_connected:
+        return None
+    try:
+        row = await database.fetch_one("""
+            SELECT s.summary, s.summarized_until, s.summarized_messages,
+                   (SELECT COUNT(*) FROM conversations c
+                    WHERE c.user_id = s.user_id AND c.timestamp > s.summarized_until) AS unsummarized_messages
+            FROM conversation_summaries s WHERE s.user_id = :user_id
+        """, {"user_id": user_id})
+        return dict(row) if row else None
+    except Exception as e:
+        print(f"[DEBUG] Error loading conversation summary: {e}")
+        return None
+
+def format_summary_for_prompt(summary_row):
+    if not summary_row or not summary_row.get("summary"):
+        return ""
+    return f"\n\n[RESUMEN DE CONVERSACIONES ANTERIORES]\n{summary_row['summary']}\n"
+
+def fold_batch(rows, foldable):
+    """
+    Leading rows (at most `foldable` of them) whose transcript fits SUMMARY_BATCH_TOKENS, and
+    that transcript. A batch never ends inside a run of equal timestamps, since
+    summarized_until is a timestamp and the rest of the run would be skipped.
+    """
+    lines, tokens = [], 0
+    for row in rows[:foldable]:
+        line = f"{'Usuario' if row['role'] == 'user' else 'Eldric'}: {strip_markup(row['content'])}"
+        line = truncate_to_tokens(line, SUMMARY_BATCH_TOKENS)
+        line_tokens = count_tokens(line)
+        if lines and tokens + line_tokens > SUMMARY_BATCH_TOKENS:
+            break
+        lines.append(line)
+        tokens += line_tokens
+    folded = len(lines)
+    if folded < len(rows):
+        while folded > 0 and rows[folded - 1]["timestamp"] == rows[folded]["timestamp"]:
+            folded -= 1
+    return rows[:folded], "\n".join(lines[:folded])
+
+async def update_summary(database, new_chatbot, user_id):
+    """
+    Fold messages older than the recent window into the user's summary, if enough have
+    accumulated: up to SUMMARY_MAX_BATCHES bounded folds; later updates continue a backlog.
+    """
+    folded = False
+    for _ in range(max(1, SUMMARY_MAX_BATCHES)):
+        if not await _fold_next_batch(database, new_chatbot, user_id):
+            break
+        folded = True
+    return folded
+
+async def _fold_next_batch(database, new_chatbot, user_id):
+    summary_row = await get_summary(database, user_id)
+    since = summary_row["summarized_until"] if summary_row else None
+
+    query = "SELECT role, content, timestamp FROM conversations WHERE user_id = :user_id"
+    values = {"user_id": user_id, "limit": SUMMARY_BATCH_MESSAGES + SUMMARY_RECENT_MESSAGES}
+    if since:
+        query += " AND timestamp > :since"
+        values["since"] = since
+    query += " ORDER BY timestamp ASC LIMIT :limit"
+    rows = await database.fetch_all(query, values=values)
+
+    # Only summarize once N messages exist beyond the window that is still sent raw; with the
+    # LIMIT, everything before the last SUMMARY_RECENT_MESSAGES rows fetched is outside that window
+    if len(rows) - SUMMARY_RECENT_MESSAGES < SUMMARY_EVERY_N_MESSAGES:
+        return False
+
+    foldable, transcript = fold_batch(rows, len(rows) - SUMMARY_RECENT_MESSAGES)
+    if not foldable:
+        return False
+    previous = summary_row["summary"] if summary_row and summary_row.get("summary") else "(sin resumen todavía)"
+
+    chatbot = new_chatbot()
+    chatbot.messages = [{"role": "system", "content": SUMMARY_INSTRUCTIONS}]
+    route = route_model("summary")
+    summary = await chatbot.achat(
+        f"RESUMEN ANTERIOR:\n{previous}\n\nMENSAJES NUEVOS:\n{transcript}",
+        model=route["model"], max_tokens=route["max_tokens"], timeout=route["latency_budget"],
+        priority=PRIORITY_BACKGROUND, user_id=user_id, state="summary"
+    )
+    summary = truncate_to_tokens(summary.strip(), SUMMARY_MAX_TOKENS)
+
+    values = {
+        "user_id": user_id,
+        "summary": summary,
+        "summarized_until": foldable[-1]["timestamp"],
+        "count": len(foldable),
+        "now": datetime.datetime.now(),
+    }
+    if summary_row:
+        await database.execute("""
+            UPDATE conversation_summaries
+            SET summary = :summary, summarized_until = :summarized_until,
+                summarized_messages = summarized_messages + :count, updated_at = :now
+            WHERE user_id = :user_id
+        """, values)
+    else:
+        await database.execute("""
+            INSERT INTO conversation_summaries (user_id, summary, summarized_until, summarized_messages, updated_at)
+            VALUES (:user_id, :summary, :summarized_until, :count, :now)
+        """, values)
+    print(f"[DEBUG] Folded {len(foldable)} messages into the conversation summary for {user_id}")
+    return True
+
+async def _run_update(database, new_chatbot, user_id):
+    try:
+        await update_summary(database, new_chatbot, user_id)
+    except Exception as e:
+        print(f"[DEBUG] Error updating conversation summary for {user_id}: {e}")
+    finally:
+        _updating.discard(user_id)
+
+def schedule_summary_update(database, new_chatbot, user_id):
+    """Start a background summary update for user_id unless one is already running"""
+    if user_id == "invitado" or user_id in _updating or new_chatbot is None:
+        return
+    if not database or not database.is_connected:
+        return
+    _updating.add(user_id)
+    task = asyncio.create_task(_run_update(database, new_chatbot, user_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
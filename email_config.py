@@ -125,9 +125,9 @@ def send_verification_email(to_email: str, verification_code: str, language: str
         print(f"[ERROR] Failed to send verification email to {to_email}: {e}")
         return False
 
-def send_pdf_email(to_email: str, pdf_path: str, user_name: str = None, language: str = "es") -> bool:
+def send_pdf_email(to_email: str, pdf_path: str, user_name: str = None, language: str = "es", insights_html: str = None) -> bool:
     """
-    Send PDF report email
+    Send PDF report email, optionally with a generated personalized insights section
     """
     try:
         config = get_email_config()
@@ -166,6 +166,8 @@ def send_pdf_email(to_email: str, pdf_path: str, user_name: str = None, language
                         <li>🎯 Pasos específicos para tu crecimiento personal</li>
                     </ul>
                     
+                    {f'<h3 style="color: #2c3e50;">Tus insights personalizados</h3>{insights_html}' if insights_html else ''}
+                    
                     <p>Puedes guardarlo, imprimirlo o compartirlo con tu pareja si lo deseas.</p>
                     
                     <p>Recuerda que estoy aquí para seguir apoyándote en tu viaje de crecimiento personal. ¡No dudes en contactarme cuando necesites!</p>
@@ -199,6 +201,8 @@ def send_pdf_email(to_email: str, pdf_path: str, user_name: str = None, language
                         <li>🎯 Specific steps for your personal growth</li>
                     </ul>
                     
+                    {f'<h3 style="color: #2c3e50;">Your personalized insights</h3>{insights_html}' if insights_html else ''}
+                    
                     <p>You can save it, print it, or share it with your partner if you'd like.</p>
                     
                     <p>Remember that I'm here to continue supporting you on your personal growth journey. Don't hesitate to reach out when you need me!</p>
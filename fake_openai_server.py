@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Fake OpenAI-compatible completion server for local load tests.
+
+Serves POST /v1/chat/completions (plain and stream=True) without touching the real API,
+so the whole /message pipeline can be benchmarked offline. Point the app at it with:
+
+    uvicorn fake_openai_server:app --port 8001
+    OPENAI_BASE_URL=http://localhost:8001/v1 CHATGPT_API_KEY=fake uvicorn main:app
+
+Configuration (environment):
+    FAKE_LLM_LATENCY      time to first token: "fixed:0.8", "uniform:0.3,2.0",
+                          "lognormal:0.8,0.5" (median seconds, sigma) or "normal:1.0,0.3"
+    FAKE_LLM_TOKEN_DELAY  seconds between streamed tokens (default 0.02)
+    FAKE_LLM_ERROR_RATE   fraction of requests that fail (default 0)
+    FAKE_LLM_ERROR_STATUS comma-separated status codes to fail with (default 500,429)
+    FAKE_LLM_MODE         "echo" (repeat the last user message) or "canned" (default)
+    FAKE_LLM_CANNED_FILE  JSON list of replies used in canned mode
+    FAKE_LLM_SEED         seed for reproducible latencies and errors
+"""
+import os
+import json
+import time
+import uuid
+import math
+import random
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:0.8,0.5")
+FAKE_LLM_TOKEN_DELAY = float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0.02"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_ERROR_STATUS = [int(code) for code in os.getenv("FAKE_LLM_ERROR_STATUS", "500,429").split(",") if code.strip()]
+FAKE_LLM_MODE = os.getenv("FAKE_LLM_MODE", "canned")
+FAKE_LLM_CANNED_FILE = os.getenv("FAKE_LLM_CANNED_FILE")
+
+DEFAULT_CANNED_REPLIES = [
+    "Entiendo lo que sientes. Cuando la otra persona se aleja, es normal que se active el miedo al abandono. "
+    "¿Qué es lo que más te preocupa de esta situación?",
+    "Gracias por contármelo. Poner límites no significa querer menos, significa cuidarte también a ti. "
+    "¿Cómo te gustaría que respondiera tu pareja?",
+    "Lo que describes encaja con un patrón de apego evitativo: necesitar espacio cuando la relación se vuelve "
+    "más cercana. Hablarlo con calma puede ayudar a que ambos os sintáis seguros.",
+]
+
+rng = random.Random(os.getenv("FAKE_LLM_SEED"))
+
+def load_canned_replies():
+    if not FAKE_LLM_CANNED_FILE:
+        return DEFAULT_CANNED_REPLIES
+    try:
+        with open(FAKE_LLM_CANNED_FILE, encoding="utf-8") as f:
+            replies = json.load(f)
+        if isinstance(replies, list) and replies:
+            return [str(reply) for reply in replies]
+        print(f"[DEBUG] {FAKE_LLM_CANNED_FILE} must be a non-empty JSON list, using default replies")
+    except Exception as e:
+        print(f"[DEBUG] Could not load canned replies ({e}), using default replies")
+    return DEFAULT_CANNED_REPLIES
+
+CANNED_REPLIES = load_canned_replies()
+
+def sample_latency(spec=FAKE_LLM_LATENCY):
+    """Draw one latency in seconds from a "kind:params" distribution spec"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()]
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+def make_reply(messages):
+    if FAKE_LLM_MODE == "echo":
+        last_user = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+        return f"Echo: {last_user}"
+    return rng.choice(CANNED_REPLIES)
+
+def split_tokens(text):
+    """Roughly one token per word, keeping the spaces so the chunks join back to the text"""
+    words = text.split(" ")
+    return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+app = FastAPI()
+
+stats = {"requests": 0, "streams": 0, "errors": 0, "in_flight": 0}
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]}
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages") or []
+    model = body.get("model") or "fake"
+    stats["requests"] += 1
+
+    if rng.random() < FAKE_LLM_ERROR_RATE:
+        stats["errors"] += 1
+        status = rng.choice(FAKE_LLM_ERROR_STATUS)
+        # Fail after part of the usual latency, like an overloaded upstream
+        await asyncio.sleep(sample_latency() * rng.random())
+        return JSONResponse(
+            status_code=status,
+            content={"error": {"message": f"Fake error {status}", "type": "fake_error", "code": status}}
+        )
+
+    reply = make_reply(messages)
+    max_tokens = body.get("max_tokens")
+    tokens = split_tokens(reply)
+    if max_tokens:
+        tokens = tokens[:max_tokens]
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+    prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in messages)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens + len(tokens),
+    }
+
+    if body.get("stream"):
+        stats["streams"] += 1
+
+        async def events():
+            stats["in_flight"] += 1
+            try:
+                await asyncio.sleep(sample_latency())
+                for token in tokens:
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(FAKE_LLM_TOKEN_DELAY)
+                final = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage_chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [], "usage": usage,
+                    }
+                    yield f"data: {json.dumps(usage_chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    stats["in_flight"] += 1
+    try:
+        # Non-streamed calls wait for the whole generation, like the real API
+        await asyncio.sleep(sample_latency() + FAKE_LLM_TOKEN_DELAY * len(tokens))
+    finally:
+        stats["in_flight"] -= 1
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(tokens)},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("FAKE_LLM_PORT", "8001")))
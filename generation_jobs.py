@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Offline generation jobs.
+
+Heavy per-user generation (PDF reports and their insight texts) is queued in the
+generation_jobs table instead of running inside the request. GenerationJobRunner claims
+pending jobs in batches and runs them with bounded concurrency at background priority,
+or, with GENERATION_PROVIDER_BATCH=true, submits their completions to the OpenAI Batch
+API (cheaper per token, results within the completion window) and polls for results.
+
+A job kind is registered with two coroutines:
+    build_messages(job) -> list of chat messages, or None when no completion is needed
+    finish(job, text)   -> result stored on the job (text is None when nothing was generated)
+Raising from either marks the attempt as failed; it is retried with backoff up to
+GENERATION_MAX_ATTEMPTS times.
+"""
+import os
+import json
+import asyncio
+import datetime
+
+from model_router import route_model
+from llm_scheduler import PRIORITY_BACKGROUND
+from llm_usage import usage_recorder
+
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+GENERATION_BATCH_SIZE = int(os.getenv("GENERATION_BATCH_SIZE", "20"))
+GENERATION_POLL_SECONDS = float(os.getenv("GENERATION_POLL_SECONDS", "5"))
+GENERATION_MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", "3"))
+GENERATION_PROVIDER_BATCH = os.getenv("GENERATION_PROVIDER_BATCH", "false").lower() == "true"
+GENERATION_PROVIDER_POLL_SECONDS = float(os.getenv("GENERATION_PROVIDER_POLL_SECONDS", "60"))
+# Jobs left 'running' longer than this (e.g. by a restart) are picked up again
+GENERATION_STALE_SECONDS = int(os.getenv("GENERATION_STALE_SECONDS", "600"))
+
+ACTIVE_STATUSES = "('pending', 'running', 'submitted')"
+
+async def enqueue_job(database, user_id, kind, language="es", payload=None):
+    """Queue a job unless the same (user, kind) is already waiting or running. Returns False on error."""
+    if not database or not database.is_connected:
+        return False
+    try:
+        await database.execute(f"""
+            INSERT INTO generation_jobs (user_id, kind, language, payload)
+            VALUES (:user_id, :kind, :language, :payload)
+            ON CONFLICT (user_id, kind) WHERE status IN {ACTIVE_STATUSES} DO NOTHING
+        """, {"user_id": user_id, "kind": kind, "language": language,
+              "payload": json.dumps(payload or {}, ensure_ascii=False)})
+        print(f"[DEBUG] Queued generation job {kind} for {user_id}")
+        return True
+    except Exception as e:
+        print(f"[DEBUG] Error queueing generation job {kind} for {user_id}: {e}")
+        return False
+
+async def claim_jobs(database, limit):
+    """Atomically move up to `limit` due jobs from pending to running"""
+    now = datetime.datetime.now()
+    rows = await database.fetch_all("""
+        UPDATE generation_jobs
+        SET status = 'running', attempts = attempts + 1, updated_at = :now
+        WHERE id IN (
+            SELECT id FROM generation_jobs
+            WHERE status = 'pending' AND run_after <= :now
+            ORDER BY id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, kind, language, payload, attempts
+    """, {"now": now, "limit": limit})
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job.get("payload") else {}
+        jobs.append(job)
+    return jobs
+
+async def requeue_stale_jobs(database):
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=GENERATION_STALE_SECONDS)
+    await database.execute(
+        "UPDATE generation_jobs SET status = 'pending' WHERE status = 'running' AND updated_at < :cutoff",
+        {"cutoff": cutoff}
+    )
+
+class GenerationJobRunner:
+    def __init__(self, database, new_chatbot=None, concurrency=GENERATION_CONCURRENCY, batch_size=GENERATION_BATCH_SIZE,
+                 poll_seconds=GENERATION_POLL_SECONDS, use_provider_batch=GENERATION_PROVIDER_BATCH):
+        self.database = database
+        self.new_chatbot = new_chatbot
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.use_provider_batch = use_provider_batch and new_chatbot is not None
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.handlers = {}  # kind -> (build_messages, finish)
+        self.task = None
+        self.last_provider_poll = 0.0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.submitted = 0
+
+    def register(self, kind, build_messages, finish):
+        self.handlers[kind] = (build_messages, finish)
+
+    def start(self):
+        if self.task is None and self.database is not None:
+            self.task = asyncio.create_task(self._loop())
+            print(f"[DEBUG] Generation job runner started (concurrency={self.concurrency}, provider_batch={self.use_provider_batch})")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _loop(self):
+        try:
+            await requeue_stale_jobs(self.database)
+        except Exception as e:
+            print(f"[DEBUG] Error requeueing stale generation jobs: {e}")
+        loop = asyncio.get_running_loop()
+        while True:
+            claimed = 0
+            try:
+                claimed = await self.run_once()
+                if self.use_provider_batch and loop.time() - self.last_provider_poll >= GENERATION_PROVIDER_POLL_SECONDS:
+                    self.last_provider_poll = loop.time()
+                    await self.poll_provider_batches()
+            except Exception as e:
+                print(f"[DEBUG] Error in generation job runner: {e}")
+            # Keep draining while there is backlog, otherwise wait for new work
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.poll_seconds)
+
+    async def run_once(self):
+        """Claim one batch of due jobs and process it; returns how many were claimed"""
+        if not self.database.is_connected:
+            return 0
+        jobs = await claim_jobs(self.database, self.batch_size)
+        if not jobs:
+            return 0
+        if self.use_provider_batch:
+            await self.submit_provider_batch(jobs)
+        else:
+            await asyncio.gather(*(self._run_job(job) for job in jobs))
+        return len(jobs)
+
+    async def _generate(self, job, messages):
+        if not messages or self.new_chatbot is None:
+            return None
+        chatbot = self.new_chatbot()
+        chatbot.messages = list(messages[:-1])
+        route = route_model("batch")
+        return await chatbot.achat(
+            messages[-1]["content"], model=route["model"], max_tokens=route["max_tokens"],
+            timeout=route["latency_budget"], priority=PRIORITY_BACKGROUND,
+            user_id=job["user_id"], state=f"batch:{job['kind']}"
+        )
+
+    async def _run_job(self, job, text=None, generated=False):
+        handler = self.handlers.get(job["kind"])
+        if handler is None:
+            await self._mark_failed(job, f"no handler for kind {job['kind']}", retry=False)
+            return
+        build_messages, finish = handler
+        async with self.semaphore:
+            try:
+                if not generated:
+                    text = await self._generate(job, await build_messages(job))
+                result = await finish(job, text)
+                await self._mark_done(job, result)
+            except Exception as e:
+                print(f"[DEBUG] Generation job {job['id']} ({job['kind']}) failed: {e}")
+                await self._mark_failed(job, str(e))
+
+    async def _mark_done(self, job, result):
+        self.completed += 1
+        await self.database.execute("""
+            UPDATE generation_jobs SET status = 'done', result = :result, error = NULL, updated_at = :now
+            WHERE id = :id
+        """, {"id": job["id"], "result": result if result is None else str(result), "now": datetime.datetime.now()})
+
+    async def _mark_failed(self, job, error, retry=True):
+        now = datetime.datetime.now()
+        if retry and job.get("attempts", 0) < GENERATION_MAX_ATTEMPTS:
+            self.retried += 1
+            run_after = now + datetime.timedelta(seconds=30 * (2 ** job.get("attempts", 0)))
+            await self.database.execute("""
+                UPDATE generation_jobs SET status = 'pending', provider_batch_id = NULL, error = :error,
+                    run_after = :run_after, updated_at = :now
+                WHERE id = :id
+            """, {"id": job["id"], "error": error, "run_after": run_after, "now": now})
+            return
+        self.failed += 1
+        await self.database.execute(
+            "UPDATE generation_jobs SET status = 'failed', error = :error, updated_at = :now WHERE id = :id",
+            {"id": job["id"], "error": error, "now": now}
+        )
+
+    async def submit_provider_batch(self, jobs):
+        """Send the completions of these jobs as one OpenAI batch; jobs that need no completion run directly"""
+        route = route_model("batch")
+        lines = []
+        direct = []
+        for job in jobs:
+            handler = self.handlers.get(job["kind"])
+            try:
+                messages = await handler[0](job) if handler else None
+            except Exception as e:
+                await self._mark_failed(job, str(e))
+                continue
+            if not messages:
+                direct.append(job)
+                continue
+            lines.append(json.dumps({
+                "custom_id": str(job["id"]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": route["model"], "messages": messages, "max_tokens": route["max_tokens"]},
+            }, ensure_ascii=False))
+        if direct:
+            await asyncio.gather(*(self._run_job(job, generated=True) for job in direct))
+        if not lines:
+            return
+
+        batch_jobs = [job for job in jobs if job not in direct]
+        try:
+            client = self.new_chatbot().get_async_client()
+            upload = await client.files.create(file=("generation_jobs.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+            batch = await client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h")
+        except Exception as e:
+            print(f"[DEBUG] Provider batch submission failed, running jobs directly: {e}")
+            await asyncio.gather(*(self._run_job(job) for job in batch_jobs))
+            return
+
+        self.submitted += len(lines)
+        for job in batch_jobs:
+            await self.database.execute("""
+                UPDATE generation_jobs SET status = 'submitted', provider_batch_id = :batch_id, updated_at = :now
+                WHERE id = :id AND status = 'running'
+            """, {"id": job["id"], "batch_id": batch.id, "now": datetime.datetime.now()})
+        print(f"[DEBUG] Submitted {len(lines)} generation jobs as provider batch {batch.id}")
+
+    async def poll_provider_batches(self):
+        """Write back the results of finished provider batches"""
+        rows = await self.database.fetch_all(
+            "SELECT DISTINCT provider_batch_id FROM generation_jobs WHERE status = 'submitted' AND provider_batch_id IS NOT NULL"
+        )
+        if not rows:
+            return
+        client = self.new_chatbot().get_async_client()
+        for row in rows:
+            batch_id = row["provider_batch_id"]
+            batch = await client.batches.retrieve(batch_id)
+            if batch.status not in ("completed", "failed", "expired", "cancelled"):
+                continue
+
+            texts = {}
+            usages = {}
+            if batch.status == "completed" and batch.output_file_id:
+                content = await client.files.content(batch.output_file_id)
+                for line in content.text.splitlines():
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    try:
+                        body = item["response"]["body"]
+                        texts[item["custom_id"]] = body["choices"][0]["message"]["content"]
+                        usages[item["custom_id"]] = (body.get("model"), body.get("usage") or {})
+                    except (KeyError, IndexError, TypeError):
+                        pass
+
+            jobs = await self.database.fetch_all("""
+                SELECT id, user_id, kind, language, payload, attempts FROM generation_jobs
+                WHERE provider_batch_id = :batch_id AND status = 'submitted'
+            """, {"batch_id": batch_id})
+            for row_job in jobs:
+                job = dict(row_job)
+                job["payload"] = json.loads(job["payload"]) if job.get("payload") else {}
+                text = texts.get(str(job["id"]))
+                if str(job["id"]) in usages:
+                    model, usage = usages[str(job["id"])]
+                    # Batch completions have no per-call latency
+                    usage_recorder.record(model, usage.get("prompt_tokens"), usage.get("completion_tokens"), 0,
+                                          user_id=job["user_id"], state=f"batch:{job['kind']}")
+                if text is None:
+                    await self._mark_failed(job, f"provider batch {batch_id} {batch.status} without output for this job")
+                else:
+                    await self._run_job(job, text=text, generated=True)
+
+    def stats(self):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "concurrency": self.concurrency,
+            "provider_batch": self.use_provider_batch,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "submitted_to_provider": self.submitted,
+        }
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk ingestion of book extracts into the eldric_knowledge* tables.
+
+    python ingest_knowledge.py attached_es.jsonl --language es --book "Attached"
+    python ingest_knowledge.py extracts.json --language ru --max-tokens 250 --dry-run
+
+The input is JSONL (one object per line) or a JSON array, read as a stream. Each record
+needs "content" (or "text"); "tags" (list or comma-separated), "book" and "chapter" are
+optional, with --book/--chapter as defaults. Content is split into chunks of at most
+--max-tokens tokens on paragraph and sentence boundaries, tags are normalized, and every
+chunk is keyed by a hash of its normalized text. Chunks are COPY'd into a temporary table
+and inserted in one transaction, skipping hashes already present, so re-running the same
+file adds nothing. knowledge_tags is synced in the same transaction; running API workers
+pick the new chunks up on their next knowledge index refresh.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+
+from databases import Database
+
+from context_packer import count_tokens
+from knowledge_tags import KNOWLEDGE_TABLES, split_tags, sync_knowledge_tags
+
+DEFAULT_MAX_TOKENS = int(os.getenv("KNOWLEDGE_CHUNK_MAX_TOKENS", "300"))
+READ_BLOCK_SIZE = 1 << 16
+
+_SPACE_RE = re.compile(r"\s+")
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+def normalize_content(text: str) -> str:
+    return _SPACE_RE.sub(" ", (text or "").strip())
+
+def content_hash(text: str) -> str:
+    """Same value as the SQL backfill in add_content_hash_columns()"""
+    return hashlib.sha256(normalize_content(text).lower().encode("utf-8")).hexdigest()
+
+async def add_content_hash_columns(database):
+    """content_hash column, index and backfill on every knowledge table (idempotent)"""
+    for table_name in KNOWLEDGE_TABLES.values():
+        try:
+            await database.execute(f"ALTER TABLE {table_name} ADD COLUMN content_hash TEXT")
+        except Exception:
+            pass  # Ya existe
+        await database.execute(f"""
+            UPDATE {table_name}
+            SET content_hash = encode(sha256(convert_to(lower(btrim(regexp_replace(content, '\\s+', ' ', 'g'))), 'UTF8')), 'hex')
+            WHERE content_hash IS NULL
+        """)
+        await database.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_hash ON {table_name} (content_hash)")
+
+def iter_records(path):
+    """Objects of a JSONL file or of a top-level JSON array, without loading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = f.read(READ_BLOCK_SIZE).lstrip()
+        if buffer.startswith("["):
+            buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            if not buffer:
+                if eof:
+                    return
+                buffer = f.read(READ_BLOCK_SIZE)
+                eof = not buffer
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                block = f.read(READ_BLOCK_SIZE)
+                eof = not block
+                buffer += block
+                continue
+            yield record
+            buffer = buffer[end:]
+
+def split_long(text, max_tokens):
+    """Split one over-long sentence on word boundaries"""
+    words = text.split(" ")
+    chunk = []
+    for word in words:
+        if chunk and count_tokens(" ".join(chunk + [word])) > max_tokens:
+            yield " ".join(chunk)
+            chunk = []
+        chunk.append(word)
+    if chunk:
+        yield " ".join(chunk)
+
+def chunk_content(text, max_tokens):
+    """Chunks of at most max_tokens tokens, packed from whole paragraphs and sentences"""
+    pieces = []
+    for paragraph in _PARAGRAPH_RE.split(text or ""):
+        paragraph = normalize_content(paragraph)
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            if count_tokens(sentence) <= max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces.extend(split_long(sentence, max_tokens))
+
+    chunk, chunk_tokens = [], 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece)
+        if chunk and chunk_tokens + piece_tokens > max_tokens:
+            yield " ".join(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(piece)
+        chunk_tokens += piece_tokens
+    if chunk:
+        yield " ".join(chunk)
+
+def iter_chunks(path, args, stats):
+    """(content, tags, book, chapter, content_hash) rows, de-duplicated within the file"""
+    seen = set()
+    for record in iter_records(path):
+        stats["records"] += 1
+        if not isinstance(record, dict):
+            stats["invalid"] += 1
+            continue
+        content = record.get("content") or record.get("text")
+        if not content:
+            stats["invalid"] += 1
+            continue
+        tags = record.get("tags") or args.tags or ""
+        if isinstance(tags, list):
+            tags = ",".join(str(tag) for tag in tags)
+        tags = ",".join(split_tags(tags))
+        book = record.get("book") or args.book
+        chapter = record.get("chapter") or args.chapter
+        for chunk in chunk_content(content, args.max_tokens):
+            key = content_hash(chunk)
+            if key in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            stats["chunks"] += 1
+            yield (chunk, tags, book, chapter, key)
+
+async def ingest(args):
+    table_name = KNOWLEDGE_TABLES[args.language]
+    stats = {"records": 0, "invalid": 0, "chunks": 0, "duplicates": 0, "inserted": 0}
+    started = time.monotonic()
+
+    if args.dry_run:
+        for _ in iter_chunks(args.path, args, stats):
+            pass
+        print(f"[DRY RUN] {table_name}: {stats}")
+        return stats
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        print("DATABASE_URL not set")
+        return stats
+    database = Database(database_url)
+    await database.connect()
+    try:
+        await add_content_hash_columns(database)
+        async with database.connection() as connection:
+            async with connection.transaction():
+                await connection.execute("""
+                    CREATE TEMP TABLE knowledge_ingest (
+                        content TEXT, tags TEXT, book TEXT, chapter TEXT, content_hash TEXT
+                    ) ON COMMIT DROP
+                """)
+                # asyncpg COPY; records are produced while the file is being read
+                await connection.raw_connection.copy_records_to_table(
+                    "knowledge_ingest",
+                    records=iter_chunks(args.path, args, stats),
+                    columns=["content", "tags", "book", "chapter", "content_hash"],
+                )
+                rows = await connection.fetch_all(f"""
+                    INSERT INTO {table_name} (content, tags, book, chapter, content_hash)
+                    SELECT i.content, i.tags, i.book, i.chapter, i.content_hash
+                    FROM knowledge_ingest i
+                    WHERE NOT EXISTS (SELECT 1 FROM {table_name} k WHERE k.content_hash = i.content_hash)
+                    RETURNING id
+                """)
+                stats["inserted"] = len(rows)
+                stats["tags_added"] = await sync_knowledge_tags(connection, table_name)
+    finally:
+        await database.disconnect()
+    print(f"[DEBUG] Ingested {args.path} into {table_name} in {time.monotonic() - started:.1f}s: {stats}")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="JSONL file or JSON array of records")
+    parser.add_argument("--language", choices=sorted(KNOWLEDGE_TABLES), default="es")
+    parser.add_argument("--book", help="book for records without one")
+    parser.add_argument("--chapter", help="chapter for records without one")
+    parser.add_argument("--tags", help="comma-separated tags for records without any")
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS, help="maximum tokens per chunk")
+    parser.add_argument("--dry-run", action="store_true", help="only read, chunk and count")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        print(f"{args.path} not found")
+        sys.exit(1)
+    asyncio.run(ingest(args))
+
+if __name__ == "__main__":
+    main()
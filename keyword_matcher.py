@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled attachment-theory keyword matcher.
+
+The keyword lists are compiled once at import: accent-folded and lightly stemmed, then
+loaded into an Aho-Corasick automaton per language (pyahocorasick), or into one
+trie-shaped regular expression per language when that package is not installed. A
+message is lowercased and folded once and scanned in a single pass; a stem only counts
+at the start of a word, and any word ending is allowed, so "celosa", "ansiosos" or
+"relaciones" match their keyword. Every match maps back to the English categories
+used as knowledge tags. benchmark_keywords.py compares it with the previous loop.
+"""
+import os
+import re
+import unicodedata
+
+_ahocorasick_available = False
+try:
+    import ahocorasick  # type: ignore
+    _ahocorasick_available = True
+except Exception as e:
+    print(f"[DEBUG] pyahocorasick not available ({e}), using the compiled regex keyword matcher")
+    ahocorasick = None
+
+# Language -> English category (knowledge tag) -> keywords
+ATTACHMENT_KEYWORDS = {
+    "es": {
+        'anxious': ['ansioso', 'ansiedad', 'preocupado', 'miedo', 'abandono', 'rechazo', 'inseguro', 'necesito', 'confirmación', 'confirmacion'],
+        'avoidant': ['evitativo', 'evito', 'distancia', 'independiente', 'solo', 'espacio', 'alejado', 'frío', 'distante'],
+        'secure': ['seguro', 'confianza', 'equilibrio', 'cómodo', 'tranquilo', 'estable', 'sano'],
+        'desorganizado': ['evitativo temeroso', 'confundido', 'contradictorio', 'caos', 'inconsistente'],
+        'relationship': ['relación', 'relaciones', 'pareja', 'amor', 'vínculo', 'conexión', 'intimidad', 'cercanía'],
+        'communication': ['comunicación', 'hablar', 'expresar', 'decir', 'conversar'],
+        'conflict': ['conflicto', 'pelea', 'discusión', 'problema', 'disputa'],
+        'trust': ['confianza', 'confiar', 'seguro', 'seguridad'],
+        'emotions': ['emoción', 'sentir', 'sentimiento', 'triste', 'feliz', 'enojado', 'frustrado']
+    },
+    "en": {
+        'anxious': ['anxious', 'anxiety', 'worried', 'fear', 'abandonment', 'rejection', 'insecure', 'need', 'confirmation'],
+        'avoidant': ['avoidant', 'avoid', 'distance', 'independent', 'alone', 'space', 'distant', 'cold', 'detached'],
+        'secure': ['secure', 'trust', 'balance', 'comfortable', 'calm', 'stable', 'healthy'],
+        'desorganizado': ['fearful avoidant', 'confused', 'contradictory', 'chaos', 'inconsistent'],
+        'relationship': ['relationship', 'partner', 'love', 'bond', 'connection', 'intimacy', 'closeness'],
+        'communication': ['communication', 'talk', 'express', 'say', 'converse'],
+        'conflict': ['conflict', 'fight', 'argument', 'problem', 'dispute'],
+        'trust': ['trust', 'trusting', 'secure', 'security'],
+        'emotions': ['emotion', 'feel', 'feeling', 'sad', 'happy', 'angry', 'frustrated']
+    },
+    "ru": {
+        'anxious': ['тревожный', 'тревога', 'беспокойный', 'страх', 'покинутость', 'отвержение', 'неуверенный', 'нужда', 'подтверждение'],
+        'avoidant': ['избегающий', 'избегать', 'дистанция', 'независимый', 'один', 'пространство', 'отдаленный', 'холодный', 'отстраненный'],
+        'secure': ['надежный', 'доверие', 'баланс', 'комфортный', 'спокойный', 'стабильный', 'здоровый'],
+        'desorganizado': ['дезорганизованный', 'запутанный', 'противоречивый', 'хаос', 'непоследовательный'],
+        'relationship': ['отношения', 'партнер', 'любовь', 'связь', 'соединение', 'близость', 'интимность'],
+        'communication': ['общение', 'говорить', 'выражать', 'сказать', 'беседовать'],
+        'conflict': ['конфликт', 'ссора', 'спор', 'проблема', 'разногласие'],
+        'trust': ['доверие', 'доверять', 'надежный', 'безопасность'],
+        'emotions': ['эмоция', 'чувствовать', 'чувство', 'грустный', 'счастливый', 'злой', 'разочарованный']
+    }
+}
+
+# Language -> conversation intent -> phrases, checked before a turn goes to the model
+INTENT_PHRASES = {
+    "es": {
+        "correction": ['cuando mencione', 'nunca mencioné', 'no mencioné', 'no dije', 'no he dicho', 'no he mencionado', 'incorrecto', 'error', 'equivocado'],
+        "test_results": ['resultados', 'resultado', 'test', 'prueba', 'estilo de apego', 'apego'],
+    },
+    "en": {
+        "correction": ['when did i mention', 'i never said', "i didn't say", 'i did not say', 'i never mentioned', "i didn't mention",
+                       'i did not mention', "i haven't said", 'incorrect', 'wrong', 'mistake', 'mistaken'],
+        "test_results": ['results', 'result', 'test', 'quiz', 'attachment style', 'attachment'],
+    },
+    "ru": {
+        "correction": ['когда я говорил', 'я не говорил', 'я не говорила', 'я не упоминал', 'я не упоминала', 'никогда не говорил',
+                       'неправильно', 'неверно', 'ошибка', 'ошибаешься'],
+        "test_results": ['результаты', 'результат', 'тест', 'стиль привязанности', 'привязанность'],
+    },
+}
+
+# Endings dropped from the last word of a keyword (longest match wins) so inflected forms match
+STEM_ENDINGS = {
+    "es": ["os", "as", "es", "o", "a", "e"],
+    "en": ["e"],
+    "ru": ["ый", "ий", "ой", "ая", "ое", "ие", "ость", "ение", "ать", "ять", "ить", "ство", "а", "я", "о", "е", "ь", "ы", "и"],
+}
+MIN_STEM_LENGTH = 4
+
+# One-word keywords whose stem would be shorter than MIN_STEM_LENGTH ("solo", "love") match
+# these inflections of it exactly instead of any word starting with the keyword
+SHORT_FORM_ENDINGS = {
+    "es": ["o", "a", "os", "as", "e", "es"],
+    "en": ["e", "es", "ed", "ing"],
+    "ru": ["а", "я", "о", "е", "ь", "ы", "и", "у", "ю", "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие",
+           "ого", "его", "ому", "ему", "ом", "ем", "ам", "ям", "ами", "ями", "ах", "ях", "ую", "юю", "ых", "их", "ым", "им"],
+}
+
+# From this message length on, categories_in() scans with str.find per stem (in category
+# order, stopping at `limit`) instead of one automaton or regex pass: CPython's substring
+# search is far cheaper per character than either, which pays off once messages are long.
+# The regex is slower than the automaton, so it hands over earlier (see benchmark_keywords.py)
+KEYWORD_SCAN_MIN_CHARS = int(os.getenv("KEYWORD_SCAN_MIN_CHARS", "1500"))
+KEYWORD_REGEX_SCAN_MIN_CHARS = int(os.getenv("KEYWORD_REGEX_SCAN_MIN_CHARS", "800"))
+
+_SPACE_RE = re.compile(r"\s+")
+
+# Folding applied to messages: plain str.replace calls, much cheaper than NFKD per message
+MESSAGE_FOLDS = [("á", "a"), ("à", "a"), ("é", "e"), ("è", "e"), ("í", "i"), ("ó", "o"), ("ò", "o"),
+                 ("ú", "u"), ("ü", "u"), ("ñ", "n"), ("ç", "c"), ("ё", "е"), ("й", "и"), ("’", "'")]
+
+def fold(text):
+    """Lowercase, strip accents (and the Cyrillic breve/diaeresis) and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _SPACE_RE.sub(" ", text).strip()
+
+def fold_message(text):
+    """Lowercase and fold the accents that occur in es/en/ru messages, keeping the length"""
+    text = (text or "").lower()
+    if not text.isascii():
+        for accented, plain in MESSAGE_FOLDS:
+            text = text.replace(accented, plain)
+    return text
+
+# Folded endings per language, longest first
+_FOLDED_ENDINGS = {
+    language: sorted((fold(ending) for ending in endings), key=len, reverse=True)
+    for language, endings in STEM_ENDINGS.items()
+}
+_FOLDED_SHORT_FORM_ENDINGS = {
+    language: [fold(ending) for ending in endings] for language, endings in SHORT_FORM_ENDINGS.items()
+}
+
+def stem_word(word, language):
+    """Already folded word with one inflectional ending removed"""
+    for ending in _FOLDED_ENDINGS.get(language, ()):
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+def stem(keyword, language):
+    """Folded keyword with one inflectional ending removed from its last word"""
+    words = fold(keyword).split(" ")
+    words[-1] = stem_word(words[-1], language)
+    return " ".join(words)
+
+def short_forms(keyword, language):
+    """Folded inflections of a one-word keyword too short to stem ("solo" -> sola, solos...), or None"""
+    word = fold(keyword)
+    if " " in word or stem_word(word, language) != word:
+        return None
+    for ending in _FOLDED_ENDINGS.get(language, ()):
+        base = word[:-len(ending)]
+        if word.endswith(ending) and MIN_STEM_LENGTH - 1 <= len(base) < MIN_STEM_LENGTH:
+            return sorted({word} | {base + form_ending for form_ending in _FOLDED_SHORT_FORM_ENDINGS.get(language, ())})
+    return None
+
+def trie_pattern(stems):
+    """
+    Regex alternation of stems factored by common prefixes (cheap to reject at each position);
+    a trailing "\0" in a stem stands for a word boundary
+    """
+    trie = {}
+    for word in stems:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [(r"\b" if ch == "\0" else re.escape(ch)) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return ("(?:" + body + ")?") if len(branches) == 1 else body + "?"
+        return body
+
+    return build(trie)
+
+def _is_word_char(ch):
+    """Same characters as the regex \\w"""
+    return ch.isalnum() or ch == "_"
+
+def _at_word_start(text, start):
+    return start == 0 or not _is_word_char(text[start - 1])
+
+def _at_word_end(text, end):
+    return end == len(text) or not _is_word_char(text[end])
+
+def _find_word_start(text, needle, start=0):
+    """Offset of the first occurrence of needle at or after start that starts a word, or -1"""
+    start = text.find(needle, start)
+    while start >= 0 and not _at_word_start(text, start):
+        start = text.find(needle, start + 1)
+    return start
+
+class KeywordMatcher:
+    """
+    Per language: an automaton (or regex) for short messages and a per-stem scan plan for
+    long ones; stems and short-keyword forms map back to their categories
+    """
+
+    def __init__(self, keywords=ATTACHMENT_KEYWORDS, use_automaton=_ahocorasick_available, scan_min_chars=None):
+        self.use_automaton = use_automaton
+        if scan_min_chars is None:
+            scan_min_chars = KEYWORD_SCAN_MIN_CHARS if use_automaton else KEYWORD_REGEX_SCAN_MIN_CHARS
+        self.scan_min_chars = scan_min_chars
+        self.order = {}  # language -> category definition order
+        self.categories = {}  # language -> {matched text: [categories]}
+        self.matchers = {}  # language -> ahocorasick.Automaton or compiled regex
+        self.scan_plans = {}  # language -> [(category, [(needle, exact forms or None)])]
+        for language, categories in keywords.items():
+            prefixes = {}  # stem -> categories; any word starting with it matches
+            exact = {}  # short-keyword form -> categories; only the whole word matches
+            plan = []
+            for category, words in categories.items():
+                needles = []
+                for word in words:
+                    forms = short_forms(word, language)
+                    entries = forms if forms else [stem(word, language)]
+                    for entry in entries:
+                        matched = (exact if forms else prefixes).setdefault(entry, [])
+                        if category not in matched:
+                            matched.append(category)
+                    needle = (forms[0][:MIN_STEM_LENGTH - 1], frozenset(forms)) if forms else (entries[0], None)
+                    if needle not in needles:
+                        needles.append(needle)
+                plan.append((category, needles))
+            self.scan_plans[language] = plan
+            self.order[language] = list(categories)
+
+            if use_automaton:
+                automaton = ahocorasick.Automaton()
+                for word_stem, word_categories in prefixes.items():
+                    automaton.add_word(word_stem, (len(word_stem), word_categories, False))
+                for form, form_categories in exact.items():
+                    if form not in prefixes:
+                        automaton.add_word(form, (len(form), form_categories, True))
+                automaton.make_automaton()
+                self.matchers[language] = automaton
+                self.categories[language] = prefixes
+            else:
+                # The regex reports the longest entry at each word start; credit the shorter stems
+                # it contains too, as the automaton does. Starting the pattern with \W (instead of
+                # \b) lets the regex engine skip ahead to non-word characters between attempts
+                self.matchers[language] = re.compile(
+                    r"\W(" + trie_pattern(list(prefixes) + [form + "\0" for form in exact]) + ")"
+                )
+                self.categories[language] = {
+                    entry: [category for other in prefixes if entry.startswith(other) for category in prefixes[other]]
+                    + exact.get(entry, [])
+                    for entry in set(prefixes) | set(exact)
+                }
+
+    def _scan(self, text, language, limit):
+        """Categories in definition order, one str.find pass per stem until a stem of the category hits"""
+        hits = {}  # needle -> bool, shared by categories with common keywords
+        found = []
+        for category, needles in self.scan_plans[language]:
+            for needle in needles:
+                hit = hits.get(needle)
+                if hit is None:
+                    prefix, forms = needle
+                    start = _find_word_start(text, prefix)
+                    if forms is not None:
+                        # Short keyword: the word starting at the prefix must be one of its forms
+                        while start >= 0:
+                            end = start + len(prefix)
+                            while end < len(text) and _is_word_char(text[end]):
+                                end += 1
+                            if text[start:end] in forms:
+                                break
+                            start = _find_word_start(text, prefix, end)
+                    hit = hits[needle] = start >= 0
+                if hit:
+                    found.append(category)
+                    break
+            if limit and len(found) >= limit:
+                break
+        return found
+
+    def categories_in(self, message, language="es", limit=None):
+        """Categories whose keywords start a word of message, in definition order (at most limit)"""
+        if language not in self.matchers:
+            language = "es"
+        text = fold_message(message)
+        if len(text) >= self.scan_min_chars:
+            return self._scan(text, language, limit)
+        found = set()
+        if self.use_automaton:
+            credited = set()  # ids of the entries already counted; later hits are skipped
+            for end, value in self.matchers[language].iter(text):
+                if id(value) in credited:
+                    continue
+                length, word_categories, whole_word = value
+                start = end - length + 1
+                if _at_word_start(text, start) and (not whole_word or _at_word_end(text, end + 1)):
+                    found.update(word_categories)
+                    credited.add(id(value))
+        else:
+            entries = self.categories[language]
+            for entry in set(self.matchers[language].findall(" " + text)):
+                found.update(entries[entry])
+        categories = [category for category in self.order[language] if category in found]
+        return categories[:limit] if limit else categories
+
+keyword_matcher = KeywordMatcher()
+intent_matcher = KeywordMatcher(INTENT_PHRASES)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Postgres full-text search over the eldric_knowledge* tables.
+
+Every knowledge table gets a generated search_vector column (content and tags, parsed
+with the language's text-search configuration) and a GIN index on it. A message is
+turned into an OR query of its stemmed words, so "celoso" finds chunks about "celos",
+and the best unquoted chunk is picked by ts_rank in a single indexed query.
+"""
+import os
+
+from knowledge_tags import KNOWLEDGE_TABLES, knowledge_table
+from knowledge_quotes import sql_unquoted
+
+KNOWLEDGE_FTS_ENABLED = os.getenv("KNOWLEDGE_FTS_ENABLED", "true").lower() == "true"
+KNOWLEDGE_FTS_MIN_RANK = float(os.getenv("KNOWLEDGE_FTS_MIN_RANK", "0.01"))
+
+# Tables whose search_vector column and index are in place; search_knowledge skips the others
+_searchable_tables = set()
+
+TEXT_SEARCH_CONFIGS = {
+    "es": "spanish",
+    "en": "english",
+    "ru": "russian",
+}
+
+def text_search_config(language: str) -> str:
+    return TEXT_SEARCH_CONFIGS.get(language, TEXT_SEARCH_CONFIGS["es"])
+
+async def add_search_vectors(database):
+    """Generated tsvector column and GIN index on every knowledge table; a failing table is left out of FTS"""
+    for language, table_name in KNOWLEDGE_TABLES.items():
+        config = text_search_config(language)
+        try:
+            await database.execute(f"""
+                ALTER TABLE {table_name} ADD COLUMN search_vector tsvector
+                GENERATED ALWAYS AS (to_tsvector('{config}', coalesce(content, '') || ' ' || coalesce(tags, ''))) STORED
+            """)
+        except Exception:
+            pass  # Ya existe
+        try:
+            await database.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table_name}_search ON {table_name} USING GIN (search_vector)"
+            )
+            _searchable_tables.add(table_name)
+        except Exception as e:
+            print(f"[DEBUG] Full-text search disabled for {table_name}: {e}")
+
+async def search_knowledge(database, language, text, quoted=None):
+    """Best-ranked chunk of the language's table matching any stemmed word of text and not in quoted, or None"""
+    if not KNOWLEDGE_FTS_ENABLED or not text or not text.strip():
+        return None
+    table_name = knowledge_table(language)
+    if table_name not in _searchable_tables:
+        return None
+    config = text_search_config(language)
+    exclude_sql = "AND " + sql_unquoted("k.id") if quoted else ""
+    values = {"text": text, "min_rank": KNOWLEDGE_FTS_MIN_RANK}
+    if quoted:
+        values["quoted_bits"] = quoted.to_bytes()
+    # plainto_tsquery ANDs the words; a conversational message should match on any of them
+    return await database.fetch_one(f"""
+        WITH q AS (
+            SELECT CAST(replace(CAST(plainto_tsquery('{config}', :text) AS TEXT), '&', '|') AS tsquery) AS query
+        )
+        SELECT k.id, k.content, k.tags, k.book, k.chapter, ts_rank(k.search_vector, q.query) AS rank
+        FROM {table_name} k, q
+        WHERE q.query <> CAST('' AS tsquery) AND k.search_vector @@ q.query {exclude_sql}
+          AND ts_rank(k.search_vector, q.query) >= :min_rank
+        ORDER BY rank DESC
+        LIMIT 1
+    """, values)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+In-process inverted index over the eldric_knowledge* tables.
+
+All chunks are loaded at startup into memory (id -> chunk, and tag -> chunk ids per
+language), so picking knowledge for a conversation turn needs no database round trip.
+Every KNOWLEDGE_REFRESH_SECONDS only rows with a newer updated_at are fetched again; a
+change in the row count (deleted chunks) triggers a full reload of that language.
+"""
+import os
+import random
+import asyncio
+
+from knowledge_tags import KNOWLEDGE_TABLES, split_tags
+
+KNOWLEDGE_INDEX_ENABLED = os.getenv("KNOWLEDGE_INDEX_ENABLED", "true").lower() == "true"
+KNOWLEDGE_REFRESH_SECONDS = float(os.getenv("KNOWLEDGE_REFRESH_SECONDS", "300"))
+
+class KnowledgeIndex:
+    def __init__(self, refresh_seconds=KNOWLEDGE_REFRESH_SECONDS, enabled=KNOWLEDGE_INDEX_ENABLED):
+        self.refresh_seconds = refresh_seconds
+        self.enabled = enabled
+        self.database = None
+        self.task = None
+        self.chunks = {}  # language -> {id: chunk dict}
+        self.postings = {}  # language -> {tag: set of ids}
+        self.synced_until = {}  # language -> newest updated_at loaded
+        self.listeners = []  # async callbacks (language, chunks) run after a language changed
+        self.refreshes = 0
+        self.lookups = 0
+
+    def loaded(self, language):
+        return self.enabled and language in self.chunks
+
+    def on_change(self, callback):
+        self.listeners.append(callback)
+
+    async def _notify(self, language):
+        for callback in self.listeners:
+            try:
+                await callback(language, self.chunks[language])
+            except Exception as e:
+                print(f"[DEBUG] Knowledge index listener failed for {language}: {e}")
+
+    async def start(self, database):
+        """Load every table, then keep refreshing in the background"""
+        if not self.enabled or database is None:
+            return
+        self.database = database
+        for language in KNOWLEDGE_TABLES:
+            try:
+                await self.load(language)
+            except Exception as e:
+                print(f"[DEBUG] Error loading knowledge index for {language}: {e}")
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            for language in KNOWLEDGE_TABLES:
+                try:
+                    await self.refresh(language)
+                except Exception as e:
+                    print(f"[DEBUG] Error refreshing knowledge index for {language}: {e}")
+
+    async def load(self, language):
+        """Full (re)load of one language"""
+        rows = await self.database.fetch_all(
+            f"SELECT id, content, tags, book, chapter, updated_at FROM {KNOWLEDGE_TABLES[language]}"
+        )
+        self.chunks[language] = {}
+        self.postings[language] = {}
+        self.synced_until[language] = None
+        self._apply(language, rows)
+        print(f"[DEBUG] Knowledge index: {len(rows)} chunks loaded for {language}")
+        await self._notify(language)
+
+    async def refresh(self, language):
+        """Fetch only new or changed rows; reload when chunks were deleted"""
+        if language not in self.chunks:
+            await self.load(language)
+            return
+        table_name = KNOWLEDGE_TABLES[language]
+        count = await self.database.fetch_val(f"SELECT COUNT(*) FROM {table_name}")
+        since = self.synced_until.get(language)
+        if since is None:
+            rows = await self.database.fetch_all(
+                f"SELECT id, content, tags, book, chapter, updated_at FROM {table_name}"
+            )
+        else:
+            rows = await self.database.fetch_all(
+                f"SELECT id, content, tags, book, chapter, updated_at FROM {table_name} WHERE updated_at > :since",
+                {"since": since}
+            )
+        self._apply(language, rows)
+        self.refreshes += 1
+        if count != len(self.chunks[language]):
+            await self.load(language)
+        elif rows:
+            print(f"[DEBUG] Knowledge index: {len(rows)} new or changed chunks for {language}")
+            await self._notify(language)
+
+    def _apply(self, language, rows):
+        chunks = self.chunks[language]
+        postings = self.postings[language]
+        for row in rows:
+            chunk_id = row["id"]
+            old = chunks.get(chunk_id)
+            if old is not None:
+                for tag in old["tag_list"]:
+                    ids = postings.get(tag)
+                    if ids is not None:
+                        ids.discard(chunk_id)
+                        if not ids:
+                            del postings[tag]
+            chunk = {
+                "id": chunk_id,
+                "content": row["content"],
+                "tags": row["tags"],
+                "book": row["book"],
+                "chapter": row["chapter"],
+                "tag_list": split_tags(row["tags"]),
+            }
+            chunks[chunk_id] = chunk
+            for tag in chunk["tag_list"]:
+                postings.setdefault(tag, set()).add(chunk_id)
+            updated_at = row["updated_at"]
+            if updated_at is not None and (self.synced_until[language] is None or updated_at > self.synced_until[language]):
+                self.synced_until[language] = updated_at
+
+    def candidates(self, language, tags):
+        """Ids of the chunks carrying any of tags"""
+        postings = self.postings.get(language, {})
+        ids = set()
+        for tag in tags or []:
+            ids |= postings.get(tag.lower(), set())
+        return ids
+
+    def pick(self, language, tags, quoted=None):
+        """A random chunk carrying any of tags and not in the quoted ChunkBitmap, or None"""
+        self.lookups += 1
+        ids = self.candidates(language, tags)
+        if quoted:
+            ids = {chunk_id for chunk_id in ids if chunk_id not in quoted}
+        if not ids:
+            return None
+        return self.chunks[language][random.choice(tuple(ids))]
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "chunks": {language: len(chunks) for language, chunks in self.chunks.items()},
+            "tags": {language: len(postings) for language, postings in self.postings.items()},
+            "refreshes": self.refreshes,
+            "lookups": self.lookups,
+        }
+
+knowledge_index = KnowledgeIndex()
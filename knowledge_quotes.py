@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Durable per-user record of the knowledge chunks already quoted.
+
+Each (user, knowledge table) pair is one bitset over chunk ids, stored as BYTEA in
+knowledge_quoted with the same bit layout as Postgres get_bit() (bit n is bit n % 8 of
+byte n // 8). Its size depends on the largest chunk id, not on how many quotes the user
+has seen. Bitmaps are loaded lazily into a bounded LRU; a new quote sets its bit in the
+stored row with set_bit() (never by writing the cached copy back, which could drop bits
+set by other workers) and refreshes the cached copy from the result. Other workers pick
+up new quotes once their cached copy is older than QUOTED_CACHE_TTL_SECONDS. SQL queries
+filter with get_bit() on the bitmap parameter instead of an ever-growing NOT IN list.
+Guests all share the "invitado" id, so nothing is recorded for them.
+"""
+import os
+import time
+from collections import OrderedDict
+
+QUOTED_CACHE_MAX_USERS = int(os.getenv("QUOTED_CACHE_MAX_USERS", "5000"))
+QUOTED_CACHE_TTL_SECONDS = float(os.getenv("QUOTED_CACHE_TTL_SECONDS", "300"))
+
+class ChunkBitmap:
+    """Set of chunk ids backed by a bytearray"""
+
+    def __init__(self, bits=b""):
+        self.bits = bytearray(bits or b"")
+
+    def __contains__(self, chunk_id):
+        byte = chunk_id >> 3
+        return 0 <= byte < len(self.bits) and bool(self.bits[byte] & (1 << (chunk_id & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count("1") for byte in self.bits)
+
+    def __bool__(self):
+        return any(self.bits)
+
+    def add(self, chunk_id):
+        byte = chunk_id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(b"\x00" * (byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (chunk_id & 7)
+
+    def clear(self):
+        self.bits = bytearray()
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+def sql_unquoted(column):
+    """
+    SQL condition keeping rows whose `column` is not set in the :quoted_bits parameter.
+    CASE makes sure get_bit() is never evaluated past the end of the bitmap; the casts keep
+    Postgres from resolving the untyped parameter as text.
+    """
+    bits = "CAST(:quoted_bits AS BYTEA)"
+    return f"(CASE WHEN {column} < length({bits}) * 8 THEN get_bit({bits}, {column}) = 0 ELSE TRUE END)"
+
+class QuotedChunks:
+    def __init__(self, max_users=QUOTED_CACHE_MAX_USERS, ttl_seconds=QUOTED_CACHE_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.bitmaps = OrderedDict()  # (user_id, table) -> (ChunkBitmap, loaded_at monotonic)
+        self.loads = 0
+        self.writes = 0
+
+    async def get(self, database, user_id, table_name):
+        """The user's bitmap for a knowledge table (empty for anonymous users and guests)"""
+        if not user_id or user_id == "invitado":
+            return ChunkBitmap()
+        key = (user_id, table_name)
+        entry = self.bitmaps.get(key)
+        if entry is not None and entry[1] + self.ttl_seconds > time.monotonic():
+            bitmap = entry[0]
+        else:
+            bits = None
+            if database is not None and database.is_connected:
+                try:
+                    bits = await database.fetch_val(
+                        "SELECT bits FROM knowledge_quoted WHERE user_id = :user_id AND knowledge_table = :table",
+                        {"user_id": key[0], "table": key[1]}
+                    )
+                    self.loads += 1
+                except Exception as e:
+                    print(f"[DEBUG] Error loading quoted chunks for {user_id}: {e}")
+            bitmap = ChunkBitmap(bits)
+            self._cache(key, bitmap)
+        self.bitmaps.move_to_end(key)
+        return bitmap
+
+    def _cache(self, key, bitmap):
+        self.bitmaps[key] = (bitmap, time.monotonic())
+        self.bitmaps.move_to_end(key)
+        while len(self.bitmaps) > self.max_users:
+            self.bitmaps.popitem(last=False)
+
+    async def add(self, database, user_id, table_name, chunk_id):
+        if not user_id or user_id == "invitado":
+            return
+        bitmap = await self.get(database, user_id, table_name)
+        bitmap.add(chunk_id)
+        if database is None or not database.is_connected:
+            return
+        # Set the bit in the stored bitmap (zero-padded first when it is too short), so
+        # concurrent quotes from other workers are kept; the result refreshes the cached copy
+        single = ChunkBitmap()
+        single.add(chunk_id)
+        try:
+            bits = await database.fetch_val("""
+                INSERT INTO knowledge_quoted (user_id, knowledge_table, bits, updated_at)
+                VALUES (:user_id, :table, :bits, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, knowledge_table) DO UPDATE SET
+                    bits = set_bit(
+                        CASE WHEN length(knowledge_quoted.bits) > :byte THEN knowledge_quoted.bits
+                             ELSE knowledge_quoted.bits || decode(repeat('00', :byte + 1 - length(knowledge_quoted.bits)), 'hex')
+                        END,
+                        :chunk_id, 1),
+                    updated_at = EXCLUDED.updated_at
+                RETURNING bits
+            """, {"user_id": user_id, "table": table_name, "bits": single.to_bytes(),
+                  "byte": chunk_id >> 3, "chunk_id": chunk_id})
+            self.writes += 1
+            if bits is not None:
+                self._cache((user_id, table_name), ChunkBitmap(bits))
+        except Exception as e:
+            print(f"[DEBUG] Error saving quoted chunks for {user_id}: {e}")
+
+    async def reset(self, database, user_id, table_name):
+        """Forget every quote of the table (all matching chunks were quoted)"""
+        if not user_id or user_id == "invitado":
+            return
+        self._cache((user_id, table_name), ChunkBitmap())
+        if database is None or not database.is_connected:
+            return
+        try:
+            await database.execute("""
+                UPDATE knowledge_quoted SET bits = CAST('' AS BYTEA), updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = :user_id AND knowledge_table = :table
+            """, {"user_id": user_id, "table": table_name})
+            self.writes += 1
+        except Exception as e:
+            print(f"[DEBUG] Error saving quoted chunks for {user_id}: {e}")
+
+    def stats(self):
+        return {
+            "cached_users": len(self.bitmaps),
+            "cached_bytes": sum(len(bitmap.bits) for bitmap, _ in self.bitmaps.values()),
+            "loads": self.loads,
+            "writes": self.writes,
+        }
+
+quoted_chunks = QuotedChunks()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Per-(user, category) rotation through the knowledge chunks of a tag.
+
+Instead of a random pick per turn, every user walks each category's chunks in a shuffled
+order that is derived from (user, table, category, epoch): position i of the rotation is
+the category's sorted id at permute(i), a keyed Feistel permutation of [0, n) (cycle
+walking over the next power of four), so the order is never materialized. Only the epoch
+and a cursor are stored (knowledge_rotation), so the next chunk is an O(1) lookup, no
+chunk repeats until the category is exhausted, and exhausting it simply starts the next
+epoch with a new order. A change in the category's size also starts a new epoch. Chunks
+already quoted elsewhere are skipped in memory and the resulting position is claimed with
+one compare-and-set UPDATE of the stored cursor, so all workers share one rotation per
+user; the in-process states are only a cache of the stored rows.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+
+from knowledge_tags import knowledge_table
+from knowledge_index import knowledge_index
+
+ROTATION_CACHE_MAX_ENTRIES = int(os.getenv("ROTATION_CACHE_MAX_ENTRIES", "20000"))
+
+FEISTEL_ROUNDS = 4
+
+def rotation_key(user_id, table_name, category, epoch):
+    return hashlib.sha256(f"{user_id}:{table_name}:{category}:{epoch}".encode("utf-8")).digest()[:16]
+
+def permute(index, n, key):
+    """Position of index in the keyed shuffle of [0, n): a bijection, computed without storing it"""
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    x = index
+    while True:
+        left, right = x >> half, x & mask
+        for round_number in range(FEISTEL_ROUNDS):
+            digest = hashlib.blake2b(f"{round_number}:{right}".encode(), key=key, digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+        x = (left << half) | right
+        # Cycle walking: values outside [0, n) are permuted again until they land inside
+        if x < n:
+            return x
+
+class RotationState:
+    __slots__ = ("epoch", "cursor", "size", "key")
+
+    def __init__(self, epoch=0, cursor=0, size=0):
+        self.epoch = epoch
+        self.cursor = cursor
+        self.size = size
+        self.key = None
+
+class KnowledgeRotation:
+    def __init__(self, index, max_entries=ROTATION_CACHE_MAX_ENTRIES):
+        self.index = index  # KnowledgeIndex providing chunks and tag postings
+        self.max_entries = max_entries
+        self.states = OrderedDict()  # (user_id, table, category) -> RotationState
+        self.ordered = {}  # (language, category) -> sorted chunk ids, rebuilt when the index changes
+        self.picks = 0
+        self.skips = 0
+        self.epochs = 0
+        self.resyncs = 0
+
+    async def invalidate(self, language, chunks=None):
+        """Index listener: drop the cached id lists of a changed language"""
+        for key in [key for key in self.ordered if key[0] == language]:
+            del self.ordered[key]
+
+    def category_ids(self, language, category):
+        key = (language, category)
+        ids = self.ordered.get(key)
+        if ids is None:
+            ids = sorted(self.index.postings.get(language, {}).get(category, ()))
+            self.ordered[key] = ids
+        return ids
+
+    async def _load(self, database, user_id, table_name, category):
+        """Stored RotationState of the category, or None when there is none (or no database)"""
+        if database is None or not database.is_connected:
+            return None
+        try:
+            row = await database.fetch_one("""
+                SELECT epoch, cursor, size FROM knowledge_rotation
+                WHERE user_id = :user_id AND knowledge_table = :table AND category = :category
+            """, {"user_id": user_id, "table": table_name, "category": category})
+            return RotationState(row["epoch"], row["cursor"], row["size"]) if row else None
+        except Exception as e:
+            print(f"[DEBUG] Error loading knowledge rotation for {user_id}: {e}")
+            return None
+
+    async def _state(self, database, user_id, table_name, category):
+        key = (user_id, table_name, category)
+        state = self.states.get(key)
+        if state is None:
+            state = await self._load(database, user_id, table_name, category) or RotationState()
+            self.states[key] = state
+            while len(self.states) > self.max_entries:
+                self.states.popitem(last=False)
+        self.states.move_to_end(key)
+        return state
+
+    def _adopt(self, state, stored):
+        """Take over the stored row written by another worker"""
+        if stored.epoch != state.epoch:
+            state.key = None
+        state.epoch, state.cursor, state.size = stored.epoch, stored.cursor, stored.size
+        self.resyncs += 1
+
+    async def _start_epoch(self, database, user_id, table_name, category, state, size):
+        """
+        Start epoch state.epoch + 1 over `size` chunks. The row is only replaced while it is
+        still on an older epoch, so when another worker got there first its epoch is adopted
+        instead of being reset a second time.
+        """
+        epoch = state.epoch + 1
+        if database is not None and database.is_connected:
+            try:
+                started = await database.fetch_val("""
+                    INSERT INTO knowledge_rotation (user_id, knowledge_table, category, epoch, cursor, size, updated_at)
+                    VALUES (:user_id, :table, :category, :epoch, 0, :size, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id, knowledge_table, category) DO UPDATE SET
+                        epoch = EXCLUDED.epoch, cursor = 0, size = EXCLUDED.size, updated_at = EXCLUDED.updated_at
+                    WHERE knowledge_rotation.epoch < EXCLUDED.epoch
+                    RETURNING epoch
+                """, {"user_id": user_id, "table": table_name, "category": category, "epoch": epoch, "size": size})
+                if started is None:
+                    stored = await self._load(database, user_id, table_name, category)
+                    if stored is not None:
+                        self._adopt(state, stored)
+                        return
+            except Exception as e:
+                print(f"[DEBUG] Error saving knowledge rotation for {user_id}: {e}")
+        state.epoch, state.cursor, state.size, state.key = epoch, 0, size, None
+        self.epochs += 1
+
+    def _scan(self, user_id, table_name, category, state, ids, quoted):
+        """
+        (chunk id, cursor after it) of the first position from state.cursor whose chunk is not
+        set in quoted, or (None, None) when the rest of the epoch is quoted or exhausted.
+        Skipping happens in memory; nothing is written.
+        """
+        # An epoch adopted from a worker with a different index does not fit these ids
+        if state.size != len(ids):
+            return None, None
+        if state.key is None:
+            state.key = rotation_key(user_id, table_name, category, state.epoch)
+        cursor = state.cursor
+        while cursor < state.size:
+            chunk_id = ids[permute(cursor, state.size, state.key)]
+            cursor += 1
+            if quoted is None or chunk_id not in quoted:
+                return chunk_id, cursor
+            self.skips += 1
+        return None, None
+
+    async def _advance(self, database, user_id, table_name, category, state, ids, quoted):
+        """
+        Next chunk id of the current epoch not set in quoted, or None when there is none.
+        The position (and every quoted one skipped before it) is claimed with one
+        compare-and-set UPDATE of the stored cursor, so concurrent workers never hand out
+        the same position or move another worker's cursor back. A failed claim means the
+        stored row moved on, so it is reloaded and the scan repeated until a claim succeeds
+        or the epoch runs out.
+        """
+        while True:
+            chunk_id, cursor = self._scan(user_id, table_name, category, state, ids, quoted)
+            if chunk_id is None:
+                return None
+            if database is None or not database.is_connected:
+                state.cursor = cursor
+                return chunk_id
+            try:
+                claimed = await database.fetch_val("""
+                    UPDATE knowledge_rotation SET cursor = :next, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = :user_id AND knowledge_table = :table AND category = :category
+                      AND epoch = :epoch AND cursor = :cursor
+                    RETURNING cursor
+                """, {"user_id": user_id, "table": table_name, "category": category,
+                      "epoch": state.epoch, "cursor": state.cursor, "next": cursor})
+            except Exception as e:
+                print(f"[DEBUG] Error advancing knowledge rotation for {user_id}: {e}")
+                return None
+            if claimed is not None:
+                state.cursor = cursor
+                return chunk_id
+            stored = await self._load(database, user_id, table_name, category)
+            if stored is None or (stored.epoch, stored.cursor) == (state.epoch, state.cursor):
+                return None
+            self._adopt(state, stored)
+
+    async def next_chunk(self, database, user_id, language, categories, quoted=None):
+        """
+        Chunk dict of the next unseen chunk in the first of `categories` that still has
+        one (skipping chunks already quoted elsewhere); when all are exhausted, the first
+        category starts a new epoch. None when no category has chunks.
+        """
+        table_name = knowledge_table(language)
+        rotations = []
+        for category in categories or []:
+            ids = self.category_ids(language, category)
+            if not ids:
+                continue
+            state = await self._state(database, user_id, table_name, category)
+            if state.size != len(ids):
+                await self._start_epoch(database, user_id, table_name, category, state, len(ids))
+            rotations.append((category, ids, state))
+
+            chunk_id = await self._advance(database, user_id, table_name, category, state, ids, quoted)
+            if chunk_id is not None:
+                self.picks += 1
+                return self.index.chunks[language].get(chunk_id)
+
+        if not rotations:
+            return None
+        category, ids, state = rotations[0]
+        await self._start_epoch(database, user_id, table_name, category, state, len(ids))
+        chunk_id = await self._advance(database, user_id, table_name, category, state, ids, None)
+        if chunk_id is None:
+            return None
+        self.picks += 1
+        return self.index.chunks[language].get(chunk_id)
+
+    def stats(self):
+        return {
+            "cached_states": len(self.states),
+            "cached_categories": len(self.ordered),
+            "picks": self.picks,
+            "skips": self.skips,
+            "epochs": self.epochs,
+            "resyncs": self.resyncs,
+        }
+
+knowledge_rotation = KnowledgeRotation(knowledge_index)
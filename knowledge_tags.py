@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Normalized tag index for the eldric_knowledge* tables.
+
+The comma-separated `tags` column of every knowledge table is split into knowledge_tags
+(one row per table, tag and chunk), indexed on (knowledge_table, tag, rand_key). Each
+row carries a random key drawn once, so picking a random chunk for a tag is an index
+seek to the first key >= random() (wrapping around to the smallest key) instead of a
+full scan with ORDER BY RANDOM().
+"""
+import random
+
+from knowledge_quotes import sql_unquoted
+
+# Language -> knowledge table (English lives in the original table)
+KNOWLEDGE_TABLES = {
+    "es": "eldric_knowledge_es",
+    "en": "eldric_knowledge",
+    "ru": "eldric_knowledge_ru",
+}
+
+def knowledge_table(language: str) -> str:
+    return KNOWLEDGE_TABLES.get(language, KNOWLEDGE_TABLES["es"])
+
+def split_tags(tags) -> list:
+    """Normalized, de-duplicated tags from a comma-separated tags value"""
+    result = []
+    for tag in (tags or "").split(","):
+        tag = " ".join(tag.lower().split())
+        if tag and tag not in result:
+            result.append(tag)
+    return result
+
+async def create_knowledge_tags_table(database):
+    await database.execute("""
+        CREATE TABLE IF NOT EXISTS knowledge_tags (
+            knowledge_table TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            chunk_id INTEGER NOT NULL,
+            rand_key DOUBLE PRECISION NOT NULL DEFAULT random(),
+            PRIMARY KEY (knowledge_table, tag, chunk_id)
+        )
+    """)
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_tags_pick ON knowledge_tags (knowledge_table, tag, rand_key)
+    """)
+
+async def sync_knowledge_tags(database, table_name):
+    """
+    Split the tags column of table_name into knowledge_tags: adds tags of new or
+    re-tagged chunks and drops those of deleted or re-tagged ones. Set-based and
+    idempotent, so it is safe to run on every startup. Returns the number of tags added.
+    """
+    async with database.transaction():
+        await database.execute(f"""
+            DELETE FROM knowledge_tags t
+            WHERE t.knowledge_table = :table
+              AND NOT EXISTS (
+                  SELECT 1 FROM {table_name} k, unnest(string_to_array(k.tags, ',')) AS raw(tag)
+                  WHERE k.id = t.chunk_id
+                    AND lower(regexp_replace(btrim(raw.tag), '\\s+', ' ', 'g')) = t.tag
+              )
+        """, {"table": table_name})
+        rows = await database.fetch_all(f"""
+            INSERT INTO knowledge_tags (knowledge_table, tag, chunk_id)
+            SELECT DISTINCT :table, lower(regexp_replace(btrim(raw.tag), '\\s+', ' ', 'g')), k.id
+            FROM {table_name} k, unnest(string_to_array(k.tags, ',')) AS raw(tag)
+            WHERE btrim(raw.tag) <> ''
+            ON CONFLICT DO NOTHING
+            RETURNING chunk_id
+        """, {"table": table_name})
+    return len(rows)
+
+async def migrate_knowledge_tags(database):
+    """Create knowledge_tags and fill it from every knowledge table"""
+    await create_knowledge_tags_table(database)
+    for table_name in KNOWLEDGE_TABLES.values():
+        try:
+            added = await sync_knowledge_tags(database, table_name)
+            print(f"[DEBUG] knowledge_tags: {added} tags added from {table_name}")
+        except Exception as e:
+            print(f"[DEBUG] Error syncing knowledge_tags for {table_name}: {e}")
+
+async def pick_tagged_chunk(database, language, tags, quoted=None):
+    """
+    One random chunk of the language's table carrying any of `tags`, skipping the
+    chunks set in the `quoted` ChunkBitmap, or None. Each tag costs one index seek (LATERAL ... LIMIT 1) from a
+    random point of its rand_key range; the second query wraps around to the start.
+    """
+    if not tags:
+        return None
+    table_name = knowledge_table(language)
+    exclude_sql = "AND " + sql_unquoted("t.chunk_id") if quoted else ""
+    values = {
+        "table": table_name,
+        "tags": [tag.lower() for tag in tags],
+        "start": random.random(),
+    }
+    if quoted:
+        values["quoted_bits"] = quoted.to_bytes()
+    for op in (">=", "<"):
+        row = await database.fetch_one(f"""
+            SELECT k.id, k.content, k.tags, k.book, k.chapter
+            FROM unnest(CAST(:tags AS TEXT[])) AS wanted(tag)
+            CROSS JOIN LATERAL (
+                SELECT t.chunk_id, t.rand_key FROM knowledge_tags t
+                WHERE t.knowledge_table = :table AND t.tag = wanted.tag AND t.rand_key {op} :start {exclude_sql}
+                ORDER BY t.rand_key
+                LIMIT 1
+            ) picked
+            JOIN {table_name} k ON k.id = picked.chunk_id
+            ORDER BY picked.rand_key
+            LIMIT 1
+        """, values)
+        if row:
+            return row
+    return None
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Semantic retrieval over the knowledge chunks with locally computed vectors.
+
+For every language the chunks loaded by knowledge_index are turned into TF-IDF vectors
+over light-stemmed words (optionally reduced with LSA to KNOWLEDGE_LSA_DIMS dimensions),
+stored as one contiguous, L2-normalized float32 matrix. With KNOWLEDGE_VECTORS_DIR set,
+the matrix is written there once per corpus version and memory-mapped, so workers share
+it through the page cache and restarts skip the rebuild.
+
+A query is vectorized the same way and scored against every chunk with one matrix
+product; chunks tagged with the user's attachment style get a small boost. Everything
+is optional: without numpy, search() returns nothing and callers fall back to tags.
+"""
+import os
+import re
+import glob
+import json
+import math
+import asyncio
+import hashlib
+import unicodedata
+
+from keyword_matcher import stem_word
+
+_numpy_available = False
+try:
+    import numpy as np  # type: ignore
+    _numpy_available = True
+except Exception as e:
+    print(f"[DEBUG] numpy not available ({e}), semantic knowledge retrieval disabled")
+    np = None
+
+KNOWLEDGE_VECTORS_ENABLED = os.getenv("KNOWLEDGE_VECTORS_ENABLED", "true").lower() == "true"
+KNOWLEDGE_VECTORS_DIR = os.getenv("KNOWLEDGE_VECTORS_DIR")
+KNOWLEDGE_LSA_DIMS = int(os.getenv("KNOWLEDGE_LSA_DIMS", "0"))  # 0 = plain TF-IDF
+KNOWLEDGE_MIN_SIMILARITY = float(os.getenv("KNOWLEDGE_MIN_SIMILARITY", "0.12"))
+KNOWLEDGE_STYLE_BOOST = float(os.getenv("KNOWLEDGE_STYLE_BOOST", "0.25"))
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", "5"))
+# Vocabulary bound (most frequent terms), which bounds the matrix size for plain TF-IDF
+KNOWLEDGE_MAX_TERMS = int(os.getenv("KNOWLEDGE_MAX_TERMS", "5000"))
+
+# Words lose one inflectional ending (keyword_matcher's rules) and are then kept to this many
+# characters, so "celos"/"celoso"/"celosa" or "contesta"/"contestar" match
+STEM_LENGTH = 6
+
+STOPWORDS = {
+    "es": set("""a al algo ante como con contra cual cuando de del desde donde el ella ellas ellos en entre era es esa
+        ese eso esta estan este esto fue ha hay la las le les lo los mas me mi mis muy nada ni no nos o para pero
+        por que se si sin sobre su sus te tengo ti tu tus un una uno unos y ya yo""".split()),
+    "en": set("""a about after all am an and any are as at be been but by can did do does for from had has have he her
+        him his how i if in into is it its just me my no not of on or our she so than that the their them then
+        there they this to was we were what when which who why will with you your""".split()),
+    "ru": set("""а без был была были было в вам вас во вот все всё вы где да для до его ее её если есть ещё же за и из
+        или им их к как ко когда кто ли мне мы на над не нет ни но ну о об он она они от по под при с со так там
+        то тоже только ты у уже чем что чтобы это я""".split()),
+}
+
+_WORD_RE = re.compile(r"\w+")
+
+def _fold(text):
+    """Lowercase and strip accents"""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+def tokenize(text, language="es"):
+    """Folded, stemmed words without stopwords or very short tokens"""
+    stopwords = STOPWORDS.get(language, STOPWORDS["es"])
+    terms = []
+    for word in _WORD_RE.findall(_fold(text)):
+        if len(word) < 3 or word.isdigit() or word in stopwords:
+            continue
+        terms.append(stem_word(word, language)[:STEM_LENGTH])
+    return terms
+
+class LanguageVectors:
+    """Vectors of one language: ids[i] is the chunk id of matrix row i"""
+
+    def __init__(self, ids, vocabulary, idf, matrix, projection, styles):
+        self.ids = ids
+        self.vocabulary = vocabulary  # term -> column
+        self.idf = idf
+        self.matrix = matrix  # (chunks, dims) float32, rows L2-normalized
+        self.projection = projection  # (terms, dims) for LSA, None for plain TF-IDF
+        self.styles = styles  # attachment style -> bool mask over rows
+
+    def scores(self, terms):
+        """Cosine similarity of every chunk to the query terms, or None when no term is known"""
+        counts = {}
+        for term in terms:
+            column = self.vocabulary.get(term)
+            if column is not None:
+                counts[column] = counts.get(column, 0) + 1
+        if not counts:
+            return None
+        columns = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.array([(1 + math.log(count)) for count in counts.values()], dtype=np.float32) * self.idf[columns]
+        if self.projection is None:
+            # Only the query's columns are read: cost grows with chunks x query terms
+            return (self.matrix[:, columns] @ weights) / np.linalg.norm(weights)
+        query = weights @ self.projection[columns]
+        norm = np.linalg.norm(query)
+        return self.matrix @ (query / norm) if norm else None
+
+class KnowledgeVectors:
+    def __init__(self, enabled=KNOWLEDGE_VECTORS_ENABLED and _numpy_available, lsa_dims=KNOWLEDGE_LSA_DIMS,
+                 vectors_dir=KNOWLEDGE_VECTORS_DIR):
+        self.enabled = enabled
+        self.lsa_dims = lsa_dims
+        self.vectors_dir = vectors_dir
+        self.languages = {}  # language -> LanguageVectors
+        self.builds = 0
+        self.searches = 0
+        self.hits = 0
+
+    def ready(self, language):
+        return self.enabled and language in self.languages
+
+    async def rebuild(self, language, chunks):
+        """Recompute the vectors of a language from its {id: chunk} map, off the event loop"""
+        if not self.enabled:
+            return
+        snapshot = [(chunk_id, chunk["content"], chunk.get("tag_list") or []) for chunk_id, chunk in chunks.items()]
+        try:
+            vectors = await asyncio.to_thread(self._build, language, snapshot)
+        except Exception as e:
+            print(f"[DEBUG] Error building knowledge vectors for {language}: {e}")
+            return
+        if vectors is None:
+            self.languages.pop(language, None)
+        else:
+            self.languages[language] = vectors
+            self.builds += 1
+            print(f"[DEBUG] Knowledge vectors for {language}: {vectors.matrix.shape[0]} chunks x {vectors.matrix.shape[1]} dims")
+
+    def _build(self, language, snapshot):
+        snapshot.sort(key=lambda item: item[0])
+        if not snapshot:
+            return None
+        documents = [tokenize(content, language) for _, content, _ in snapshot]
+        frequency = {}
+        for terms in documents:
+            for term in set(terms):
+                frequency[term] = frequency.get(term, 0) + 1
+        if not frequency:
+            return None
+        kept = sorted(frequency, key=lambda term: (-frequency[term], term))[:KNOWLEDGE_MAX_TERMS]
+        vocabulary = {term: column for column, term in enumerate(sorted(kept))}
+
+        ids = np.array([chunk_id for chunk_id, _, _ in snapshot], dtype=np.int64)
+        styles = {}
+        for row, (_, _, tags) in enumerate(snapshot):
+            for tag in tags:
+                styles.setdefault(tag, np.zeros(len(snapshot), dtype=bool))[row] = True
+
+        # The vocabulary is part of the key, so a tokenizer change never reuses stale columns
+        fingerprint = hashlib.sha256(json.dumps(
+            [language, self.lsa_dims, sorted(vocabulary), [(chunk_id, content) for chunk_id, content, _ in snapshot]],
+            ensure_ascii=False
+        ).encode("utf-8")).hexdigest()[:16]
+        cached = self._load_cached(language, fingerprint)
+        if cached is not None:
+            idf, matrix, projection = cached
+            return LanguageVectors(ids, vocabulary, idf, matrix, projection, styles)
+
+        document_frequency = np.zeros(len(vocabulary), dtype=np.float32)
+        tfidf = np.zeros((len(snapshot), len(vocabulary)), dtype=np.float32)
+        for row, terms in enumerate(documents):
+            counts = {}
+            for term in terms:
+                if term in vocabulary:
+                    counts[vocabulary[term]] = counts.get(vocabulary[term], 0) + 1
+            for column, count in counts.items():
+                tfidf[row, column] = 1 + math.log(count)
+                document_frequency[column] += 1
+        idf = (np.log((1 + len(snapshot)) / (1 + document_frequency)) + 1).astype(np.float32)
+        tfidf *= idf
+
+        projection = None
+        matrix = tfidf
+        if self.lsa_dims and self.lsa_dims < min(tfidf.shape):
+            # Truncated SVD: terms that co-occur end up close even when a query uses only one of them
+            _, _, vt = np.linalg.svd(tfidf, full_matrices=False)
+            projection = np.ascontiguousarray(vt[:self.lsa_dims].T, dtype=np.float32)
+            matrix = tfidf @ projection
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix = np.ascontiguousarray(matrix / norms, dtype=np.float32)
+        matrix = self._store(language, fingerprint, idf, matrix, projection)
+        return LanguageVectors(ids, vocabulary, idf, matrix, projection, styles)
+
+    def _paths(self, language, fingerprint):
+        base = os.path.join(self.vectors_dir, f"knowledge_{language}_{fingerprint}")
+        return base + ".npy", base + ".idf.npy", base + ".lsa.npy"
+
+    def _load_cached(self, language, fingerprint):
+        if not self.vectors_dir:
+            return None
+        matrix_path, idf_path, projection_path = self._paths(language, fingerprint)
+        if not (os.path.exists(matrix_path) and os.path.exists(idf_path)):
+            return None
+        try:
+            projection = np.load(projection_path) if self.lsa_dims and os.path.exists(projection_path) else None
+            return np.load(idf_path), np.load(matrix_path, mmap_mode="r"), projection
+        except Exception as e:
+            print(f"[DEBUG] Could not load cached knowledge vectors ({e}), rebuilding")
+            return None
+
+    @staticmethod
+    def _save_atomic(path, array):
+        """Write to a private temporary file and rename it into place, so readers never see a partial file"""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                np.save(f, array)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _remove_stale(self, language, fingerprint):
+        """Delete the files of other corpus versions of language (mapped copies stay valid until unmapped)"""
+        current = set(self._paths(language, fingerprint))
+        for path in glob.glob(os.path.join(self.vectors_dir, f"knowledge_{language}_*.npy")):
+            if path not in current:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _store(self, language, fingerprint, idf, matrix, projection):
+        """Write the matrix and return it memory-mapped, or unchanged without KNOWLEDGE_VECTORS_DIR"""
+        if not self.vectors_dir:
+            return matrix
+        matrix_path, idf_path, projection_path = self._paths(language, fingerprint)
+        try:
+            os.makedirs(self.vectors_dir, exist_ok=True)
+            # The matrix goes last: _load_cached only trusts a version whose matrix exists
+            self._save_atomic(idf_path, idf)
+            if projection is not None:
+                self._save_atomic(projection_path, projection)
+            self._save_atomic(matrix_path, matrix)
+            self._remove_stale(language, fingerprint)
+            return np.load(matrix_path, mmap_mode="r")
+        except Exception as e:
+            print(f"[DEBUG] Could not store knowledge vectors ({e}), keeping them in memory")
+            return matrix
+
+    def search(self, language, text, k=KNOWLEDGE_TOP_K, attachment_style=None, quoted=None):
+        """
+        Up to k (chunk_id, score) pairs most similar to text, best first, scoring at least
+        KNOWLEDGE_MIN_SIMILARITY and not set in the quoted ChunkBitmap; chunks tagged with
+        attachment_style are boosted.
+        """
+        if not self.ready(language) or not text:
+            return []
+        self.searches += 1
+        vectors = self.languages[language]
+        scores = vectors.scores(tokenize(text, language))
+        if scores is None:
+            return []
+        scores[scores < KNOWLEDGE_MIN_SIMILARITY] = 0
+        if attachment_style in vectors.styles:
+            scores = np.where(vectors.styles[attachment_style], scores * (1 + KNOWLEDGE_STYLE_BOOST), scores)
+        if quoted:
+            bits = np.unpackbits(np.frombuffer(bytes(quoted.bits), dtype=np.uint8), bitorder="little")
+            in_range = vectors.ids < len(bits)
+            excluded = np.zeros(len(scores), dtype=bool)
+            excluded[in_range] = bits[vectors.ids[in_range]].astype(bool)
+            scores[excluded] = 0
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        hits = [(int(vectors.ids[row]), float(scores[row])) for row in top if scores[row] > 0]
+        if hits:
+            self.hits += 1
+        return hits
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "languages": {language: list(vectors.matrix.shape) for language, vectors in self.languages.items()},
+            "lsa_dims": self.lsa_dims,
+            "memory_mapped": bool(self.vectors_dir),
+            "builds": self.builds,
+            "searches": self.searches,
+            "hits": self.hits,
+        }
+
+knowledge_vectors = KnowledgeVectors()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Resilience layer around model calls.
+
+Every call gets a deadline, transient failures (timeouts, connection errors, 429 and 5xx)
+are retried with jittered exponential backoff, slow calls can optionally be hedged with a
+duplicate request once they pass the recent p95 latency, and a circuit breaker fails fast
+while the upstream is degraded.
+"""
+import os
+import time
+import random
+import asyncio
+from collections import deque
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+# Hedging sends a duplicate request (and may bill twice), so it is off unless enabled
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+
+class LLMUnavailableError(Exception):
+    """The model could not answer in time (deadline exceeded, retries exhausted or circuit open)"""
+
+
+def is_retryable(error):
+    """Timeouts, connection errors, rate limits and server errors are worth another try"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        # openai's APIConnectionError/APITimeoutError carry no status code
+        return error.__class__.__name__ in ("APIConnectionError", "APITimeoutError")
+    return status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds=LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open" and not self.probe_in_flight:
+            # Let a single probe through to test the upstream
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"[DEBUG] LLM circuit breaker opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """Free the half-open probe slot of a call that ended without an outcome (e.g. cancelled)"""
+        self.probe_in_flight = False
+
+
+class ResilientCaller:
+    def __init__(self, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES, hedge_enabled=LLM_HEDGE_ENABLED):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_enabled = hedge_enabled
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=200)
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def hedge_delay(self):
+        """Recent p95 latency, or None while there are too few samples"""
+        if not self.hedge_enabled or len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    async def _attempt(self, make_call, timeout, hedge):
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(make_call(), timeout)
+
+        # Hedged call: start a duplicate if the first one is slower than p95, keep the first result
+        deadline = time.monotonic() + timeout
+        first = asyncio.ensure_future(make_call())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(make_call()))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and not task.exception():
+                        return task.result()
+                    tasks.remove(task)
+                    if not tasks:
+                        return task.result()  # re-raises its exception or CancelledError
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, make_call, timeout=None, hedge=True):
+        """
+        Await make_call() (a zero-argument coroutine factory) within the deadline.
+        Raises LLMUnavailableError when the circuit is open, the deadline passes
+        or retries are exhausted; non-retryable errors are re-raised unchanged.
+        """
+        timeout = timeout or self.timeout
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise LLMUnavailableError("circuit breaker open")
+        # allow() only lets a half-open breaker through for the single probe
+        probe = self.breaker.state == "half_open"
+
+        self.calls += 1
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                started = time.monotonic()
+                try:
+                    result = await self._attempt(make_call, remaining, hedge)
+                    self.latencies.append(time.monotonic() - started)
+                    self.breaker.record_success()
+                    return result
+                except Exception as e:
+                    if not is_retryable(e):
+                        self.breaker.record_success()  # the upstream answered, the request was bad
+                        raise
+                    print(f"[DEBUG] LLM call attempt {attempt + 1} failed: {type(e).__name__}: {e}")
+                    if attempt >= self.max_retries:
+                        break
+                    attempt += 1
+                    self.retries += 1
+                    # Full jitter backoff, never sleeping past the deadline
+                    backoff = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+                    await asyncio.sleep(min(backoff, max(0, deadline - time.monotonic())))
+
+            self.failures += 1
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"model call failed after {attempt + 1} attempts")
+        finally:
+            # A cancelled probe (client disconnect, outer wait_for) records no outcome; without
+            # this it would stay in flight forever. Other calls must not touch the probe slot
+            if probe:
+                self.breaker.release_probe()
+
+    def stats(self):
+        delay = self.hedge_delay()
+        return {
+            "breaker_state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "failures": self.failures,
+            "rejected_by_breaker": self.rejected,
+            "hedge_after_seconds": round(delay, 3) if delay else None,
+            "timeout_seconds": self.timeout,
+        }
+
+llm_caller = ResilientCaller()
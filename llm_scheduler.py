@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Admission scheduler for model calls.
+
+At most LLM_MAX_CONCURRENCY completions run at once. Callers beyond that wait in
+priority lanes (premium, then interactive, then background; FIFO within a lane), and
+once LLM_MAX_QUEUE callers are already waiting new ones are rejected right away with
+SchedulerOverloaded, which the API turns into 503 + Retry-After.
+"""
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from collections import deque
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+
+PRIORITY_PREMIUM = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+LANE_NAMES = {PRIORITY_PREMIUM: "premium", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+
+class SchedulerOverloaded(Exception):
+    """The wait queue is over budget; retry_after is a hint in whole seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"model queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionScheduler:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters = []  # heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.service_times = deque(maxlen=100)
+        self.admitted = {lane: 0 for lane in LANE_NAMES.values()}
+        self.rejected = 0
+        self.max_queue_depth_seen = 0
+
+    def queue_depth(self, priority=None):
+        return sum(1 for p, _, f in self.waiters if not f.done() and (priority is None or p == priority))
+
+    def retry_after(self):
+        """Rough time until the current queue drains, from recent call durations"""
+        average = sum(self.service_times) / len(self.service_times) if self.service_times else 5.0
+        rounds = (self.queue_depth() + 1) / max(1, self.max_concurrency)
+        return max(1, math.ceil(rounds * average))
+
+    def check_capacity(self):
+        """Raise SchedulerOverloaded if a new caller would exceed the queue budget"""
+        if self.active >= self.max_concurrency and self.queue_depth() >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerOverloaded(self.retry_after())
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        if self.active < self.max_concurrency and not self.queue_depth():
+            self.active += 1
+        else:
+            self.check_capacity()
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (priority, next(self.seq), future))
+            self.max_queue_depth_seen = max(self.max_queue_depth_seen, self.queue_depth())
+            try:
+                # release() hands its slot over, so active is not touched here
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just before the cancellation
+                    self.release()
+                raise
+        self.admitted[LANE_NAMES.get(priority, "interactive")] += 1
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE):
+        """Hold one model-call slot for the duration of the block"""
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.service_times.append(time.monotonic() - started)
+            self.release()
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": {name: self.queue_depth(priority) for priority, name in LANE_NAMES.items()},
+            "max_queue_depth_seen": self.max_queue_depth_seen,
+            "admitted": dict(self.admitted),
+            "rejected": self.rejected,
+            "retry_after_hint": self.retry_after(),
+        }
+
+llm_scheduler = AdmissionScheduler()
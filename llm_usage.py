@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user token and latency accounting for model calls.
+
+ChatGPT reports every completion (prompt/completion tokens, model, latency, user and
+conversation state) to usage_recorder. Records are buffered in memory and flushed in
+one transaction every USAGE_FLUSH_SECONDS into llm_usage (raw rows, kept for
+USAGE_RAW_RETENTION_DAYS) and llm_usage_daily (rollup per day, user, model and state).
+"""
+import os
+import json
+import asyncio
+import datetime
+from collections import defaultdict
+
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+USAGE_MAX_BUFFER = int(os.getenv("USAGE_MAX_BUFFER", "5000"))
+USAGE_RAW_RETENTION_DAYS = int(os.getenv("USAGE_RAW_RETENTION_DAYS", "30"))
+
+# USD per 1K tokens: [prompt, completion]; override with a JSON object in USAGE_MODEL_PRICES
+DEFAULT_MODEL_PRICES = {
+    "gpt-4-turbo": [0.01, 0.03],
+    "gpt-4o": [0.0025, 0.01],
+    "gpt-4o-mini": [0.00015, 0.0006],
+}
+
+def load_model_prices():
+    prices = dict(DEFAULT_MODEL_PRICES)
+    raw = os.getenv("USAGE_MODEL_PRICES")
+    if raw:
+        try:
+            prices.update(json.loads(raw))
+        except Exception as e:
+            print(f"[DEBUG] Invalid USAGE_MODEL_PRICES ({e}), using default prices")
+    return prices
+
+MODEL_PRICES = load_model_prices()
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Cost in USD; models missing from the price table count as 0"""
+    prompt_price, completion_price = MODEL_PRICES.get(model, [0, 0])
+    # float() as well: SUM() results would otherwise come back as Decimal
+    return float(prompt_tokens or 0) / 1000 * prompt_price + float(completion_tokens or 0) / 1000 * completion_price
+
+class UsageRecorder:
+    def __init__(self, flush_seconds=USAGE_FLUSH_SECONDS, max_buffer=USAGE_MAX_BUFFER):
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.database = None
+        self.buffer = []
+        self.task = None
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+
+    def record(self, model, prompt_tokens, completion_tokens, latency_ms, user_id=None, state=None):
+        """Queue one call for the next flush (cheap, safe to call from the request path)"""
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.recorded += 1
+        self.buffer.append({
+            "user_id": user_id or "unknown",
+            "model": model or "unknown",
+            "state": state or "none",
+            "prompt_tokens": int(prompt_tokens or 0),
+            "completion_tokens": int(completion_tokens or 0),
+            "latency_ms": int(latency_ms or 0),
+            "created_at": datetime.datetime.now(),
+        })
+
+    def start(self, database):
+        self.database = database
+        if self.task is None and database is not None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self):
+        """Write buffered records and add them to the daily rollup"""
+        if not self.buffer or self.database is None or not self.database.is_connected:
+            return
+        rows, self.buffer = self.buffer, []
+
+        rollup = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0})
+        for row in rows:
+            bucket = rollup[(row["created_at"].date(), row["user_id"], row["model"], row["state"])]
+            bucket["calls"] += 1
+            bucket["prompt_tokens"] += row["prompt_tokens"]
+            bucket["completion_tokens"] += row["completion_tokens"]
+            bucket["latency_ms"] += row["latency_ms"]
+
+        try:
+            async with self.database.transaction():
+                await self.database.execute_many("""
+                    INSERT INTO llm_usage (user_id, model, state, prompt_tokens, completion_tokens, latency_ms, created_at)
+                    VALUES (:user_id, :model, :state, :prompt_tokens, :completion_tokens, :latency_ms, :created_at)
+                """, rows)
+                await self.database.execute_many("""
+                    INSERT INTO llm_usage_daily (day, user_id, model, state, calls, prompt_tokens, completion_tokens, latency_ms)
+                    VALUES (:day, :user_id, :model, :state, :calls, :prompt_tokens, :completion_tokens, :latency_ms)
+                    ON CONFLICT (day, user_id, model, state) DO UPDATE SET
+                        calls = llm_usage_daily.calls + EXCLUDED.calls,
+                        prompt_tokens = llm_usage_daily.prompt_tokens + EXCLUDED.prompt_tokens,
+                        completion_tokens = llm_usage_daily.completion_tokens + EXCLUDED.completion_tokens,
+                        latency_ms = llm_usage_daily.latency_ms + EXCLUDED.latency_ms
+                """, [
+                    {"day": day, "user_id": user_id, "model": model, "state": state, **totals}
+                    for (day, user_id, model, state), totals in rollup.items()
+                ])
+            self.flushed += len(rows)
+        except Exception as e:
+            print(f"[DEBUG] Error flushing {len(rows)} usage records: {e}")
+            # Keep them for the next flush, within the buffer bound
+            self.buffer = (rows + self.buffer)[:self.max_buffer]
+
+    async def purge_raw(self):
+        """Drop raw rows older than the retention window; the daily rollup is kept"""
+        if self.database is None or not self.database.is_connected:
+            return
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=USAGE_RAW_RETENTION_DAYS)
+        try:
+            await self.database.execute("DELETE FROM llm_usage WHERE created_at < :cutoff", {"cutoff": cutoff})
+        except Exception as e:
+            print(f"[DEBUG] Error purging raw usage rows: {e}")
+
+    async def report(self, days=7, limit=20):
+        """Top consumers and per-state totals over the last `days` days, from the daily rollup"""
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+        rows = await self.database.fetch_all("""
+            SELECT user_id, model, state, CAST(SUM(calls) AS BIGINT) AS calls,
+                   CAST(SUM(prompt_tokens) AS BIGINT) AS prompt_tokens,
+                   CAST(SUM(completion_tokens) AS BIGINT) AS completion_tokens,
+                   CAST(SUM(latency_ms) AS BIGINT) AS latency_ms
+            FROM llm_usage_daily
+            WHERE day >= :since
+            GROUP BY user_id, model, state
+        """, {"since": since})
+
+        users = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+        states = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "latency_ms": 0})
+        for row in rows:
+            cost = estimate_cost(row["model"], row["prompt_tokens"], row["completion_tokens"])
+            for bucket in (users[row["user_id"]], states[row["state"]]):
+                bucket["calls"] += row["calls"]
+                bucket["prompt_tokens"] += row["prompt_tokens"]
+                bucket["completion_tokens"] += row["completion_tokens"]
+                bucket["cost_usd"] += cost
+            states[row["state"]]["latency_ms"] += row["latency_ms"]
+
+        for bucket in states.values():
+            bucket["avg_prompt_tokens"] = round(bucket["prompt_tokens"] / bucket["calls"]) if bucket["calls"] else 0
+            bucket["avg_latency_ms"] = round(bucket.pop("latency_ms") / bucket["calls"]) if bucket["calls"] else 0
+        for bucket in list(users.values()) + list(states.values()):
+            bucket["cost_usd"] = round(bucket["cost_usd"], 4)
+
+        top_users = sorted(users.items(), key=lambda item: item[1]["cost_usd"], reverse=True)[:limit]
+        return {
+            "since": since.isoformat(),
+            "days": days,
+            "total_cost_usd": round(sum(bucket["cost_usd"] for bucket in states.values()), 4),
+            "top_users": [{"user_id": user_id, **totals} for user_id, totals in top_users],
+            "by_state": dict(sorted(states.items(), key=lambda item: item[1]["cost_usd"], reverse=True)),
+        }
+
+    def stats(self):
+        return {"recorded": self.recorded, "flushed": self.flushed, "buffered": len(self.buffer), "dropped": self.dropped}
+
+usage_recorder = UsageRecorder()
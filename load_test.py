@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load test for /message.
+
+Run the API against fake_openai_server.py (see its docstring) and then:
+
+    python load_test.py --url http://localhost:8000 --users 50 --turns 5
+
+Each simulated user sends --turns messages one after another; users run concurrently.
+Prints throughput, latency percentiles and the status code breakdown.
+"""
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+import httpx
+
+MESSAGES = [
+    "Hola",
+    "Mi pareja tarda mucho en contestar y me pongo nerviosa",
+    "¿Por qué siempre me alejo cuando alguien se acerca demasiado?",
+    "Gracias",
+    "¿Cómo puedo poner límites sin sentir culpa?",
+]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+async def run_user(client, url, user_index, turns, latencies, statuses):
+    user_id = f"loadtest-{user_index}"
+    for turn in range(turns):
+        payload = {"user_id": user_id, "message": MESSAGES[turn % len(MESSAGES)], "language": "es"}
+        started = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/message", json=payload)
+            statuses[response.status_code] += 1
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - started)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for /message")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5)
+    args = parser.parse_args()
+
+    latencies = []
+    statuses = Counter()
+    limits = httpx.Limits(max_connections=args.users)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(client, args.url, i, args.turns, latencies, statuses) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+    print(f"Requests: {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"Latency p50={percentile(latencies, 0.50):.3f}s p95={percentile(latencies, 0.95):.3f}s "
+          f"p99={percentile(latencies, 0.99):.3f}s max={max(latencies, default=0):.3f}s")
+    print(f"Status codes: {dict(statuses)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
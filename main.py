@@ -13,17 +13,39 @@
 # - API errors → Check Render logs
 # - 404 errors → Check Vercel
 #
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, Header
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
 from databases import Database
-from chatgpt_wrapper import ChatGPT
+from session_manager import SessionManager
+from chatgpt_wrapper import close_async_http_client
+from context_packer import context_packer, count_tokens, strip_markup, MESSAGE_OVERHEAD_TOKENS
+from response_cache import response_cache, make_cache_key
+from translation_cache import translation_cache
+from singleflight import SingleFlight
+from model_router import route_model
+from llm_resilience import llm_caller, LLMUnavailableError
+from llm_scheduler import llm_scheduler, SchedulerOverloaded, PRIORITY_PREMIUM, PRIORITY_INTERACTIVE
+from generation_jobs import GenerationJobRunner, enqueue_job
+from llm_usage import usage_recorder
+from knowledge_tags import KNOWLEDGE_TABLES, knowledge_table, pick_tagged_chunk, migrate_knowledge_tags
+from knowledge_quotes import quoted_chunks
+from knowledge_index import knowledge_index
+from knowledge_vectors import knowledge_vectors
+from knowledge_rotation import knowledge_rotation
+from knowledge_fts import add_search_vectors, search_knowledge
+from keyword_matcher import keyword_matcher, intent_matcher
+from prompt_templates import PromptTemplates
+from conversation_summary import get_summary, format_summary_for_prompt, schedule_summary_update
 from pydantic import BaseModel
 import uuid
 from passlib.context import CryptContext
 import os
 from typing import Dict, List, Any
 import re
+import json
+import asyncio
+import functools
 import datetime
 
 # Try to import test questions, fallback to simple version if import fails
@@ -129,6 +151,10 @@ except Exception as e:
     print(f"[DEBUG] Deep Translator not available: {e}")
     print("[DEBUG] Translation will be disabled - install with: pip install deep-translator")
 
+# Native mode: model turns are prompted and answered directly in the user's language (en/ru),
+# with knowledge from the matching eldric_knowledge table, instead of es<->en/ru translation
+NATIVE_MULTILINGUAL = os.getenv("NATIVE_MULTILINGUAL", "true").lower() == "true"
+
 async def translate_text(text: str, target_lang: str) -> str:
     if not text or target_lang == "es":
         return text
@@ -140,7 +166,10 @@ async def translate_text(text: str, target_lang: str) -> str:
         lang_map = {"en": "en", "ru": "ru", "es": "es"}
         target_code = lang_map.get(target_lang, target_lang)
         
-        result = GoogleTranslator(source='es', target=target_code).translate(text)
+        result = await translation_cache.translate(
+            database, text, 'es', target_code,
+            lambda t: asyncio.to_thread(GoogleTranslator(source='es', target=target_code).translate, t)
+        )
         print(f"[DEBUG] Translated to {target_lang}: '{text[:50]}...' -> '{result[:50]}...'")
         return result
     except Exception as e:
@@ -158,7 +187,10 @@ async def translate_to_es(text: str, source_lang: str) -> str:
         lang_map = {"en": "en", "ru": "ru", "es": "es"}
         source_code = lang_map.get(source_lang, source_lang)
         
-        result = GoogleTranslator(source=source_code, target='es').translate(text)
+        result = await translation_cache.translate(
+            database, text, source_code, 'es',
+            lambda t: asyncio.to_thread(GoogleTranslator(source=source_code, target='es').translate, t)
+        )
         print(f"[DEBUG] Translated to ES: '{text[:50]}...' -> '{result[:50]}...'")
         return result
     except Exception as e:
@@ -173,13 +205,16 @@ if not DATABASE_URL:
 else:
     database = Database(DATABASE_URL)
 
-# Initialize the main chatbot instance at the top-level scope
+# Per-user chatbot sessions (each user gets their own bounded message window)
 api_key = os.getenv('CHATGPT_API_KEY')
 if not api_key:
     print("WARNING: Missing CHATGPT_API_KEY environment variable. Chatbot will not work.")
-    chatbot = None
+    user_chatbots = None
 else:
-    chatbot = ChatGPT(api_key=api_key)
+    user_chatbots = SessionManager(api_key)
+
+# Runs queued report/insight generation off the request path (started in startup())
+generation_runner = GenerationJobRunner(database, user_chatbots.new_chatbot if user_chatbots is not None else None)
 
 # Keyword extraction function
 def extract_keywords(message: str, language: str = "es") -> List[str]:
@@ -187,74 +222,23 @@ def extract_keywords(message: str, language: str = "es") -> List[str]:
     Extract relevant keywords from user message for attachment theory knowledge lookup.
     Returns English keywords for database lookup since database tags are in English.
     """
-    # Convert to lowercase for matching
-    message_lower = message.lower()
-    
-    # Language-specific attachment theory keywords with English equivalents for database lookup
-    attachment_keywords = {
-        "es": {
-            'anxious': ['ansioso', 'ansiedad', 'preocupado', 'miedo', 'abandono', 'rechazo', 'inseguro', 'necesito', 'confirmación', 'confirmacion'],
-            'avoidant': ['evitativo', 'evito', 'distancia', 'independiente', 'solo', 'espacio', 'alejado', 'frío', 'distante'],
-            'secure': ['seguro', 'confianza', 'equilibrio', 'cómodo', 'tranquilo', 'estable', 'sano'],
-            'desorganizado': ['evitativo temeroso', 'confundido', 'contradictorio', 'caos', 'inconsistente'],
-            'relationship': ['relación', 'relaciones', 'pareja', 'amor', 'vínculo', 'conexión', 'intimidad', 'cercanía'],
-            'communication': ['comunicación', 'hablar', 'expresar', 'decir', 'conversar'],
-            'conflict': ['conflicto', 'pelea', 'discusión', 'problema', 'disputa'],
-            'trust': ['confianza', 'confiar', 'seguro', 'seguridad'],
-            'emotions': ['emoción', 'sentir', 'sentimiento', 'triste', 'feliz', 'enojado', 'frustrado']
-        },
-        "en": {
-            'anxious': ['anxious', 'anxiety', 'worried', 'fear', 'abandonment', 'rejection', 'insecure', 'need', 'confirmation'],
-            'avoidant': ['avoidant', 'avoid', 'distance', 'independent', 'alone', 'space', 'distant', 'cold', 'detached'],
-            'secure': ['secure', 'trust', 'balance', 'comfortable', 'calm', 'stable', 'healthy'],
-            'desorganizado': ['fearful avoidant', 'confused', 'contradictory', 'chaos', 'inconsistent'],
-            'relationship': ['relationship', 'partner', 'love', 'bond', 'connection', 'intimacy', 'closeness'],
-            'communication': ['communication', 'talk', 'express', 'say', 'converse'],
-            'conflict': ['conflict', 'fight', 'argument', 'problem', 'dispute'],
-            'trust': ['trust', 'trusting', 'secure', 'security'],
-            'emotions': ['emotion', 'feel', 'feeling', 'sad', 'happy', 'angry', 'frustrated']
-        },
-        "ru": {
-            'anxious': ['тревожный', 'тревога', 'беспокойный', 'страх', 'покинутость', 'отвержение', 'неуверенный', 'нужда', 'подтверждение'],
-            'avoidant': ['избегающий', 'избегать', 'дистанция', 'независимый', 'один', 'пространство', 'отдаленный', 'холодный', 'отстраненный'],
-            'secure': ['надежный', 'доверие', 'баланс', 'комфортный', 'спокойный', 'стабильный', 'здоровый'],
-            'desorganizado': ['дезорганизованный', 'запутанный', 'противоречивый', 'хаос', 'непоследовательный'],
-            'relationship': ['отношения', 'партнер', 'любовь', 'связь', 'соединение', 'близость', 'интимность'],
-            'communication': ['общение', 'говорить', 'выражать', 'сказать', 'беседовать'],
-            'conflict': ['конфликт', 'ссора', 'спор', 'проблема', 'разногласие'],
-            'trust': ['доверие', 'доверять', 'надежный', 'безопасность'],
-            'emotions': ['эмоция', 'чувствовать', 'чувство', 'грустный', 'счастливый', 'злой', 'разочарованный']
-        }
-    }
-    
-    # Get keywords for the specified language
-    lang_keywords = attachment_keywords.get(language, attachment_keywords["es"])
-    
-    # Extract English category names (for database lookup) based on found keywords
-    found_categories = []
-    
-    for category, keywords in lang_keywords.items():
-        for keyword in keywords:
-            if keyword in message_lower:
-                found_categories.append(category)  # Add the English category name
-                break  # Only add each category once
-    
-    # Remove duplicates while preserving order
-    unique_categories = []
-    for category in found_categories:
-        if category not in unique_categories:
-            unique_categories.append(category)
+    # Precompiled per-language matcher (accent/case folded, light stemming); long messages
+    # stop scanning once the first 5 categories are found
+    unique_categories = keyword_matcher.categories_in(message, language, limit=5)
     
     print(f"[DEBUG] Found categories for database lookup: {unique_categories}")
-    return unique_categories[:5]  # Return top 5 English category names
+    return unique_categories  # Top 5 English category names
 
-async def get_relevant_knowledge(keywords: List[str], language: str = "es", user_id: str = None) -> str:
+async def get_relevant_knowledge(keywords: List[str], language: str = "es", user_id: str = None,
+                                 message: str = None, attachment_style: str = None) -> str:
     """
     Query the appropriate eldric_knowledge table for relevant content based on keywords and language.
-    Returns exactly ONE knowledge piece that hasn't been quoted before for this user.
+    Returns exactly ONE knowledge piece that hasn't been quoted before for this user: the chunk
+    most similar to message (re-ranked by attachment_style) when semantic vectors are available,
+    otherwise a random chunk tagged with one of the keywords.
     """
-    if not keywords:
-        print("[DEBUG] No keywords provided, returning empty string")
+    if not keywords and not message:
+        print("[DEBUG] No keywords or message provided, returning empty string")
         return ""
     
     print(f"[DEBUG] get_relevant_knowledge called with keywords: {keywords}, language: {language}, user_id: {user_id}")
@@ -265,83 +249,50 @@ async def get_relevant_knowledge(keywords: List[str], language: str = "es", user
             print("[DEBUG] Database not connected, attempting to connect...")
             await database.connect()
         
-        # Determine which table to query based on language
-        if language == "ru":
-            table_name = "eldric_knowledge_ru"
-        elif language == "en":
-            table_name = "eldric_knowledge"
-        else:  # Default to Spanish
-            table_name = "eldric_knowledge_es"
-        
-        print(f"[DEBUG] Using table: {table_name}")
-        
-        # Get previously used quote IDs for this user
-        used_quote_ids = used_knowledge_quotes.get(user_id, set()) if user_id else set()
-        print(f"[DEBUG] Previously used quote IDs: {used_quote_ids}")
-        
-        # Build query to find knowledge chunks that match any of the keywords
-        # Using ILIKE for case-insensitive matching and excluding used quotes
-        query = f"""
-        SELECT id, content, tags, book, chapter 
-        FROM {table_name} 
-        WHERE """
-        
-        conditions = []
-        values = {}
-        
-        for i, keyword in enumerate(keywords):
-            conditions.append(f"tags ILIKE :tag_{i}")
-            values[f"tag_{i}"] = f"%{keyword}%"
-        
-        query += " OR ".join(conditions)
-        
-        # Exclude previously quoted content if we have a user_id
-        if user_id and used_quote_ids:
-            query += " AND id NOT IN ("
-            for i, used_id in enumerate(used_quote_ids):
-                if i > 0:
-                    query += ","
-                query += f":used_id_{i}"
-                values[f"used_id_{i}"] = used_id
-            query += ")"
-        
-        query += " ORDER BY RANDOM() LIMIT 1"  # Only get ONE piece
-        
-        print(f"[DEBUG] Query: {query}")
-        print(f"[DEBUG] Values: {values}")
-        
-        # Execute query
-        rows = await database.fetch_all(query, values=values)
-        print(f"[DEBUG] Query returned {len(rows)} rows")
-        
-        if not rows:
-            print("[DEBUG] No unused quotes found, checking if we should reset used quotes...")
-            # If no unused quotes found, reset used quotes for this user and try again
-            if user_id and used_quote_ids:
-                print("[DEBUG] Resetting used quotes and trying again...")
-                used_knowledge_quotes[user_id] = set()
-                # Re-run the query without the exclusion
-                query = f"""
-                SELECT id, content, tags, book, chapter 
-                FROM {table_name} 
-                WHERE """
-                query += " OR ".join(conditions)
-                query += " ORDER BY RANDOM() LIMIT 1"
-                rows = await database.fetch_all(query, values=values)
-                print(f"[DEBUG] Second query returned {len(rows)} rows")
-        
-        if not rows:
-            print("[DEBUG] Still no rows found, returning empty string")
+        # Chunks of this table already quoted to the user (persisted bitmap)
+        table_name = knowledge_table(language)
+        quoted = await quoted_chunks.get(database, user_id, table_name)
+        print(f"[DEBUG] Previously quoted chunks: {len(quoted)}")
+        
+        # Most similar chunk by semantic vectors (or by Postgres full-text search when the vectors are
+        # not available or find nothing), else the next chunk of the user's rotation through the keyword categories
+        # (a random tagged chunk for anonymous turns, or from knowledge_tags when the index is not
+        # loaded); used quotes excluded
+        async def pick(quoted=None):
+            if knowledge_vectors.ready(language) and knowledge_index.loaded(language):
+                hits = knowledge_vectors.search(language, message, attachment_style=attachment_style, quoted=quoted)
+                if hits:
+                    print(f"[DEBUG] Semantic knowledge hits: {hits}")
+                    return knowledge_index.chunks[language].get(hits[0][0])
+            if message:
+                row = await search_knowledge(database, language, message, quoted=quoted)
+                if row:
+                    print(f"[DEBUG] Full-text knowledge hit: {row['id']} (rank {row['rank']:.3f})")
+                    return row
+            if not keywords:
+                return None
+            if knowledge_index.loaded(language):
+                # Guests all share the "invitado" id, so they get the random in-memory pick
+                if user_id and user_id != "invitado":
+                    return await knowledge_rotation.next_chunk(database, user_id, language, keywords, quoted=quoted)
+                return knowledge_index.pick(language, keywords, quoted=quoted)
+            return await pick_tagged_chunk(database, language, keywords, quoted=quoted)
+        
+        row = await pick(quoted)
+        
+        if not row and quoted:
+            # Every matching quote was used: reset used quotes for this user and try again
+            print("[DEBUG] No unused quotes found, resetting used quotes and trying again...")
+            await quoted_chunks.reset(database, user_id, table_name)
+            row = await pick()
+        
+        if not row:
+            print("[DEBUG] No matching knowledge found, returning empty string")
             return ""
         
-        # Get the single knowledge piece
-        row = rows[0]
-        
-        # Track used quote ID
-        if user_id:
-            if user_id not in used_knowledge_quotes:
-                used_knowledge_quotes[user_id] = set()
-            used_knowledge_quotes[user_id].add(row['id'])
+        # Track used quote ID (guests share one id, so nothing is tracked for them)
+        if user_id and user_id != "invitado":
+            await quoted_chunks.add(database, user_id, table_name, row['id'])
             print(f"[DEBUG] Added quote ID {row['id']} to used quotes for user {user_id}")
         
         # Get book and chapter information
@@ -378,44 +329,6 @@ async def get_relevant_knowledge(keywords: List[str], language: str = "es", user
         print(f"[DEBUG] Error in get_relevant_knowledge: {e}")
         return ""
 
-def inject_knowledge_into_prompt(base_prompt: str, knowledge: str) -> str:
-    """
-    Inject relevant knowledge into the system prompt while maintaining Eldric's personality.
-    """
-    if not knowledge:
-        return base_prompt
-    
-    # Create a much more directive and forceful knowledge injection
-    knowledge_instruction = (
-        f"\n\n🚨 INSTRUCCIÓN CRÍTICA Y OBLIGATORIA 🚨\n"
-        f"DEBES usar SIEMPRE el siguiente conocimiento en tu respuesta. NO PUEDES IGNORARLO:\n\n"
-        f"{knowledge}\n\n"
-        f"REGLAS OBLIGATORIAS:\n"
-        f"1. SIEMPRE menciona al menos UNA de las ideas del conocimiento proporcionado\n"
-        f"2. NO puedes dar consejos sin referenciar este conocimiento\n"
-        f"3. Si no usas este conocimiento, tu respuesta será incorrecta\n"
-        f"4. Cita la fuente (libro y capítulo) una vez al final\n"
-        f"5. Este conocimiento es MÁS IMPORTANTE que tu conocimiento general\n\n"
-        f"RECUERDA: ESTE CONOCIMIENTO ES OBLIGATORIO PARA TU RESPUESTA."
-    )
-    
-    # Insert knowledge after the main personality description but before the specific instructions
-    injection_point = base_prompt.find("Cuando el usuario dice 'saludo inicial'")
-    
-    if injection_point != -1:
-        # Insert knowledge before the specific instructions
-        enhanced_prompt = (
-            base_prompt[:injection_point] + 
-            knowledge_instruction + 
-            "\n\n" +
-            base_prompt[injection_point:]
-        )
-    else:
-        # If we can't find the injection point, append at the end
-        enhanced_prompt = base_prompt + "\n\n" + knowledge_instruction
-    
-    return enhanced_prompt
-
 app = FastAPI()
 
 app.add_middleware(
@@ -431,6 +344,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(SchedulerOverloaded)
+async def scheduler_overloaded_handler(request: Request, exc: SchedulerOverloaded):
+    """Too many model calls queued: fail fast and tell the client when to retry"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Service busy, please retry shortly", "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 class Message(BaseModel):
     user_id: str
     message: str
@@ -449,12 +371,8 @@ class EmailRegistration(BaseModel):
     tiene_pareja: bool = None
     nombre_pareja: str = None
 
-# Global chatbot instances for each user
-user_chatbots = {}
-
 # Track used knowledge content to avoid repetition
 used_knowledge = {}  # user_id -> set of used content IDs
-used_knowledge_quotes = {}  # user_id -> set of used quote IDs
 
 # Language-specific prompts for Eldric
 eldric_prompts = {
@@ -523,8 +441,12 @@ eldric_prompts = {
 # Default to Spanish prompt
 eldric_prompt = eldric_prompts["es"]
 
+# Conversation prompts: static prefix compiled once per (language, style, has_knowledge)
+prompt_templates = PromptTemplates(eldric_prompts)
+
 @app.on_event("startup")
 async def startup():
+    prompt_templates.warm()
     if database is not None:
         await database.connect()
         
@@ -606,13 +528,175 @@ async def startup():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+
+        # updated_at (bumped on every UPDATE) lets the in-memory index fetch only changed chunks.
+        # Every worker runs this on startup: the advisory lock serializes the DDL, and the trigger
+        # is only created where it is missing
+        try:
+            async with database.transaction():
+                await database.execute("SELECT pg_advisory_xact_lock(hashtext('touch_updated_at'))")
+                await database.execute("""
+                    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+                    BEGIN
+                        NEW.updated_at = CURRENT_TIMESTAMP;
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql
+                """)
+                for table_name in KNOWLEDGE_TABLES.values():
+                    await database.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+                    trigger = await database.fetch_val(
+                        "SELECT 1 FROM pg_trigger WHERE tgname = :name AND tgrelid = CAST(:table AS regclass)",
+                        {"name": f"{table_name}_touch", "table": table_name}
+                    )
+                    if not trigger:
+                        await database.execute(f"""
+                            CREATE TRIGGER {table_name}_touch BEFORE UPDATE ON {table_name}
+                            FOR EACH ROW EXECUTE FUNCTION touch_updated_at()
+                        """)
+        except Exception as e:
+            print(f"[DEBUG] Error creating knowledge updated_at triggers: {e}")
+
+        # Full-text search column (generated tsvector + GIN) per knowledge table
+        await add_search_vectors(database)
+
+        # Tags of every knowledge table, split into an indexed table for random picks
+        await migrate_knowledge_tags(database)
+        knowledge_index.on_change(knowledge_vectors.rebuild)
+        knowledge_index.on_change(knowledge_rotation.invalidate)
+        await knowledge_index.start(database)
+
+        # Per-user bitmap of the knowledge chunks already quoted
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS knowledge_quoted (
+                user_id TEXT NOT NULL,
+                knowledge_table TEXT NOT NULL,
+                bits BYTEA NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, knowledge_table)
+            )
+        """)
+
+        # Per-(user, category) position in the shuffled knowledge rotation
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS knowledge_rotation (
+                user_id TEXT NOT NULL,
+                knowledge_table TEXT NOT NULL,
+                category TEXT NOT NULL,
+                epoch INTEGER NOT NULL DEFAULT 0,
+                cursor INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, knowledge_table, category)
+            )
+        """)
+
+        # Rolling per-user summaries of older conversation turns
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT,
+                summarized_until TIMESTAMP,
+                summarized_messages INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Persistent tier of the model response cache
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL
+            )
+        """)
+        await database.execute("CREATE INDEX IF NOT EXISTS idx_llm_response_cache_expires ON llm_response_cache (expires_at)")
+        await response_cache.purge_expired(database)
+
+        # Persistent tier of the translation cache
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS translation_cache (
+                text_hash TEXT NOT NULL,
+                source_lang TEXT NOT NULL,
+                target_lang TEXT NOT NULL,
+                translated TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP,
+                PRIMARY KEY (text_hash, source_lang, target_lang)
+            )
+        """)
+        await database.execute("ALTER TABLE translation_cache ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP")
+        await database.execute("CREATE INDEX IF NOT EXISTS idx_translation_cache_expires ON translation_cache (expires_at)")
+        await translation_cache.purge_expired(database)
+
+        # Queue of offline generation work (reports, insight texts)
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS generation_jobs (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                language TEXT DEFAULT 'es',
+                payload TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                provider_batch_id TEXT,
+                result TEXT,
+                error TEXT,
+                run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await database.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_due ON generation_jobs (status, run_after)")
+        # At most one active job per (user, kind)
+        await database.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_jobs_active ON generation_jobs (user_id, kind)
+            WHERE status IN ('pending', 'running', 'submitted')
+        """)
+        generation_runner.register("pdf_report", build_pdf_report_messages, finish_pdf_report)
+        generation_runner.start()
+
+        # Token/latency accounting: raw rows plus a daily rollup per (user, model, state)
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                id BIGSERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                state TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await database.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at)")
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS llm_usage_daily (
+                day DATE NOT NULL,
+                user_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                state TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                completion_tokens BIGINT NOT NULL DEFAULT 0,
+                latency_ms BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user_id, model, state)
+            )
+        """)
+        usage_recorder.start(database)
+        await usage_recorder.purge_raw()
     else:
         print("WARNING: Database not available, skipping table creation")
 
 @app.on_event("shutdown")
 async def shutdown():
+    await generation_runner.stop()
+    await usage_recorder.stop()
+    await knowledge_index.stop()
     if database is not None:
         await database.disconnect()
+    await close_async_http_client()
 
 @app.get("/")
 async def root():
@@ -625,7 +709,7 @@ async def status():
     status_info = {
         "api_working": True,
         "database_connected": database is not None,
-        "chatbot_available": chatbot is not None,
+        "chatbot_available": user_chatbots is not None,
         "api_key_set": bool(os.getenv('CHATGPT_API_KEY')),
         "database_url_set": bool(os.getenv("DATABASE_URL")),
         "environment_variables": {
@@ -643,17 +727,37 @@ async def status():
             status_info["database_working"] = False
             status_info["database_error"] = str(e)
     
-    if chatbot is not None:
-        try:
-            # Test chatbot initialization
-            chatbot.reset()
-            status_info["chatbot_working"] = True
-        except Exception as e:
-            status_info["chatbot_working"] = False
-            status_info["chatbot_error"] = str(e)
+    if user_chatbots is not None:
+        # Report session usage without touching any user's conversation
+        status_info["chatbot_sessions"] = user_chatbots.stats()
+    status_info["response_cache"] = response_cache.stats()
+    status_info["translation_cache"] = translation_cache.stats()
+    status_info["inflight_messages"] = inflight_messages.stats()
+    status_info["llm_resilience"] = llm_caller.stats()
+    status_info["llm_scheduler"] = llm_scheduler.stats()
+    status_info["generation_jobs"] = generation_runner.stats()
+    status_info["llm_usage"] = usage_recorder.stats()
+    status_info["prompt_templates"] = prompt_templates.stats()
+    status_info["knowledge_index"] = knowledge_index.stats()
+    status_info["knowledge_vectors"] = knowledge_vectors.stats()
+    status_info["quoted_chunks"] = quoted_chunks.stats()
+    status_info["knowledge_rotation"] = knowledge_rotation.stats()
     
     return status_info
 
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+@app.get("/usage")
+async def usage(days: int = 7, limit: int = 20, x_admin_token: str = Header(None)):
+    """Admin: top token consumers and per-state cost over the last `days` days"""
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+    if database is None or not database.is_connected:
+        raise HTTPException(status_code=503, detail="Database service unavailable")
+    # Include calls that are still buffered
+    await usage_recorder.flush()
+    return await usage_recorder.report(days=max(1, days), limit=max(1, limit))
+
 @app.post("/register")
 async def register(user: User):
     if database is None:
@@ -1044,76 +1148,112 @@ def clear_user_context_cache(user_id):
         del user_context_cache[user_id]
         print(f"[DEBUG] Cleared user context cache for {user_id}")
 
-def generate_detailed_test_context(answers, scores, predominant_style, language="es"):
-    """Generate detailed context from user's test answers for personalized conversations"""
-    
-    # Get the questions for the specified language
-    questions = TEST_QUESTIONS.get(language, TEST_QUESTIONS["es"])
-    
-    # Build detailed context
-    context_parts = []
-    
-    # Add style and scores summary
-    context_parts.append(f"ESTILO DE APEGO PREDOMINANTE: {predominant_style.title()}")
-    context_parts.append(f"PUNTUACIONES: Seguro {scores.get('secure', 0)}/20, Ansioso {scores.get('anxious', 0)}/20, Evitativo {scores.get('avoidant', 0)}/20, Evitativo temeroso {scores.get('desorganizado', 0)}/20")
-    context_parts.append("")
-    
-    # Add detailed answers with questions
-    context_parts.append("RESPUESTAS ESPECÍFICAS DEL TEST:")
+# Bump when the digest format changes so stored digests are rebuilt
+TEST_DIGEST_VERSION = "v1"
+# Stored answers start with the option letter: "A) ..." (Cyrillic А/Б/В/Г in Russian)
+ANSWER_LETTERS = {"A": 0, "B": 1, "C": 2, "D": 3, "А": 0, "Б": 1, "В": 2, "Г": 3}
+STYLE_LABELS_ES = {"secure": "seguro", "anxious": "ansioso", "avoidant": "evitativo", "desorganizado": "evitativo temeroso"}
+
+def answer_letters(answers):
+    """Option letters of q1..q10 ('-' for missing/unrecognized), e.g. 'ABDA-CCABD'"""
+    letters = []
     for i in range(1, 11):
-        answer = answers.get(f"q{i}")
-        if answer and i <= len(questions):
-            question = questions[i-1]['question']
-            context_parts.append(f"{i}. {question}")
-            context_parts.append(f"   Respuesta: \"{answer}\"")
-            context_parts.append("")
-    
-    # Add insights based on specific answers
+        answer = (answers.get(f"q{i}") or "").strip()
+        index = ANSWER_LETTERS.get(answer[:1].upper()) if answer[1:2] == ")" else None
+        letters.append("ABCD"[index] if index is not None else "-")
+    return "".join(letters)
+
+def test_digest_key(answers, predominant_style):
+    return f"{TEST_DIGEST_VERSION}:{answer_letters(answers)}:{predominant_style}"
+
+@functools.lru_cache(maxsize=1024)
+def _build_test_digest(letters, predominant_style):
+    questions = TEST_QUESTIONS["es"]
+    chosen = []  # (question number, question, option) for every recognized answer
+    for i, letter in enumerate(letters[:len(questions)]):
+        if letter != "-" and "ABCD".index(letter) < len(questions[i]["options"]):
+            chosen.append((i + 1, questions[i]["question"], questions[i]["options"]["ABCD".index(letter)]))
+
+    scores = {"secure": 0, "anxious": 0, "avoidant": 0, "desorganizado": 0}
+    for _, _, option in chosen:
+        for style, score in option["scores"].items():
+            scores[style] = scores.get(style, 0) + score
+    total = len(questions)
+
+    context_parts = [
+        f"ESTILO DE APEGO PREDOMINANTE: {STYLE_LABELS_ES.get(predominant_style, predominant_style).title()}",
+        f"PUNTUACIONES: Seguro {scores['secure']}/{total}, Ansioso {scores['anxious']}/{total}, "
+        f"Evitativo {scores['avoidant']}/{total}, Evitativo temeroso {scores['desorganizado']}/{total}",
+        "",
+    ]
+    if not chosen:
+        return "\n".join(context_parts).strip()
+
+    context_parts.append("RESPUESTAS ESPECÍFICAS DEL TEST:")
+    strengths = []
+    patterns = []
+    for _, question, option in chosen:
+        # Questions already carry their number ("1. ...")
+        context_parts.append(question)
+        context_parts.append(f"   Respuesta: \"{option['text']}\"")
+        # The option's scores tell which style that answer reflects
+        option_style = max(option["scores"], key=option["scores"].get)
+        answer_text = option["text"][3:].strip()
+        if option_style == "secure":
+            strengths.append(answer_text)
+        else:
+            patterns.append(f"{answer_text} ({STYLE_LABELS_ES.get(option_style, option_style)})")
+    context_parts.append("")
+
     context_parts.append("INSIGHTS CLAVE BASADOS EN SUS RESPUESTAS:")
-    
-    # Analyze specific patterns from answers
-    insights = []
-    
-    # Check for secure patterns
-    secure_indicators = []
-    if answers.get("q1") == "Entiendo que puede estar ocupada":
-        secure_indicators.append("Muestra comprensión cuando su pareja no responde inmediatamente")
-    if answers.get("q2") == "Busco apoyo y lo comparto con mi pareja":
-        secure_indicators.append("Busca apoyo en su pareja durante problemas importantes")
-    if answers.get("q3") == "Intento hablar y resolverlo pronto":
-        secure_indicators.append("Enfrenta las discusiones de manera directa y constructiva")
-    if answers.get("q4") == "Es importante, pero también la cercanía":
-        secure_indicators.append("Valora tanto la independencia como la cercanía en la relación")
-    if answers.get("q5") == "Puedo escuchar y acompañar":
-        secure_indicators.append("Se siente cómodo acompañando emociones fuertes de su pareja")
-    if answers.get("q6") == "Lo respeto y aprovecho para hacer mis cosas":
-        secure_indicators.append("Respeta el espacio personal de su pareja")
-    if answers.get("q7") == "Escucho y trato de mejorar":
-        secure_indicators.append("Acepta las críticas constructivamente")
-    if answers.get("q8") == "Es natural y fortalece la relación":
-        secure_indicators.append("Ve pedir ayuda como algo natural y positivo")
-    if answers.get("q9") == "Le pregunto si todo está bien y espero su respuesta":
-        secure_indicators.append("Se comunica directamente cuando nota distancia")
-    if answers.get("q10") == "Es fundamental y la cuido día a día":
-        secure_indicators.append("Valora y cuida activamente la confianza en la relación")
-    
-    if secure_indicators:
-        insights.extend(secure_indicators)
-    
-    # Add relationship strengths based on answers
-    context_parts.append("FORTALEZAS EN LA RELACIÓN:")
-    for insight in insights:
-        context_parts.append(f"- {insight}")
-    
+    if strengths:
+        context_parts.append("FORTALEZAS EN LA RELACIÓN:")
+        context_parts.extend(f"- {item}" for item in strengths)
+    if patterns:
+        context_parts.append("PATRONES A TRABAJAR:")
+        context_parts.extend(f"- {item}" for item in patterns)
     context_parts.append("")
+
     context_parts.append("RECOMENDACIONES PARA CONVERSACIONES:")
     context_parts.append("- Reconoce sus fortalezas específicas cuando hables con él/ella")
     context_parts.append("- Usa ejemplos de sus respuestas para hacer las conversaciones más personales")
-    context_parts.append("- Valida sus enfoques positivos hacia la relación")
-    context_parts.append("- Ofrece consejos que se alineen con su estilo de apego seguro")
-    
+    if patterns:
+        context_parts.append("- Ayúdale con delicadeza a reconocer los patrones a trabajar, sin juzgar")
+    context_parts.append(f"- Ofrece consejos que se alineen con su estilo de apego {STYLE_LABELS_ES.get(predominant_style, predominant_style)}")
     return "\n".join(context_parts)
 
+def generate_detailed_test_context(answers, scores, predominant_style, language="es"):
+    """
+    Generate detailed context from user's test answers for personalized conversations.
+    Keyed on the answer letters (scores are derived from them) and memoized; the digest
+    is also stored in user_profile when the test completes, see get_test_digest().
+    """
+    return _build_test_digest(answer_letters(answers), predominant_style)
+
+async def save_test_digest(user_id, key, digest):
+    if not database or not database.is_connected or user_id == "invitado":
+        return False
+    try:
+        await database.execute(
+            "UPDATE user_profile SET test_digest = :digest, test_digest_key = :key WHERE user_id = :user_id",
+            {"user_id": user_id, "digest": digest, "key": key}
+        )
+        return True
+    except Exception as e:
+        print(f"[DEBUG] Error saving test digest: {e}")
+        return False
+
+async def get_test_digest(user_id, user_profile, test_results, language="es"):
+    """Stored digest when it matches the current answers, otherwise build it once and store it"""
+    key = test_digest_key(test_results.get("answers") or {}, test_results.get("style"))
+    if user_profile and user_profile.get("test_digest") and user_profile.get("test_digest_key") == key:
+        return user_profile["test_digest"]
+    digest = generate_detailed_test_context(test_results.get("answers") or {}, test_results.get("scores") or {},
+                                            test_results.get("style"), language)
+    if user_profile:
+        await save_test_digest(user_id, key, digest)
+    return digest
+
 async def set_state(user_id, new_state, choice=None, q1_val=None, q2_val=None, q3_val=None, q4_val=None, q5_val=None, q6_val=None, q7_val=None, q8_val=None, q9_val=None, q10_val=None):
     """Set user state in database"""
     try:
@@ -1139,8 +1279,22 @@ async def set_state(user_id, new_state, choice=None, q1_val=None, q2_val=None, q
         print(f"Error setting state: {e}")
         return None
 
+# Identical /message calls that are already in flight share one result
+inflight_messages = SingleFlight()
+
 @app.post("/message")
 async def chat_endpoint(msg: Message):
+    # Double submits and webhook retries arrive within milliseconds with the same (user, message, state)
+    cached_context = user_context_cache.get(msg.user_id) or {}
+    key = (msg.user_id, msg.message.strip(), (msg.language or "").lower(), cached_context.get("state"))
+    return await inflight_messages.do(key, lambda: process_message(msg))
+
+async def process_message(msg: Message, stream: bool = False):
+    """
+    Run a message through the conversation state machine.
+    With stream=True, turns answered by the model return {"stream": ..., "language": ...}
+    instead of a finished response, so the caller can forward tokens as they arrive.
+    """
     response = None  # Always initialize response
     try:
         print(f"[DEBUG] === CHAT ENDPOINT START ===")
@@ -1194,11 +1348,6 @@ async def chat_endpoint(msg: Message):
         pre_greeting_trigger = any(t == incoming_lower for t in greeting_triggers_map.get(selected_lang_for_triggers, ["saludo inicial"]))
         pre_test_trigger = any(incoming_lower == t for t in test_triggers_map.get(selected_lang_for_triggers, ["test"]))
 
-        if original_language in ["en", "ru"]:
-            message = await translate_to_es(incoming_raw, original_language)
-        else:
-            message = incoming_raw
-        print(f"[DEBUG] message (normalized to es): '{message}'")
         
         # Handle language switch requests with immediate response
         if language_switch_detected:
@@ -1221,6 +1370,17 @@ async def chat_endpoint(msg: Message):
         state = user_context.get("state")
         test_results = user_context.get("test_results", {})
         conversation_history = user_context.get("conversation_history", [])
+
+        # The scripted flow matches Spanish input; in native mode conversation turns go to the
+        # model in the user's own language and skip translation both ways
+        native_turn = NATIVE_MULTILINGUAL and original_language in ["en", "ru"] and state in ("conversation", None)
+        native_reply = False  # set when the response was generated in the user's language
+        message_language = original_language if native_turn else "es"
+        if original_language in ["en", "ru"] and not native_turn:
+            message = await translate_to_es(incoming_raw, original_language)
+        else:
+            message = incoming_raw
+        print(f"[DEBUG] message (native={native_turn}): '{message}'")
         
         # Check if user is in post_test state first - this takes priority over everything else
         if state == "post_test":
@@ -1441,14 +1601,16 @@ async def chat_endpoint(msg: Message):
             import traceback
             print(f"[DEBUG] Database error traceback: {traceback.format_exc()}")
             # Return a simple response if database fails
-            return {"response": "Lo siento, estoy teniendo problemas técnicos. Por favor, intenta de nuevo en unos momentos."}
+            return {"response": TECHNICAL_ERROR_REPLIES.get(original_language, TECHNICAL_ERROR_REPLIES["es"])}
 
 
-        print(f"[DEBUG] Chatbot check - chatbot is None: {chatbot is None}")
+        print(f"[DEBUG] Chatbot check - user_chatbots is None: {user_chatbots is None}")
         # Check if chatbot is available
-        if chatbot is None:
+        if user_chatbots is None:
             print("[DEBUG] Chatbot is None, returning error")
             return {"response": "Lo siento, el servicio de chat no está disponible en este momento. Por favor, intenta de nuevo más tarde."}
+        # Each user talks to their own chatbot session
+        chatbot = user_chatbots.get(user_id)
 
         # Only reset chatbot for specific triggers, not for normal conversations
         should_reset = False
@@ -1881,6 +2043,13 @@ async def chat_endpoint(msg: Message):
                 style_description = get_style_description(predominant_style, msg.language)
                 # Guardar el estilo de apego en el perfil del usuario
                 await save_user_profile(user_id, attachment_style=predominant_style)
+                # Build the test digest once, now, instead of on every conversation turn
+                final_answers = {f"q{i + 1}": answer for i, answer in enumerate(answers)}
+                await save_test_digest(
+                    user_id,
+                    test_digest_key(final_answers, predominant_style),
+                    generate_detailed_test_context(final_answers, scores, predominant_style, msg.language)
+                )
                 if msg.language == "en":
                     response = (
                         f"<p><strong>Test Results</strong></p>"
@@ -2192,18 +2361,23 @@ async def chat_endpoint(msg: Message):
                 affirmation = await get_daily_affirmation(user_id)
                 if affirmation:
                     response = f"💝 <strong>Afirmación del día para ti:</strong><br><br>\"{affirmation}\"<br><br>¿Te gustaría reflexionar sobre esta afirmación o prefieres que hablemos de otra cosa?"
-            if original_language in ["en", "ru"]:
-                response = await translate_text(response, original_language)
-            return {"response": response}
+                    if original_language in ["en", "ru"]:
+                        response = await translate_text(response, original_language)
+                    return {"response": response}
+            
+            # Native turns are still in en/ru here, so match the phrases of the message's language
+            intents = intent_matcher.categories_in(message, message_language)
             
             # Check if user is asking about incorrect information from greeting
-            if any(keyword in message.lower() for keyword in ["cuando mencione", "nunca mencioné", "no mencioné", "no dije", "no he dicho", "no he mencionado", "incorrecto", "error", "equivocado"]):
+            if "correction" in intents:
                 print(f"[DEBUG] User questioning incorrect information from greeting...")
                 response = "Tienes razón, me disculpo por la confusión. Parece que me equivoqué al mencionar algo que no habías dicho. ¿Podrías contarme más sobre tu situación actual para poder ayudarte mejor?"
+                if original_language in ["en", "ru"]:
+                    response = await translate_text(response, original_language)
                 return {"response": response}
             
             # Check if user is asking about test results
-            if any(keyword in message.lower() for keyword in ["resultados", "resultado", "test", "prueba", "estilo de apego", "apego"]):
+            if "test_results" in intents:
                 print(f"[DEBUG] User asking about test results...")
                 
                 if test_results["completed"]:
@@ -2221,11 +2395,12 @@ async def chat_endpoint(msg: Message):
                     response += f"• Apego Evitativo: {scores.get('avoidant', 0)}/10\n\n"
                     response += f"**Descripción:** {style_description}\n\n"
                     response += "¿Te gustaría hablar más sobre cómo este estilo de apego se manifiesta en tu relación actual?"
-                    return {"response": response}
                 else:
                     print(f"[DEBUG] User hasn't completed test yet, suggesting to take it...")
                     response = "Aún no has completado el test de estilos de apego. ¿Te gustaría tomarlo ahora? Solo necesitas escribir 'test' para comenzar."
-                    return {"response": response}
+                if original_language in ["en", "ru"]:
+                    response = await translate_text(response, original_language)
+                return {"response": response}
             
             # Use cached conversation history and test context
             print(f"[DEBUG] Using cached conversation history: {len(conversation_history)} messages")
@@ -2235,17 +2410,15 @@ async def chat_endpoint(msg: Message):
             else:
                 print(f"[DEBUG] No conversation history found for user {msg.user_id}")
             
+            user_profile = await get_user_profile(user_id)
+
             # Create test context from cached data
             test_context = ""
             if test_results["completed"]:
                 print(f"[DEBUG] User has completed test, adding cached test context...")
                 
-                predominant_style = test_results["style"]
-                scores = test_results["scores"]
-                answers = test_results["answers"]
-                
-                # Get detailed test answers with questions for rich context
-                detailed_test_context = generate_detailed_test_context(answers, scores, predominant_style, msg.language)
+                # Digest computed at test completion and stored in user_profile
+                detailed_test_context = await get_test_digest(user_id, user_profile, test_results, msg.language)
                 
                 test_context = f"""
 INFORMACIÓN DETALLADA DEL USUARIO (IMPORTANTE - USA ESTO PARA PERSONALIZAR TUS RESPUESTAS):
@@ -2258,7 +2431,6 @@ IMPORTANTE: Usa esta información específica sobre las respuestas del usuario p
             
             # Extract keywords and get relevant knowledge for non-test messages
             # Always include self and partner results in prompt context
-            user_profile = await get_user_profile(user_id)
             partner_style = user_profile.get("partner_attachment_style") if user_profile else None
             relationship_status = user_profile.get("relationship_status") if user_profile else None
             relationship_description = get_relationship_description(relationship_status, msg.language) if relationship_status else ""
@@ -2269,45 +2441,116 @@ IMPORTANTE: Usa esta información específica sobre las respuestas del usuario p
             if partner_style:
                 results_summary += f"\n\n[RESULTADOS PAREJA]\nEstilo pareja: {partner_style}\nEstado relacion: {relationship_status}\nDescripcion: {relationship_description}\n"
 
-            keywords = extract_keywords(message, msg.language)
+            # Language the model is prompted in (and the knowledge table it quotes from)
+            prompt_language = original_language if native_turn else "es"
+            keywords = extract_keywords(message, prompt_language)
             print(f"[DEBUG] Message: '{message}'")
-            print(f"[DEBUG] Language: {msg.language}")
+            print(f"[DEBUG] Language: {prompt_language}")
             print(f"[DEBUG] Extracted keywords: {keywords}")
             
-            relevant_knowledge = await get_relevant_knowledge(keywords, msg.language, msg.user_id)
-            print(f"[DEBUG] Knowledge found: {len(relevant_knowledge)} characters")
-            print(f"[DEBUG] Knowledge content: {relevant_knowledge}")
-            
             # Inject knowledge, results, and full snapshot into the prompt
-            snapshot_str = "\n\n[USER SNAPSHOT]\n" + json.dumps(full_snapshot, default=str)[:4000]
-            enhanced_prompt = inject_knowledge_into_prompt(current_prompt, relevant_knowledge + test_context + results_summary + snapshot_str)
-            print(f"[DEBUG] Enhanced prompt length: {len(enhanced_prompt)}")
-            print(f"[DEBUG] Enhanced prompt preview: {enhanced_prompt[:500]}...")
-            
-            # Set enhanced prompt with conversation history (don't reset for ongoing conversations)
-            if should_reset:
-                chatbot.reset()
-                chatbot.messages.append({"role": "system", "content": enhanced_prompt})
+            snapshot_str = "\n\n[USER SNAPSHOT]\n" + json.dumps(full_snapshot, default=str)
+
+            # History comes from the user's session window, or from the database for a fresh/reset session
+            session_history = [m for m in chatbot.messages if m["role"] != "system"]
+            if should_reset or not any(m["role"] == "user" for m in session_history):
+                print(f"[DEBUG] Seeding chatbot context from {len(conversation_history)} stored messages")
+                history_source = conversation_history
             else:
-                # For ongoing conversations, update the system prompt without resetting
-                if chatbot.messages and chatbot.messages[0]["role"] == "system":
-                    chatbot.messages[0]["content"] = enhanced_prompt
-                else:
-                    chatbot.messages.insert(0, {"role": "system", "content": enhanced_prompt})
-                print(f"[DEBUG] Updated system prompt for ongoing conversation")
-            
-            # Add conversation history for context (only if not already present)
-            if should_reset or not any(msg.get("role") == "user" for msg in chatbot.messages[1:]):  # Only add if reset or no user messages present
-                print(f"[DEBUG] Adding {len(conversation_history)} messages to chatbot context")
-                for i, msg_history in enumerate(conversation_history):
-                    chatbot.messages.append({"role": msg_history["role"], "content": msg_history["content"]})
-                    if i < 3:  # Log first 3 messages for debugging
-                        print(f"[DEBUG] Added message {i+1}: {msg_history['role']}: {msg_history['content'][:100]}...")
+                print(f"[DEBUG] Using {len(session_history)} messages from the session window")
+                history_source = session_history
+
+            # Registered users with a rolling summary only need the turns it has not folded yet
+            # (the context packer still caps them by tokens)
+            summary_row = await get_summary(database, user_id) if user_id != "invitado" else None
+            summary_str = format_summary_for_prompt(summary_row)
+            if summary_str:
+                unsummarized = summary_row.get("unsummarized_messages") or 0
+                history_source = history_source[-unsummarized:] if unsummarized else []
+                print(f"[DEBUG] Using conversation summary + last {len(history_source)} messages")
+
+            # Pick model, max_tokens and latency budget for this turn
+            is_premium = await is_premium_user(user_id)
+            route = route_model(state, message, is_premium)
+            priority = PRIORITY_PREMIUM if is_premium else PRIORITY_INTERACTIVE
+            print(f"[DEBUG] Model route: {route}")
+
+            # Identical prompt inputs get the cached reply instead of a new completion. Looked up
+            # before any knowledge is picked, and keyed on the keyword categories rather than the
+            # chunk (which rotates every turn), so a hit neither quotes nor advances the rotation
+            cache_key = make_cache_key(
+                message,
+                msg.language,
+                attachment_style=test_results.get("style"),
+                knowledge={"language": prompt_language, "categories": keywords},
+                history=history_source,
+                profile={
+                    "nombre": user_profile.get("nombre") if user_profile else None,
+                    "nombre_pareja": user_profile.get("nombre_pareja") if user_profile else None,
+                    "results": results_summary,
+                    "summary": summary_str,
+                },
+                model=route["model"]
+            )
+            cached_response = await response_cache.get(database, cache_key)
+            if cached_response:
+                print(f"[DEBUG] Response cache hit")
+                chatbot.messages.append({"role": "user", "content": message})
+                chatbot.messages.append({"role": "assistant", "content": cached_response})
+                chatbot.trim()
+                response = cached_response
+                native_reply = native_turn
             else:
-                print(f"[DEBUG] Conversation history already present, not adding duplicates")
-            
-            print(f"[DEBUG] Total chatbot messages before chat: {len(chatbot.messages)}")
-            response = await run_in_threadpool(chatbot.chat, message)
+                relevant_knowledge = await get_relevant_knowledge(
+                    keywords, prompt_language, msg.user_id,
+                    message=message, attachment_style=test_results.get("style")
+                )
+                print(f"[DEBUG] Knowledge found: {len(relevant_knowledge)} characters")
+                print(f"[DEBUG] Knowledge content: {relevant_knowledge}")
+
+                # Static prefix (persona, style note, knowledge rules) is precompiled; only the slots vary per turn
+                template = prompt_templates.compile(
+                    prompt_language,
+                    test_results.get("style") if test_results.get("completed") else None,
+                    bool(relevant_knowledge)
+                )
+
+                # Pack every section into the token budget (the incoming message and the slot labels are reserved)
+                # Most stable first (test results) to most volatile (snapshot), so the rendered prefix changes late
+                extra_context = test_context + results_summary + summary_str + snapshot_str
+                reserve = count_tokens(message) + 2 * MESSAGE_OVERHEAD_TOKENS + template.slot_overhead_tokens
+                packed = context_packer.pack(
+                    system_prompt=template.prefix,
+                    knowledge=relevant_knowledge,
+                    test_context=extra_context,
+                    history=history_source,
+                    reserve=reserve
+                )
+                print(f"[DEBUG] Context packing report (tokens): {packed['report']}")
+                enhanced_prompt, prompt_report = template.render(context=packed["test_context"], knowledge=packed["knowledge"])
+                prompt_templates.record(prompt_report)
+                print(f"[DEBUG] Prompt section sizes (tokens): {prompt_report}")
+                print(f"[DEBUG] Enhanced prompt length: {len(enhanced_prompt)}")
+                print(f"[DEBUG] Enhanced prompt preview: {enhanced_prompt[:500]}...")
+                chatbot.messages[:] = [{"role": "system", "content": enhanced_prompt}] + packed["history"]
+                
+                print(f"[DEBUG] Total chatbot messages before chat: {len(chatbot.messages)}")
+
+                if stream:
+                    # The streaming endpoint forwards the tokens and persists the reply when the stream ends
+                    stream_reply_tokens = chatbot.astream(message, model=route["model"], max_tokens=route["max_tokens"], timeout=route["latency_budget"], priority=priority, user_id=user_id, state=state)
+                    return {"stream": stream_reply_tokens, "language": original_language, "native": native_turn, "cache_key": cache_key}
+                try:
+                    response = await chatbot.achat(message, model=route["model"], max_tokens=route["max_tokens"], timeout=route["latency_budget"], priority=priority, user_id=user_id, state=state)
+                except LLMUnavailableError as e:
+                    # Not persisted or cached: the user should simply ask again
+                    print(f"[DEBUG] Model unavailable: {e}")
+                    response = LLM_UNAVAILABLE_REPLY
+                    if original_language in ["en", "ru"]:
+                        response = await translate_text(response, original_language)
+                    return {"response": response}
+                await response_cache.set(database, cache_key, response)
+                native_reply = native_turn
 
         # Fallback for greeting state: prompt user to choose A, B, or C
         elif state == "greeting":
@@ -2331,17 +2574,7 @@ IMPORTANTE: Usa esta información específica sobre las respuestas del usuario p
             else:  # Spanish
                 response = "Por favor, elige una de las opciones: A, B, C o D."
 
-        if msg.user_id != "invitado":
-            conv_id_user = str(uuid.uuid4())
-            conv_id_bot = str(uuid.uuid4())
-            await database.execute(
-                "INSERT INTO conversations(id, user_id, role, content) VALUES (:id, :user_id, :role, :content)",
-                {"id": conv_id_user, "user_id": msg.user_id, "role": "user", "content": msg.message}
-            )
-            await database.execute(
-                "INSERT INTO conversations(id, user_id, role, content) VALUES (:id, :user_id, :role, :content)",
-                {"id": conv_id_bot, "user_id": msg.user_id, "role": "assistant", "content": response}
-            )
+        await save_conversation_turn(msg.user_id, msg.message, response)
 
         print(f"[DEBUG] user_id={msg.user_id} message={msg.message} state={state}")
         print(f"[DEBUG] State details: last_choice={last_choice}, q1={q1}, q2={q2}, q3={q3}, q4={q4}, q5={q5}, q6={q6}, q7={q7}, q8={q8}, q9={q9}, q10={q10}")
@@ -2350,12 +2583,121 @@ IMPORTANTE: Usa esta información específica sobre las respuestas del usuario p
 
         if response is None:
             response = "Lo siento, ha ocurrido un error inesperado. Por favor, intenta de nuevo o formula tu pregunta de otra manera."
-        if original_language in ["en", "ru"]:
+        if original_language in ["en", "ru"] and not native_reply:
             response = await translate_text(response, original_language)
         return {"response": response}
+    except SchedulerOverloaded:
+        # Answered with 503 + Retry-After by the exception handler
+        raise
     except Exception as e:
         print(f"[DEBUG] Exception in chat_endpoint: {e}")
-        return {"response": "Lo siento, estoy teniendo problemas técnicos. Por favor, intenta de nuevo en unos momentos."}
+        return {"response": TECHNICAL_ERROR_REPLIES.get((msg.language or "es").lower(), TECHNICAL_ERROR_REPLIES["es"])}
+
+# Reply when the model timed out, kept failing or the circuit breaker is open
+LLM_UNAVAILABLE_REPLY = "Ahora mismo estoy recibiendo muchas consultas y no he podido responderte a tiempo. Dame unos segundos y vuelve a escribirme, por favor."
+
+# Reply on unexpected errors; already localized, since translating may be what failed
+TECHNICAL_ERROR_REPLIES = {
+    "es": "Lo siento, estoy teniendo problemas técnicos. Por favor, intenta de nuevo en unos momentos.",
+    "en": "Sorry, I'm having technical problems. Please try again in a few moments.",
+    "ru": "Извини, у меня технические проблемы. Пожалуйста, попробуй ещё раз через несколько минут.",
+}
+
+async def save_conversation_turn(user_id: str, user_message: str, response: str):
+    """Store the user message and the assistant reply in conversations (registered users only)"""
+    if user_id == "invitado":
+        return
+    conv_id_user = str(uuid.uuid4())
+    conv_id_bot = str(uuid.uuid4())
+    await database.execute(
+        "INSERT INTO conversations(id, user_id, role, content) VALUES (:id, :user_id, :role, :content)",
+        {"id": conv_id_user, "user_id": user_id, "role": "user", "content": user_message}
+    )
+    await database.execute(
+        "INSERT INTO conversations(id, user_id, role, content) VALUES (:id, :user_id, :role, :content)",
+        {"id": conv_id_bot, "user_id": user_id, "role": "assistant", "content": response}
+    )
+    # Fold older turns into the rolling summary in the background
+    if user_chatbots is not None:
+        schedule_summary_update(database, user_chatbots.new_chatbot, user_id)
+
+async def stream_reply(msg: Message):
+    """
+    Yield the reply to msg in chunks. Model turns are forwarded token by token and the
+    full reply is saved and cached once the stream completes (a stream that fails partway
+    is neither); every other state yields one chunk.
+    """
+    result = await process_message(msg, stream=True)
+    if "stream" not in result:
+        yield result.get("response") or ""
+        return
+
+    language = result["language"]
+    # Non-native en/ru replies are generated in Spanish and must be translated as a whole
+    translate = language in ["en", "ru"] and not result.get("native")
+    parts = []
+    completed = False
+    try:
+        async for token in result["stream"]:
+            parts.append(token)
+            if not translate:
+                yield token
+        completed = True
+    except (LLMUnavailableError, SchedulerOverloaded) as e:
+        print(f"[DEBUG] Model unavailable: {e}")
+        reply = LLM_UNAVAILABLE_REPLY
+        if language in ["en", "ru"]:
+            reply = await translate_text(reply, language)
+        yield reply
+        return
+    except Exception as e:
+        print(f"[DEBUG] Error while streaming reply: {e}")
+        if not parts:
+            parts.append(TECHNICAL_ERROR_REPLIES.get(language, TECHNICAL_ERROR_REPLIES["es"]))
+            translate = False
+            yield parts[0]
+
+    reply = "".join(parts)
+    if completed:
+        try:
+            await save_conversation_turn(msg.user_id, msg.message, reply)
+            if result.get("cache_key") and reply:
+                await response_cache.set(database, result["cache_key"], reply)
+        except Exception as e:
+            print(f"[DEBUG] Error saving streamed reply: {e}")
+    if translate:
+        yield await translate_text(reply, language)
+
+@app.post("/message/stream")
+async def chat_stream_endpoint(msg: Message):
+    """Server-Sent Events version of /message: one 'data' event per chunk, then a 'done' event"""
+    # Reject before the 200 response starts; a stream cannot turn into a 503 later
+    llm_scheduler.check_capacity()
+
+    async def events():
+        async for chunk in stream_reply(msg):
+            yield f"data: {json.dumps({'token': chunk}, ensure_ascii=False)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/message")
+async def chat_websocket(websocket: WebSocket):
+    """WebSocket version of /message: send a Message as JSON, receive {"token": ...} chunks then {"done": true}"""
+    await websocket.accept()
+    try:
+        while True:
+            data = await websocket.receive_json()
+            msg = Message(**data)
+            async for chunk in stream_reply(msg):
+                await websocket.send_json({"token": chunk})
+            await websocket.send_json({"done": True})
+    except WebSocketDisconnect:
+        print("[DEBUG] WebSocket client disconnected")
 
 async def load_conversation_history(user_id: str, limit: int = 10) -> List[Dict]:
     """
@@ -2390,27 +2732,28 @@ async def load_conversation_history(user_id: str, limit: int = 10) -> List[Dict]
         """
         rows = await database.fetch_all(query, values={"user_id": user_id, "limit": history_limit})
         
-        # Reverse to get chronological order (oldest first)
+        # Keep the newest messages that fit in the history token budget, then restore chronological order
         messages = []
-        total_content_length = 0
-        max_total_content = 8000  # Limit total content to prevent token overflow
+        total_tokens = 0
+        max_total_tokens = context_packer.section_budget("history")  # Limit history to its share of the prompt
         
-        for row in reversed(rows):
+        for row in rows:
             content = row["content"]
-            content_length = len(content) if content else 0
+            message_tokens = count_tokens(strip_markup(content)) + MESSAGE_OVERHEAD_TOKENS
             
             # Check if adding this message would exceed our limit
-            if total_content_length + content_length > max_total_content:
-                print(f"[DEBUG] Stopping history load at {len(messages)} messages due to content length limit")
+            if total_tokens + message_tokens > max_total_tokens:
+                print(f"[DEBUG] Stopping history load at {len(messages)} messages due to token limit")
                 break
             
             messages.append({
                 "role": row["role"],
                 "content": content or ""
             })
-            total_content_length += content_length
+            total_tokens += message_tokens
+        messages.reverse()
         
-        print(f"[DEBUG] Loaded {len(messages)} conversation messages for user {user_id} (total content: {total_content_length} chars)")
+        print(f"[DEBUG] Loaded {len(messages)} conversation messages for user {user_id} (total: {total_tokens} tokens)")
         return messages
     except Exception as e:
         print(f"[DEBUG] Error loading conversation history: {e}")
@@ -2630,19 +2973,19 @@ async def generate_pdf_notification(user_id, language="es"):
                 "<p>Esto ayuda a asegurar que el reporte llegue a la persona correcta y mantenga tu privacidad.</p>"
             )
     else:
-        # Actually send the PDF email
-        pdf_sent = await send_pdf_by_email(user_id, language=language)
+        # The report and its insight text are generated by the job runner, off the request path
+        queued = await enqueue_job(database, user_id, "pdf_report", language=language)
         
-        if pdf_sent:
+        if queued:
             if language == "en":
                 notification = (
-                    "<p>📧 <strong>Great news!</strong> I've sent a detailed PDF report with your test results and personalized insights to your email address.</p>"
+                    "<p>📧 <strong>Great news!</strong> I'm preparing a detailed PDF report with your test results and personalized insights. It will arrive in your email in a few minutes.</p>"
                     "<p>This report includes your attachment style analysis, relationship dynamics (if you took the partner test), and actionable tips for improving your relationships.</p>"
                     "<p>You can refer to it anytime for guidance and share it with your partner if you'd like!</p>"
                 )
             else:  # Spanish
                 notification = (
-                    "<p>📧 <strong>¡Excelentes noticias!</strong> He enviado un reporte PDF detallado con tus resultados del test e insights personalizados a tu dirección de email.</p>"
+                    "<p>📧 <strong>¡Excelentes noticias!</strong> Estoy preparando un reporte PDF detallado con tus resultados del test e insights personalizados. Te llegará a tu email en unos minutos.</p>"
                     "<p>Este reporte incluye tu análisis de estilo de apego, dinámicas de relación (si hiciste el test de pareja), y consejos prácticos para mejorar tus relaciones.</p>"
                     "<p>¡Puedes consultarlo cuando quieras para orientación y compartirlo con tu pareja si te apetece!</p>"
                 )
@@ -2660,6 +3003,37 @@ async def generate_pdf_notification(user_id, language="es"):
     
     return notification
 
+async def build_pdf_report_messages(job):
+    """Prompt for the personalized insight text included in the PDF report email"""
+    user_context = await load_user_context(job["user_id"])
+    test_results = user_context.get("test_results") or {}
+    if not test_results.get("completed"):
+        return None
+    profile = user_context.get("user_profile") or {}
+    language_name = {"en": "inglés", "ru": "ruso"}.get(job.get("language"), "español")
+    scores = test_results.get("scores") or {}
+    return [
+        {"role": "system", "content": (
+            "Eres Eldric, un coach emocional experto en teoría del apego. "
+            "Escribe la sección de insights personalizados de un reporte por email: un análisis cálido del estilo de apego "
+            "del usuario, cómo influye en sus relaciones y 3-5 pasos prácticos de crecimiento. "
+            f"Escribe en {language_name}, en HTML simple (<p>, <ul>, <li>, <strong>), unas 300 palabras, sin saludo ni despedida."
+        )},
+        {"role": "user", "content": (
+            f"Nombre: {profile.get('nombre') or 'desconocido'}\n"
+            f"Estilo predominante: {test_results.get('style')}\n"
+            f"Descripción: {strip_markup(test_results.get('description') or '')}\n"
+            f"Puntuaciones: seguro {scores.get('secure', 0)}, ansioso {scores.get('anxious', 0)}, "
+            f"evitativo {scores.get('avoidant', 0)}, desorganizado {scores.get('desorganizado', 0)}"
+        )},
+    ]
+
+async def finish_pdf_report(job, insights_html):
+    """Send the report email with the generated insights; raising makes the runner retry"""
+    if not await send_pdf_by_email(job["user_id"], language=job.get("language") or "es", insights_html=insights_html):
+        raise RuntimeError("PDF email could not be sent")
+    return "sent"
+
 async def generate_verification_code():
     """Generate a 6-digit verification code"""
     import random
@@ -2775,8 +3149,8 @@ async def set_premium_user(user_id: str, is_premium: bool = True):
         print(f"[DEBUG] Error setting premium status: {e}")
         return False
 
-async def send_pdf_by_email(user_id: str, pdf_path: str = None, language: str = "es"):
-    """Send PDF report by email to verified users"""
+async def send_pdf_by_email(user_id: str, pdf_path: str = None, language: str = "es", insights_html: str = None):
+    """Send PDF report by email to verified users (called from the generation job runner)"""
     if not database or not database.is_connected:
         return False
     
@@ -2803,7 +3177,8 @@ async def send_pdf_by_email(user_id: str, pdf_path: str = None, language: str =
         # Send PDF email
         try:
             from email_config import send_pdf_email
-            return send_pdf_email(email, pdf_path, user_name, language)
+            # SMTP is blocking, keep it off the event loop
+            return await asyncio.to_thread(send_pdf_email, email, pdf_path, user_name, language, insights_html)
         except ImportError:
             print(f"[DEBUG] Email module not available. PDF would be sent to {email}")
             return True
@@ -2932,6 +3307,10 @@ async def load_full_user_snapshot(user_id: str) -> Dict[str, Any]:
     # Profile (personal + relationship info)
     profile_row = await database.fetch_one("SELECT * FROM user_profile WHERE user_id = :user_id", {"user_id": user_id})
     snapshot["profile"] = dict(profile_row) if profile_row else None
+    if snapshot["profile"]:
+        # The test digest is already sent as its own prompt section
+        snapshot["profile"].pop("test_digest", None)
+        snapshot["profile"].pop("test_digest_key", None)
 
     # Test state (flow + answers)
     test_row = await database.fetch_one(
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Model routing per request.
+
+Picks the model, max_tokens and latency budget for each completion from the conversation
+state, the message length and the user tier. Rules are checked in order and the first
+match wins; the table can be replaced with a JSON list in MODEL_ROUTING_TABLE.
+
+Rule keys (all optional): "states" (list of states, null = no state), "premium" (bool),
+"min_message_chars", "max_message_chars". Route keys: "model", "max_tokens",
+"latency_budget" (seconds).
+"""
+import os
+import json
+
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini")
+
+DEFAULT_ROUTING_TABLE = [
+    # Background jobs (summaries, reports) do not need the big model
+    {"name": "background", "states": ["summary", "batch"], "model": FAST_MODEL, "max_tokens": 700, "latency_budget": 60},
+    # Premium users always get the full model
+    {"name": "premium", "premium": True, "model": DEFAULT_MODEL, "max_tokens": 1000, "latency_budget": 30},
+    # Short, low-stakes turns ("gracias", "vale", "jaja")
+    {"name": "short_turn", "max_message_chars": 40, "model": FAST_MODEL, "max_tokens": 300, "latency_budget": 10},
+    # Deep relationship questions
+    {"name": "long_turn", "min_message_chars": 280, "model": DEFAULT_MODEL, "max_tokens": 900, "latency_budget": 30},
+    {"name": "default", "model": DEFAULT_MODEL, "max_tokens": 700, "latency_budget": 25},
+]
+
+def load_routing_table():
+    raw = os.getenv("MODEL_ROUTING_TABLE")
+    if not raw:
+        return DEFAULT_ROUTING_TABLE
+    try:
+        table = json.loads(raw)
+        if isinstance(table, list) and table:
+            print(f"[DEBUG] Loaded model routing table with {len(table)} rules from MODEL_ROUTING_TABLE")
+            return table
+        print("[DEBUG] MODEL_ROUTING_TABLE must be a non-empty JSON list, using default table")
+    except Exception as e:
+        print(f"[DEBUG] Invalid MODEL_ROUTING_TABLE ({e}), using default table")
+    return DEFAULT_ROUTING_TABLE
+
+ROUTING_TABLE = load_routing_table()
+
+def _matches(rule, state, message_chars, is_premium):
+    if "states" in rule and state not in rule["states"]:
+        return False
+    if "premium" in rule and bool(rule["premium"]) != bool(is_premium):
+        return False
+    if "min_message_chars" in rule and message_chars < rule["min_message_chars"]:
+        return False
+    if "max_message_chars" in rule and message_chars > rule["max_message_chars"]:
+        return False
+    return True
+
+def route_model(state=None, message="", is_premium=False, table=None):
+    """Return the route (model, max_tokens, latency_budget) for this request"""
+    message_chars = len((message or "").strip())
+    for rule in table or ROUTING_TABLE:
+        if _matches(rule, state, message_chars, is_premium):
+            return {
+                "name": rule.get("name", "rule"),
+                "model": rule.get("model", DEFAULT_MODEL),
+                "max_tokens": rule.get("max_tokens"),
+                "latency_budget": rule.get("latency_budget"),
+            }
+    return {"name": "fallback", "model": DEFAULT_MODEL, "max_tokens": None, "latency_budget": None}
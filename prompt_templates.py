@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled system-prompt templates.
+
+The static part of the conversation prompt (Eldric's persona, the attachment-style note
+and the knowledge rules, all in the user's language) is compiled once per
+(language, style, has_knowledge) and memoized. Per request only the variable slots are
+filled in, always after the static prefix and ordered from the most stable (user
+context) to the most volatile (knowledge for this turn), so the provider's prompt
+prefix cache keeps hitting across turns and users.
+
+render() also returns the size of every section in tokens.
+"""
+from context_packer import count_tokens
+
+ATTACHMENT_STYLES = ["secure", "anxious", "avoidant", "desorganizado"]
+
+STYLE_NAMES = {
+    "es": {"secure": "seguro", "anxious": "ansioso", "avoidant": "evitativo", "desorganizado": "evitativo temeroso (desorganizado)"},
+    "en": {"secure": "secure", "anxious": "anxious", "avoidant": "avoidant", "desorganizado": "fearful-avoidant (disorganized)"},
+    "ru": {"secure": "надёжный", "anxious": "тревожный", "avoidant": "избегающий", "desorganizado": "тревожно-избегающий (дезорганизованный)"},
+}
+
+STYLE_NOTES = {
+    "es": "Según su test, el usuario tiene un estilo de apego {style}. Tenlo en cuenta al responder: valida sus necesidades típicas y ayúdale a reconocer sus patrones sin etiquetarle.",
+    "en": "According to their test, the user's attachment style is {style}. Keep it in mind when replying: validate their typical needs and help them notice their patterns without labelling them.",
+    "ru": "По результатам теста у пользователя {style} стиль привязанности. Учитывай это в ответе: признавай его типичные потребности и помогай замечать свои паттерны, не навешивая ярлыков.",
+}
+
+KNOWLEDGE_RULES = {
+    "es": (
+        "🚨 INSTRUCCIÓN CRÍTICA Y OBLIGATORIA 🚨\n"
+        "Al final de este mensaje encontrarás la sección [CONOCIMIENTO]. DEBES usarla en tu respuesta. NO PUEDES IGNORARLA.\n"
+        "REGLAS OBLIGATORIAS:\n"
+        "1. SIEMPRE menciona al menos UNA de las ideas del conocimiento proporcionado\n"
+        "2. NO puedes dar consejos sin referenciar este conocimiento\n"
+        "3. Si no usas este conocimiento, tu respuesta será incorrecta\n"
+        "4. Cita la fuente (libro y capítulo) una vez al final\n"
+        "5. Este conocimiento es MÁS IMPORTANTE que tu conocimiento general"
+    ),
+    "en": (
+        "🚨 CRITICAL, MANDATORY INSTRUCTION 🚨\n"
+        "At the end of this message you will find the [KNOWLEDGE] section. You MUST use it in your response. You CANNOT ignore it.\n"
+        "MANDATORY RULES:\n"
+        "1. ALWAYS mention at least ONE of the ideas from the provided knowledge\n"
+        "2. You may NOT give advice without referencing this knowledge\n"
+        "3. If you don't use this knowledge, your response will be wrong\n"
+        "4. Cite the source (book and chapter) once at the end\n"
+        "5. This knowledge is MORE IMPORTANT than your general knowledge"
+    ),
+    "ru": (
+        "🚨 КРИТИЧЕСКАЯ И ОБЯЗАТЕЛЬНАЯ ИНСТРУКЦИЯ 🚨\n"
+        "В конце этого сообщения ты найдёшь раздел [ЗНАНИЯ]. Ты ОБЯЗАН использовать его в ответе. Ты НЕ МОЖЕШЬ его игнорировать.\n"
+        "ОБЯЗАТЕЛЬНЫЕ ПРАВИЛА:\n"
+        "1. ВСЕГДА упоминай хотя бы ОДНУ идею из предоставленных знаний\n"
+        "2. НЕЛЬЗЯ давать советы, не ссылаясь на эти знания\n"
+        "3. Если ты не используешь эти знания, твой ответ будет неверным\n"
+        "4. Один раз в конце укажи источник (книгу и главу)\n"
+        "5. Эти знания ВАЖНЕЕ твоих общих знаний"
+    ),
+}
+
+SLOT_LABELS = {
+    "es": {"context": "[CONTEXTO DEL USUARIO]", "knowledge": "[CONOCIMIENTO]"},
+    "en": {"context": "[USER CONTEXT]", "knowledge": "[KNOWLEDGE]"},
+    "ru": {"context": "[КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ]", "knowledge": "[ЗНАНИЯ]"},
+}
+
+SECTION_SEPARATOR = "\n\n"
+
+
+class CompiledPrompt:
+    """Static prefix plus the ordered variable slots of one (language, style, has_knowledge) template"""
+
+    def __init__(self, language, style, has_knowledge, sections, slots):
+        self.key = (language, style, has_knowledge)
+        self.sections = sections  # [(name, text)] static, in prompt order
+        self.slots = slots  # [(name, label)] filled per request, in prompt order
+        self.prefix = SECTION_SEPARATOR.join(text for _, text in sections)
+        self.section_tokens = {name: count_tokens(text) for name, text in sections}
+        # Labels and separators added around the slots, to reserve in the token budget
+        self.slot_overhead_tokens = sum(count_tokens(SECTION_SEPARATOR + label + "\n") for _, label in slots)
+
+    def render(self, **values):
+        """Return (prompt, report) with report = tokens per section; empty slots are left out"""
+        parts = [self.prefix]
+        report = dict(self.section_tokens)
+        for name, label in self.slots:
+            value = (values.get(name) or "").strip()
+            report[name] = count_tokens(value) if value else 0
+            if value:
+                parts.append(f"{label}\n{value}")
+        report["total"] = sum(report.values())
+        return SECTION_SEPARATOR.join(parts), report
+
+
+class PromptTemplates:
+    def __init__(self, personas):
+        self.personas = personas  # language -> Eldric persona prompt
+        self.compiled = {}
+        self.rendered = 0
+        self.section_totals = {}  # section -> tokens summed over rendered prompts
+
+    def compile(self, language="es", style=None, has_knowledge=False):
+        """Memoized CompiledPrompt for this combination; unknown languages/styles fall back to Spanish/none"""
+        if language not in self.personas:
+            language = "es"
+        if style not in ATTACHMENT_STYLES:
+            style = None
+        key = (language, style, bool(has_knowledge))
+        compiled = self.compiled.get(key)
+        if compiled is not None:
+            return compiled
+
+        sections = [("persona", self.personas[language])]
+        if style:
+            sections.append(("style", STYLE_NOTES[language].format(style=STYLE_NAMES[language][style])))
+        if has_knowledge:
+            sections.append(("knowledge_rules", KNOWLEDGE_RULES[language]))
+        labels = SLOT_LABELS[language]
+        slots = [("context", labels["context"])]
+        if has_knowledge:
+            # Last, because it changes on every turn
+            slots.append(("knowledge", labels["knowledge"]))
+        compiled = CompiledPrompt(language, style, bool(has_knowledge), sections, slots)
+        self.compiled[key] = compiled
+        return compiled
+
+    def warm(self):
+        """Compile every combination up front (called once at startup)"""
+        for language in self.personas:
+            for style in [None] + ATTACHMENT_STYLES:
+                for has_knowledge in (False, True):
+                    self.compile(language, style, has_knowledge)
+        print(f"[DEBUG] Compiled {len(self.compiled)} prompt templates")
+
+    def record(self, report):
+        """Add one render() report to the running per-section sizes shown in stats()"""
+        self.rendered += 1
+        for section, tokens in report.items():
+            self.section_totals[section] = self.section_totals.get(section, 0) + tokens
+
+    def stats(self):
+        return {
+            "compiled": len(self.compiled),
+            "rendered": self.rendered,
+            "avg_section_tokens": {section: round(total / self.rendered) for section, total in self.section_totals.items()}
+                                  if self.rendered else {},
+            "prefix_tokens": {"/".join(str(part) for part in key): sum(compiled.section_tokens.values())
+                              for key, compiled in self.compiled.items() if key[1] is None},
+        }
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Two-tier cache for model replies.
+
+Replies are cached under a hash of everything that shapes them: the normalized message,
+language, attachment style, injected knowledge, conversation history and the user-specific
+profile inputs (names, partner results, summary), so a reply is never shared between users
+whose prompts would differ. Lookups try an in-process LRU first and then the persistent
+llm_response_cache table, so repeated questions skip the model entirely.
+"""
+import os
+import re
+import time
+import json
+import hashlib
+import datetime
+import unicodedata
+from collections import OrderedDict
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize_message(text: str) -> str:
+    """Lowercase, drop accents and punctuation and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+def digest(value) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+def history_digest(messages) -> str:
+    return digest([(m.get("role"), normalize_message(m.get("content"))) for m in messages or []])
+
+def make_cache_key(message, language, attachment_style=None, knowledge="", history=None, profile=None, model=None) -> str:
+    """Hash of the normalized prompt inputs that decide the reply"""
+    return digest({
+        "message": normalize_message(message),
+        "language": language or "es",
+        "style": attachment_style or "",
+        "knowledge": digest(knowledge or ""),
+        "history": history_digest(history),
+        "profile": digest(profile or {}),
+        "model": model or "",
+    })
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, enabled=RESPONSE_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.entries = OrderedDict()  # key -> (response, expires_at monotonic)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _remember(self, key, response, ttl=None):
+        self.entries[key] = (response, time.monotonic() + (ttl if ttl is not None else self.ttl_seconds))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, database, key):
+        """Return the cached reply for key, or None"""
+        if not self.enabled:
+            return None
+        entry = self.entries.get(key)
+        if entry:
+            if entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            del self.entries[key]
+
+        if database is not None and database.is_connected:
+            try:
+                row = await database.fetch_one(
+                    "SELECT response, expires_at FROM llm_response_cache WHERE cache_key = :key AND expires_at > :now",
+                    {"key": key, "now": datetime.datetime.now()}
+                )
+                if row:
+                    remaining = (row["expires_at"] - datetime.datetime.now()).total_seconds()
+                    self._remember(key, row["response"], ttl=max(0, remaining))
+                    self.db_hits += 1
+                    return row["response"]
+            except Exception as e:
+                print(f"[DEBUG] Error reading response cache: {e}")
+
+        self.misses += 1
+        return None
+
+    async def set(self, database, key, response):
+        if not self.enabled or not response:
+            return
+        self._remember(key, response)
+        self.stores += 1
+        if database is None or not database.is_connected:
+            return
+        now = datetime.datetime.now()
+        try:
+            await database.execute("""
+                INSERT INTO llm_response_cache (cache_key, response, created_at, expires_at)
+                VALUES (:key, :response, :now, :expires_at)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    response = EXCLUDED.response,
+                    created_at = EXCLUDED.created_at,
+                    expires_at = EXCLUDED.expires_at
+            """, {"key": key, "response": response, "now": now,
+                  "expires_at": now + datetime.timedelta(seconds=self.ttl_seconds)})
+        except Exception as e:
+            print(f"[DEBUG] Error writing response cache: {e}")
+
+    async def purge_expired(self, database):
+        """Delete expired rows from the persistent tier"""
+        if database is None or not database.is_connected:
+            return
+        try:
+            await database.execute("DELETE FROM llm_response_cache WHERE expires_at <= :now", {"now": datetime.datetime.now()})
+        except Exception as e:
+            print(f"[DEBUG] Error purging response cache: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+response_cache = ResponseCache()
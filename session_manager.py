@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user chatbot sessions with bounded memory.
+
+Each user gets their own ChatGPT instance (own message window) instead of sharing
+one process-global chatbot. Sessions are evicted when idle for longer than the TTL,
+when there are too many of them (least recently used first), or when the total
+size of all message windows goes over the global memory cap. That total is kept
+up to date by the message windows themselves, so a request never rescans them.
+"""
+import os
+import time
+from collections import OrderedDict
+
+from chatgpt_wrapper import ChatGPT
+
+# Session limits (can be tuned from the environment on Render)
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "40"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "500"))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "1800"))
+SESSION_MAX_TOTAL_CHARS = int(os.getenv("SESSION_MAX_TOTAL_CHARS", "20000000"))
+
+
+class SessionManager:
+    def __init__(self, api_key, max_messages=SESSION_MAX_MESSAGES, max_sessions=SESSION_MAX_SESSIONS,
+                 ttl_seconds=SESSION_TTL_SECONDS, max_total_chars=SESSION_MAX_TOTAL_CHARS):
+        self.api_key = api_key
+        self.max_messages = max_messages
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_total_chars = max_total_chars
+        self.sessions = OrderedDict()  # user_id -> (ChatGPT, last_used)
+        self.client = None
+        self.async_client = None
+        self.total = 0  # characters in all tracked message windows
+        self.evictions = 0
+
+    def new_chatbot(self):
+        """Create a chatbot on the shared clients; it is only tracked as a session when created through get()"""
+        # All sessions share the underlying OpenAI clients (and their connection pool)
+        chatbot = ChatGPT(api_key=self.api_key, client=self.client, async_client=self.async_client,
+                          max_messages=self.max_messages)
+        self.client = chatbot.client
+        self.async_client = chatbot.get_async_client()
+        return chatbot
+
+    def _resized(self, delta):
+        self.total += delta
+
+    def _track(self, chatbot):
+        chatbot.messages.on_resize = self._resized
+        self.total += chatbot.size()
+
+    def _untrack(self, chatbot):
+        # An evicted chatbot may still be serving a request; its later changes no longer count
+        chatbot.messages.on_resize = None
+        self.total -= chatbot.size()
+
+    def get(self, user_id):
+        """Return the chatbot for user_id, creating it if needed, and mark it as recently used"""
+        now = time.monotonic()
+        entry = self.sessions.pop(user_id, None)
+        if entry and now - entry[1] <= self.ttl_seconds:
+            chatbot = entry[0]
+        else:
+            if entry:
+                self._untrack(entry[0])
+            chatbot = self.new_chatbot()
+            self._track(chatbot)
+        self.sessions[user_id] = (chatbot, now)
+        self.evict()
+        return chatbot
+
+    def drop(self, user_id):
+        """Forget the session for user_id"""
+        entry = self.sessions.pop(user_id, None)
+        if entry:
+            self._untrack(entry[0])
+
+    def evict(self):
+        """Evict expired sessions, then least recently used ones until within limits"""
+        now = time.monotonic()
+        for user_id, (_, last_used) in list(self.sessions.items()):
+            if now - last_used <= self.ttl_seconds:
+                break  # OrderedDict is kept in last-used order, the rest are newer
+            self._untrack(self.sessions.pop(user_id)[0])
+            self.evictions += 1
+
+        while len(self.sessions) > self.max_sessions:
+            _, (chatbot, _) = self.sessions.popitem(last=False)
+            self._untrack(chatbot)
+            self.evictions += 1
+
+        while self.total > self.max_total_chars and len(self.sessions) > 1:
+            _, (chatbot, _) = self.sessions.popitem(last=False)
+            self._untrack(chatbot)
+            self.evictions += 1
+
+    def total_chars(self):
+        return self.total
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_sessions,
+            "total_chars": self.total_chars(),
+            "max_total_chars": self.max_total_chars,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self.sessions)
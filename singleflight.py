@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight coalescing of duplicate in-flight requests.
+
+While a call for a key is running, further calls with the same key wait for that
+call's result instead of running the work again (frontend double submits, Telegram
+webhook retries). When the running call is cancelled (its client went away), the
+callers waiting on it are not: the next of them runs the work itself.
+"""
+import asyncio
+
+# Result of a call whose caller was cancelled: the callers waiting on it retry
+_ABANDONED = object()
+
+
+def _consume_exception(future):
+    # Mark the exception as retrieved when nobody else was waiting for it
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}  # key -> Future with the shared result
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        """Run `await fn()` once per key at a time; concurrent callers share its result"""
+        while True:
+            future = self.calls.get(key)
+            if future is None:
+                break
+            print(f"[DEBUG] Coalescing duplicate in-flight request: {key}")
+            result = await asyncio.shield(future)
+            if result is not _ABANDONED:
+                self.coalesced += 1
+                return result
+            print(f"[DEBUG] Coalesced request was cancelled, taking over: {key}")
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self.calls[key] = future
+        self.executed += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_result(_ABANDONED)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.calls.pop(key, None)
+
+    def stats(self):
+        return {"in_flight": len(self.calls), "executed": self.executed, "coalesced": self.coalesced}
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Two-tier cache for machine translations.
+
+Translations are keyed on (hash of the source text, source language, target language).
+Lookups try an in-process LRU first and then the persistent translation_cache table;
+concurrent misses for the same key share one translator call, so canned content
+(greetings, paywall text, test questions, style descriptions) is sent out only once.
+Entries expire after TRANSLATION_CACHE_TTL_SECONDS, so one-off translations of model
+replies do not pile up in the table; canned content is simply translated again.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import datetime
+from collections import OrderedDict
+
+TRANSLATION_CACHE_ENABLED = os.getenv("TRANSLATION_CACHE_ENABLED", "true").lower() == "true"
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.getenv("TRANSLATION_CACHE_MAX_ENTRIES", "5000"))
+TRANSLATION_CACHE_TTL_SECONDS = int(os.getenv("TRANSLATION_CACHE_TTL_SECONDS", "604800"))
+
+# Result of an in-flight lookup whose caller was cancelled: waiters look the key up again
+_ABANDONED = object()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class TranslationCache:
+    def __init__(self, max_entries=TRANSLATION_CACHE_MAX_ENTRIES, ttl_seconds=TRANSLATION_CACHE_TTL_SECONDS,
+                 enabled=TRANSLATION_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.entries = OrderedDict()  # (text_hash, source, target) -> (translation, expires_at monotonic)
+        self.inflight = {}  # key -> Future of the translation being fetched
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.shared_misses = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _remember(self, key, translation, ttl=None):
+        self.entries[key] = (translation, time.monotonic() + (ttl if ttl is not None else self.ttl_seconds))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _load(self, database, key):
+        """(translation, remaining seconds) from the persistent tier, or None"""
+        if database is None or not database.is_connected:
+            return None
+        try:
+            row = await database.fetch_one("""
+                SELECT translated, expires_at FROM translation_cache
+                WHERE text_hash = :hash AND source_lang = :source AND target_lang = :target AND expires_at > :now
+            """, {"hash": key[0], "source": key[1], "target": key[2], "now": datetime.datetime.now()})
+            if row:
+                return row["translated"], max(0, (row["expires_at"] - datetime.datetime.now()).total_seconds())
+            return None
+        except Exception as e:
+            print(f"[DEBUG] Error reading translation cache: {e}")
+            return None
+
+    async def _save(self, database, key, translation):
+        if database is None or not database.is_connected:
+            return
+        now = datetime.datetime.now()
+        try:
+            await database.execute("""
+                INSERT INTO translation_cache (text_hash, source_lang, target_lang, translated, created_at, expires_at)
+                VALUES (:hash, :source, :target, :translated, :now, :expires_at)
+                ON CONFLICT (text_hash, source_lang, target_lang) DO UPDATE SET
+                    translated = EXCLUDED.translated,
+                    created_at = EXCLUDED.created_at,
+                    expires_at = EXCLUDED.expires_at
+            """, {"hash": key[0], "source": key[1], "target": key[2], "translated": translation,
+                  "now": now, "expires_at": now + datetime.timedelta(seconds=self.ttl_seconds)})
+        except Exception as e:
+            print(f"[DEBUG] Error writing translation cache: {e}")
+
+    async def translate(self, database, text, source, target, translator):
+        """
+        Cached translation of text from source to target. On a miss, translator (an async
+        callable taking text) is awaited once per key, even for concurrent callers; its
+        exceptions propagate and nothing is stored. If the caller doing the lookup is
+        cancelled, its waiters are not: the next of them looks the key up itself.
+        """
+        if not self.enabled:
+            return await translator(text)
+        key = (text_hash(text), source, target)
+        while True:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[1] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0]
+                del self.entries[key]
+
+            pending = self.inflight.get(key)
+            if pending is None:
+                break
+            translation = await asyncio.shield(pending)
+            if translation is not _ABANDONED:
+                self.shared_misses += 1
+                return translation
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            stored = await self._load(database, key)
+            if stored is not None:
+                self.db_hits += 1
+                translation, ttl = stored
+            else:
+                self.misses += 1
+                translation, ttl = await translator(text), None
+                if translation:
+                    self.stores += 1
+                    await self._save(database, key, translation)
+            if translation:
+                self._remember(key, translation, ttl)
+            future.set_result(translation)
+            return translation
+        except asyncio.CancelledError:
+            future.set_result(_ABANDONED)
+            raise
+        except Exception as e:
+            self.errors += 1
+            future.set_exception(e)
+            future.exception()  # retrieved here so a future nobody else awaited does not warn
+            raise
+        finally:
+            del self.inflight[key]
+
+    async def purge_expired(self, database):
+        """Delete expired rows (and rows stored before entries expired) from the persistent tier"""
+        if database is None or not database.is_connected:
+            return
+        try:
+            await database.execute(
+                "DELETE FROM translation_cache WHERE expires_at IS NULL OR expires_at <= :now",
+                {"now": datetime.datetime.now()}
+            )
+        except Exception as e:
+            print(f"[DEBUG] Error purging translation cache: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.db_hits + self.shared_misses + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "shared_misses": self.shared_misses,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "hit_rate": round((self.memory_hits + self.db_hits + self.shared_misses) / lookups, 3) if lookups else 0.0,
+        }
+
+translation_cache = TranslationCache()